@@ -0,0 +1,245 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import sys
+
+import logging
+import math
+import os
+
+from .generations import GenerationManifest
+
+#############################################################################
+## cgroups.py -- figure out how many worker threads Envoy should run
+##
+## Left to itself, Envoy starts one worker thread per core on the host. In a
+## container with a CPU limit on a big node, that's far more workers than
+## the CFS quota can actually run, and they all end up fighting over it.
+##
+## So we work out Envoy's --concurrency from, in order of precedence:
+##
+## 1. AMBASSADOR_ENVOY_CONCURRENCY in the environment;
+## 2. envoy_concurrency in the ambassador Module (kubewatch records it in the
+##    generation manifest);
+## 3. the container's CPU quota (cgroup v2 cpu.max, or cgroup v1
+##    cpu.cfs_quota_us / cpu.cfs_period_us), rounded up;
+##
+## never exceeding the number of CPUs we're allowed to run on. If none of
+## these applies, we leave it to Envoy.
+
+logger = logging.getLogger("ambassador.cgroups")
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_CGROUP = "/proc/self/cgroup"
+
+
+def read_file(path):
+    try:
+        with open(path, "r") as fd:
+            return fd.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_paths(proc_cgroup=PROC_CGROUP):
+    """
+    Parse /proc/self/cgroup into { controller: path }. The cgroup v2 unified
+    hierarchy shows up with the controller "".
+    """
+
+    paths = {}
+    data = read_file(proc_cgroup) or ""
+
+    for line in data.split("\n"):
+        fields = line.split(":", 2)
+
+        if len(fields) != 3:
+            continue
+
+        for controller in fields[1].split(","):
+            paths[controller] = fields[2]
+
+    return paths
+
+
+def candidate_dirs(mount, path):
+    """
+    The directories that might hold limits for our cgroup: its own directory
+    and those of its ancestors, under the given mount. If the mount is
+    already our cgroup (as with a cgroup namespace), path won't exist there,
+    and we're left with just the mount itself.
+    """
+
+    dirs = []
+
+    if path:
+        path = path.strip("/")
+
+        while path:
+            candidate = os.path.join(mount, path)
+
+            if os.path.isdir(candidate):
+                dirs.append(candidate)
+
+            path = os.path.dirname(path)
+
+    dirs.append(mount)
+
+    return dirs
+
+
+def v2_quota(cgroup_dir):
+    data = read_file(os.path.join(cgroup_dir, "cpu.max"))
+
+    if not data:
+        return None
+
+    fields = data.split()
+
+    if (len(fields) != 2) or (fields[0] == "max"):
+        return None
+
+    try:
+        return int(fields[0]) / int(fields[1])
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def v1_quota(cgroup_dir):
+    quota = read_file(os.path.join(cgroup_dir, "cpu.cfs_quota_us"))
+    period = read_file(os.path.join(cgroup_dir, "cpu.cfs_period_us"))
+
+    try:
+        quota = int(quota)
+        period = int(period)
+    except (TypeError, ValueError):
+        return None
+
+    if (quota <= 0) or (period <= 0):
+        return None
+
+    return quota / period
+
+
+def cpu_quota(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP):
+    """
+    Return our CPU quota, in CPUs, or None if we don't have one. If we're
+    nested in several limited cgroups, the tightest limit wins.
+    """
+
+    paths = cgroup_paths(proc_cgroup)
+    quotas = []
+
+    if os.path.exists(os.path.join(root, "cgroup.controllers")):
+        # cgroup v2: one unified hierarchy.
+        for cgroup_dir in candidate_dirs(root, paths.get("", None)):
+            quotas.append(v2_quota(cgroup_dir))
+    else:
+        # cgroup v1: the cpu controller has its own hierarchy, which might be
+        # mounted as cpu, cpu,cpuacct, or cpuacct,cpu.
+        for name in [ "cpu", "cpu,cpuacct", "cpuacct,cpu" ]:
+            mount = os.path.join(root, name)
+
+            if os.path.isdir(mount):
+                for cgroup_dir in candidate_dirs(mount, paths.get("cpu", None)):
+                    quotas.append(v1_quota(cgroup_dir))
+
+                break
+
+    quotas = [ quota for quota in quotas if quota ]
+
+    return min(quotas) if quotas else None
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+def positive_int(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+
+    return value if (value > 0) else None
+
+
+def envoy_concurrency(module_value=None, environ=None, root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP, cpus=None):
+    """
+    Work out Envoy's concurrency. Returns (concurrency, source), where source
+    is 'environment', 'module', 'cgroup', or 'default'; concurrency is None
+    for 'default'.
+    """
+
+    if environ is None:
+        environ = os.environ
+
+    if cpus is None:
+        cpus = available_cpus()
+
+    setting = environ.get('AMBASSADOR_ENVOY_CONCURRENCY', None)
+    concurrency = positive_int(setting)
+
+    if concurrency:
+        return concurrency, 'environment'
+    elif setting:
+        logger.warning("ignoring invalid AMBASSADOR_ENVOY_CONCURRENCY %s" % setting)
+
+    concurrency = positive_int(module_value)
+
+    if concurrency:
+        return concurrency, 'module'
+    elif module_value is not None:
+        logger.warning("ignoring invalid envoy_concurrency %s" % module_value)
+
+    quota = cpu_quota(root=root, proc_cgroup=proc_cgroup)
+
+    if quota:
+        concurrency = max(int(math.ceil(quota)), 1)
+
+        if cpus:
+            concurrency = min(concurrency, cpus)
+
+        return concurrency, 'cgroup'
+
+    return None, 'default'
+
+
+def manifest_concurrency(config_dir):
+    """
+    Return the envoy_concurrency that kubewatch recorded for the latest
+    generation in config_dir, if any.
+    """
+
+    manifest = GenerationManifest(config_dir)
+    entry = manifest.latest_entry() if manifest.load() else None
+
+    return entry.get('envoy_concurrency', None) if entry else None
+
+
+if __name__ == "__main__":
+    # This is how start-envoy.sh finds Envoy's concurrency:
+    #
+    # python3 -m ambassador.cgroups $CONFIG_DIR
+    #
+    # prints the concurrency to use, or nothing to leave it to Envoy.
+
+    module_value = manifest_concurrency(sys.argv[1]) if (len(sys.argv) > 1) else None
+    concurrency, source = envoy_concurrency(module_value=module_value)
+
+    if concurrency:
+        print(concurrency)
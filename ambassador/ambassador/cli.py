@@ -25,6 +25,7 @@ import clize
 from clize import Parameter
 
 from .config import Config
+from .route_matcher import RouteMatcher, ReplayStats
 from .utils import RichStatus
 
 from .VERSION import Version
@@ -56,8 +57,10 @@ def handle_exception(what, e, **kwargs):
     show_notices()
 
 def show_notices(printer=logger.log):
-    if Config.scout_notices:
-        for notice in Config.scout_notices:
+    notices = Config.get_scout_notices()
+
+    if notices:
+        for notice in notices:
             try:
                 if isinstance(notice, str):
                     printer(logging.WARNING, notice)
@@ -219,8 +222,83 @@ def config(config_dir_path:Parameter.REQUIRED, output_json_path:Parameter.REQUIR
         # This is fatal.
         sys.exit(1)
 
+def route_label(route):
+    prefix = route['prefix']
+    method = '*'
+    extras = []
+
+    for header in route['headers']:
+        if header['name'] == ':method':
+            method = header.get('value', '*')
+        else:
+            extras.append("%s%s%s" % (header['name'], "~" if header.get('regex', False) else "=",
+                                      header.get('value', '*')))
+
+    label = "%s %s%s" % (method, "regex " if route['regex'] else "", prefix)
+
+    if extras:
+        label += " [%s]" % ", ".join(extras)
+
+    return "%s (%s)" % (label, route['source'])
+
+def replay(config_dir_path:Parameter.REQUIRED, *access_logs, k8s=False, top=20, json_output=False):
+    """
+    Replay Envoy access logs against an Ambassador configuration, showing
+    which routes the requests hit and how many routes Envoy had to try
+
+    :param config_dir_path: Configuration directory to scan for Ambassador YAML files
+    :param access_logs: Files of Envoy ACCESS log lines (other lines are skipped); standard input if none
+    :param k8s: If set, assume configuration files are annotated K8s manifests
+    :param top: Show only this many of the busiest routes (0 for all)
+    :param json_output: If set, write the whole report as JSON
+    """
+
+    try:
+        aconf = parse_config(config_dir_path, k8s=k8s)
+        stats = ReplayStats(RouteMatcher(aconf.envoy_config['routes']))
+
+        for path in (access_logs or [ '-' ]):
+            fd = sys.stdin if path == '-' else open(path, "r")
+
+            try:
+                for line in fd:
+                    stats.add_line(line)
+            finally:
+                if fd is not sys.stdin:
+                    fd.close()
+
+        report = stats.report()
+
+        if json_output:
+            json.dump(report, sys.stdout, indent=4, sort_keys=True)
+            print("")
+            return
+
+        print("Replayed %d requests (%d unmatched, %d lines skipped) against %d routes" %
+              (report['requests'], report['unmatched'], report['skipped'], report['route_count']))
+        print("Average match depth: %.1f" % report['average_depth'])
+
+        for error in report['errors']:
+            print("Route %d can't be replayed: %s" % (error['index'], error['error']))
+
+        routes = report['routes'][:top] if top else report['routes']
+
+        if routes:
+            print("")
+            print("%8s %7s %6s  %s" % ("hits", "share", "depth", "route"))
+
+            for route in routes:
+                print("%8d %6.1f%% %6d  %s" % (route['hits'], (route['hits'] * 100.0) / report['requests'],
+                                              route['depth'], route_label(route)))
+    except Exception as e:
+        handle_exception("EXCEPTION from replay", e,
+                         config_dir_path=config_dir_path)
+
+        # This is fatal.
+        sys.exit(1)
+
 def main():
-    clize.run([config, dump, validate], alt=[version, showid],
+    clize.run([config, dump, validate, replay], alt=[version, showid],
               description="""
               Generate an Envoy config, or manage an Ambassador deployment. Use
 
@@ -15,11 +15,11 @@
 import sys
 
 import collections
-import datetime
 import json
 import logging
 import os
 import re
+import time
 from urllib.parse import urlparse
 
 import jsonschema
@@ -32,6 +32,7 @@ from jinja2 import Environment, FileSystemLoader
 
 from .utils import RichStatus, SourcedDict, read_cert_secret, save_cert, TLSPaths, kube_v1, check_cert_file
 from .mapping import Mapping
+from .scout_reporter import SCOUT_CACHE_PATH, ScoutCache, ScoutReporter
 
 from scout import Scout
 
@@ -69,6 +70,12 @@ from .VERSION import Version
 ## The diag service also uses generate_intermediate_for() to extract the
 ## intermediate config for a given mapping or service.
 
+# Envoy puts virtual cluster names in stat names, so keep them to one dotless
+# element; and prefixes become virtual cluster patterns, so escape whatever
+# is special in a regex.
+VIRTUAL_CLUSTER_NAME_UNSAFE = re.compile(r'[^a-zA-Z0-9_-]')
+VIRTUAL_CLUSTER_PATTERN_UNSAFE = re.compile(r'([.^$*+?()\[\]{}|\\])')
+
 def get_semver(what, version_string):
     semver = None
 
@@ -143,12 +150,18 @@ class Config (object):
     scout_latest_semver = None
     scout_notices = []
 
-    scout_last_response = None
-    scout_last_update = datetime.datetime.now() - datetime.timedelta(hours=24)
-    scout_update_frequency = datetime.timedelta(hours=4)
+    # Scout reports happen in the background, with the results shared by every
+    # Ambassador process (see scout_reporter.py).
+    scout_reporter = ScoutReporter(scout, ScoutCache(SCOUT_CACHE_PATH)) if not scout_error else None
 
     @classmethod
     def scout_report(klass, force_result=None, **kwargs):
+        """
+        Arrange to report to Scout, if it's time, and return the latest result.
+        Never waits for Scout: the report happens in the background, and shows
+        up in later results.
+        """
+
         _notices = []
 
         env_result = os.environ.get("AMBASSADOR_SCOUT_RESULT", None)
@@ -164,28 +177,46 @@ class Config (object):
                 if 'runtime' not in kwargs:
                     kwargs['runtime'] = Config.runtime
 
-                # How long since the last Scout update? If it's been more than an hour,
-                # check Scout again.
-
-                now = datetime.datetime.now()
-
-                if (now - Config.scout_last_update) > Config.scout_update_frequency:
-                    result = Config.scout.report(**kwargs)
+                result, result_timestamp = Config.scout_reporter.report(**kwargs)
 
-                    Config.scout_last_update = now
-                    Config.scout_last_result = dict(**result)
+                if result is None:
+                    # Nobody has heard from Scout yet.
+                    result = { "scout": "pending" }
+                    result_timestamp = time.time()
                 else:
-                    # _notices.append({ "level": "debug", "message": "Returning cached result" })
-                    result = dict(**Config.scout_last_result)
                     result_was_cached = True
-
-                result_timestamp = Config.scout_last_update
             else:
                 result = { "scout": "unavailable" }
-                result_timestamp = datetime.datetime.now()
+                result_timestamp = time.time()
         else:
             _notices.append({ "level": "debug", "message": "Returning forced result" })
-            result_timestamp = datetime.datetime.now()
+            result_timestamp = time.time()
+
+        result['cached'] = result_was_cached
+        result['timestamp'] = result_timestamp
+
+        Config.scout_notices = _notices + Config.scout_result_notices(result)
+
+        return result
+
+    @classmethod
+    def get_scout_notices(klass):
+        """
+        The notices from the latest Scout result that any Ambassador process
+        has. Never blocks, and never reports.
+        """
+
+        if Config.scout_reporter and not os.environ.get("AMBASSADOR_SCOUT_RESULT", None):
+            result, result_timestamp = Config.scout_reporter.latest()
+
+            if result is not None:
+                Config.scout_notices = Config.scout_result_notices(result)
+
+        return Config.scout_notices
+
+    @classmethod
+    def scout_result_notices(klass, result):
+        _notices = []
 
         if not Config.current_semver:
             _notices.append({
@@ -193,9 +224,6 @@ class Config (object):
                 "message": "Ambassador has bad version '%s'??!" % Config.scout_version
             })
 
-        result['cached'] = result_was_cached
-        result['timestamp'] = result_timestamp.timestamp()
-
         # Do version & notices stuff.
         if 'latest_version' in result:
             latest_version = result['latest_version']
@@ -221,9 +249,7 @@ class Config (object):
         if 'notices' in result:
             _notices.extend(result['notices'])
 
-        Config.scout_notices = _notices
-
-        return result
+        return _notices
 
     def __init__(self, config_dir_path, k8s=False, schema_dir_path=None, template_dir_path=None):
         self.config_dir_path = config_dir_path
@@ -1013,6 +1039,8 @@ class Config (object):
             tls_config = None,
             use_proxy_proto = False,
             x_forwarded_proto_redirect = False,
+            envoy_concurrency = None,
+            virtual_clusters = False,
         )
 
         # Next up: let's define initial clusters, routes, and filters.
@@ -1275,6 +1303,10 @@ class Config (object):
             route for group_id, route in self.envoy_routes.items()
         ], reverse=True, key=Mapping.route_weight)
 
+        # ...give each of them a virtual cluster, if we've been asked to...
+        if self.ambassador_module.get('virtual_clusters', False):
+            self.envoy_config['virtual_clusters'] = self.generate_virtual_clusters(self.envoy_config['routes'])
+
         # ...then map clusters back into a list...
         self.envoy_config['clusters'] = [
             self.envoy_clusters[cluster_key] for cluster_key in sorted(self.envoy_clusters.keys())
@@ -1291,6 +1323,64 @@ class Config (object):
         self.envoy_config['breakers'] = self.clean_and_copy(self.breakers)
         self.envoy_config['outliers'] = self.clean_and_copy(self.outliers)
 
+    def generate_virtual_clusters(self, routes):
+        """
+        Build an Envoy virtual cluster for each route, named after the Mapping
+        that defined it, so that Envoy keeps request stats per Mapping rather
+        than just per cluster. Each route is marked with its virtual cluster's
+        name as _virtual_cluster.
+
+        Envoy counts a request against the first virtual cluster that matches
+        it, so these are in the same order as the routes. Virtual clusters
+        can't match on anything but the path and the method, so a Mapping
+        whose route needs other headers to match can also count requests
+        that really went to a later route.
+        """
+
+        virtual_clusters = []
+        names = set([ 'other' ])    # Envoy's name for requests nothing else matches
+
+        for route in routes:
+            source = self.sources.get(route['_source'], None)
+
+            if not source or (source.get('kind', None) != 'Mapping'):
+                continue
+
+            name = VIRTUAL_CLUSTER_NAME_UNSAFE.sub('_', source['name'])
+            unique_name = name
+            suffix = 1
+
+            while unique_name in names:
+                suffix += 1
+                unique_name = "%s_%d" % (name, suffix)
+
+            names.add(unique_name)
+
+            # Envoy matches a virtual cluster's pattern against the whole
+            # path, query string and all.
+            if 'regex' in route:
+                pattern = "(?:%s)(?:\\?.*)?" % route['regex']
+            else:
+                # Case matters here, as it does for the route: envoy.j2
+                # never passes case_sensitive: false on to Envoy.
+                pattern = "%s.*" % VIRTUAL_CLUSTER_PATTERN_UNSAFE.sub(r'\\\1', route['prefix'])
+
+            vcluster = SourcedDict(
+                _source=route['_source'],
+                _group_id=route['_group_id'],
+                name=unique_name,
+                pattern=pattern
+            )
+
+            for header in route.get('headers', []):
+                if (header['name'] == ':method') and not header.get('regex', False):
+                    vcluster['method'] = header['value']
+
+            route['_virtual_cluster'] = unique_name
+            virtual_clusters.append(vcluster)
+
+        return virtual_clusters
+
     @staticmethod
     def tmod_certs_exist(tmod):
         """
@@ -1546,7 +1636,8 @@ class Config (object):
         # as we find them.
         for key in [ 'service_port', 'admin_port', 'diag_port',
                      'liveness_probe', 'readiness_probe', 'auth_enabled',
-                     'use_proxy_proto', 'use_remote_address', 'diagnostics', 'x_forwarded_proto_redirect' ]:
+                     'use_proxy_proto', 'use_remote_address', 'diagnostics', 'x_forwarded_proto_redirect',
+                     'envoy_concurrency', 'virtual_clusters' ]:
             if amod and (key in amod):
                 # Yes. It overrides the default.
                 self.set_config_ambassador(amod, key, amod[key])
@@ -0,0 +1,415 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import sys
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+#############################################################################
+## generations.py -- bookkeeping for kubewatch's configuration generations
+##
+## Every time kubewatch regenerates the Envoy configuration, it writes a new
+## generation: the Ambassador inputs go into $CONFIG_DIR-N, and the validated
+## Envoy configuration goes into envoy-N.json. Without some bookkeeping, the
+## only way to find the latest generation is to scan the filesystem, and the
+## history grows forever.
+##
+## The GenerationManifest fixes both problems. It lives next to the config
+## directory ($CONFIG_DIR-generations.json), records every generation that
+## we're still retaining, and remembers which one is the latest valid one.
+## kubewatch is the only writer; diagd and start-envoy.sh just read it.
+##
+## Retention is controlled by AMBASSADOR_GENERATION_RETENTION (default 10).
+## When a new generation is added, the oldest generations beyond that count
+## are compacted away -- their config directories and Envoy configs are
+## deleted. The latest valid generation is never compacted.
+##
+## Most changes touch only one or two input files, so rewriting every file
+## for every generation is a lot of pointless I/O. The GenerationWriter
+## hardlinks unchanged files from the previous generation instead, and uses
+## an index file in each generation directory (.generation.json, which
+## Config ignores since it's not YAML) to know what's unchanged and to check
+## that each generation directory is complete before anyone uses it.
+
+logger = logging.getLogger("ambassador.generations")
+
+DEFAULT_RETENTION = 10
+
+GENERATION_INDEX = ".generation.json"
+
+
+def read_generation_index(config_dir):
+    """
+    Return the file index for a generation directory, or {} if there isn't one.
+    """
+
+    try:
+        with open(os.path.join(config_dir, GENERATION_INDEX), "r") as fd:
+            return json.load(fd).get('files', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def check_generation_dir(config_dir, files):
+    """
+    Make sure that a generation directory contains exactly the YAML files in
+    its index, with the right sizes. Returns a list of the names that are
+    wrong (missing, mis-sized, or unexpected); an empty list means all is well.
+    """
+
+    bad = []
+
+    try:
+        present = set(name for name in os.listdir(config_dir) if name.endswith(".yaml"))
+    except FileNotFoundError:
+        present = set()
+
+    for name in sorted(present - set(files.keys())):
+        bad.append(name)
+
+    for name in sorted(files.keys()):
+        if name not in present:
+            bad.append(name)
+            continue
+
+        try:
+            size = os.stat(os.path.join(config_dir, name)).st_size
+        except OSError:
+            size = -1
+
+        if size != files[name]['size']:
+            bad.append(name)
+
+    return bad
+
+
+class GenerationWriter (object):
+    def __init__(self, previous_dir=None):
+        self.previous_dir = previous_dir
+        self.previous_files = read_generation_index(previous_dir) if previous_dir else {}
+
+        self.linked = 0
+        self.written = 0
+
+    def link_input(self, name, path):
+        if not self.previous_dir:
+            return False
+
+        try:
+            os.link(os.path.join(self.previous_dir, name), path)
+            return True
+        except OSError as e:
+            # EXDEV, EPERM, ENOENT (the previous generation got compacted),
+            # whatever -- we'll just write the file.
+            if e.errno != errno.ENOENT:
+                logger.debug("could not link %s from %s: %s" % (name, self.previous_dir, e))
+
+            return False
+
+    def write_input(self, path, data):
+        with open(path, "wb") as fd:
+            fd.write(data)
+
+    def write(self, output, configs):
+        """
+        Write configs (a dict of filename => YAML) into the generation directory
+        output, which must already exist and be empty. Unchanged files are linked
+        from the previous generation. Returns the file index for output.
+        """
+
+        files = {}
+        encoded = {}
+
+        for name, config in configs.items():
+            data = config.encode('utf-8')
+            digest = hashlib.sha1(data).hexdigest()
+            path = os.path.join(output, name)
+
+            files[name] = { 'sha1': digest, 'size': len(data) }
+            encoded[name] = data
+
+            previous = self.previous_files.get(name, None)
+
+            if previous and (previous.get('sha1') == digest) and self.link_input(name, path):
+                self.linked += 1
+            else:
+                self.write_input(path, data)
+                self.written += 1
+
+        # Integrity check: if anything is amiss, rewrite it from scratch and
+        # check again.
+        bad = check_generation_dir(output, files)
+
+        if bad:
+            logger.warning("generation %s: repairing %s" % (output, ", ".join(bad)))
+
+            for name in bad:
+                path = os.path.join(output, name)
+
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+                if name in encoded:
+                    self.write_input(path, encoded[name])
+                    self.written += 1
+
+            bad = check_generation_dir(output, files)
+
+            if bad:
+                raise Exception("generation %s is incomplete: %s" % (output, ", ".join(bad)))
+
+        with open(os.path.join(output, GENERATION_INDEX), "w") as fd:
+            json.dump({ 'files': files }, fd, sort_keys=True)
+
+        return files
+
+
+class GenerationManifest (object):
+    def __init__(self, config_dir_prefix, retain=None):
+        self.config_dir_prefix = config_dir_prefix
+        self.path = GenerationManifest.manifest_path(config_dir_prefix)
+
+        if retain is None:
+            retain = int(os.environ.get('AMBASSADOR_GENERATION_RETENTION', DEFAULT_RETENTION))
+
+        # We always keep at least the latest generation, obviously.
+        self.retain = max(retain, 1)
+
+        # 'latest' is the latest _valid_ generation; 'last_generation' is the
+        # highest generation number we've ever handed out, valid or not.
+        self.latest = 0
+        self.last_generation = 0
+        self.generations = []
+
+    @staticmethod
+    def manifest_path(config_dir_prefix):
+        return "%s-generations.json" % config_dir_prefix
+
+    def load(self):
+        """
+        Load the manifest from disk. Returns True if we found a manifest,
+        False if there isn't one (or it's unreadable).
+        """
+
+        try:
+            with open(self.path, "r") as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning("ignoring unreadable generation manifest %s: %s" % (self.path, e))
+            return False
+
+        self.latest = data.get('latest', 0)
+        self.last_generation = data.get('last_generation', self.latest)
+        self.generations = data.get('generations', [])
+
+        return True
+
+    def scan(self):
+        """
+        Rebuild the manifest from whatever generation directories exist on disk,
+        along with the envoy-N.json next to each one, if there is one. This is
+        only needed when upgrading from a version of Ambassador that didn't
+        write a manifest, so it's fine that it's a directory scan.
+        """
+
+        parent = os.path.dirname(os.path.abspath(self.config_dir_prefix))
+        base = os.path.basename(self.config_dir_prefix)
+        matcher = re.compile(r'^%s-(\d+)$' % re.escape(base))
+
+        found = []
+
+        try:
+            names = os.listdir(parent)
+        except FileNotFoundError:
+            names = []
+
+        for name in names:
+            m = matcher.match(name)
+
+            if m and os.path.isdir(os.path.join(parent, name)):
+                found.append(int(m.group(1)))
+
+        self.generations = []
+
+        for generation in sorted(found):
+            envoy_config = os.path.join(parent, "envoy-%d.json" % generation)
+
+            self.generations.append({
+                'generation': generation,
+                'config_dir': "%s-%d" % (self.config_dir_prefix, generation),
+                'envoy_config': envoy_config if os.path.exists(envoy_config) else None,
+                'valid': True,
+                'timestamp': None
+            })
+
+        self.last_generation = max(found) if found else 0
+        self.latest = self.last_generation
+
+        # Envoy should start from the newest generation that has an Envoy
+        # config, if any do.
+        with_configs = [ entry['generation'] for entry in self.generations if entry['envoy_config'] ]
+
+        if with_configs:
+            self.latest = max(with_configs)
+
+        logger.debug("scanned %d generation%s from %s" %
+                     (len(found), "" if (len(found) == 1) else "s", parent))
+
+    def save(self):
+        data = {
+            'latest': self.latest,
+            'last_generation': self.last_generation,
+            'generations': self.generations
+        }
+
+        # Write-and-rename so that readers never see a partial manifest.
+        tmp_path = "%s.tmp" % self.path
+
+        with open(tmp_path, "w") as fd:
+            json.dump(data, fd, indent=4, sort_keys=True)
+
+        os.rename(tmp_path, self.path)
+
+    def next_generation(self):
+        self.last_generation += 1
+        return self.last_generation
+
+    def entry(self, generation):
+        for entry in self.generations:
+            if entry['generation'] == generation:
+                return entry
+
+        return None
+
+    def latest_entry(self):
+        """ Return the entry for the latest valid generation, or None. """
+        return self.entry(self.latest) if self.latest else None
+
+    def newest_entry(self):
+        """ Return the entry for the newest generation, valid or not, or None. """
+        return self.generations[-1] if self.generations else None
+
+    def latest_config_dir(self):
+        """
+        Return the config directory for the latest valid generation. If we
+        don't have one, fall back to the base config directory.
+        """
+
+        entry = self.latest_entry()
+
+        if entry and entry.get('config_dir'):
+            return entry['config_dir']
+        else:
+            return self.config_dir_prefix
+
+    def latest_envoy_config(self):
+        entry = self.latest_entry()
+        return entry.get('envoy_config') if entry else None
+
+    def add(self, generation, config_dir, envoy_config, valid=True, **kwargs):
+        """
+        Record a new generation, compact old generations, and save the manifest.
+        """
+
+        entry = dict(generation=generation, config_dir=config_dir, envoy_config=envoy_config,
+                     valid=valid, timestamp=time.time(), **kwargs)
+
+        self.generations.append(entry)
+
+        if generation > self.last_generation:
+            self.last_generation = generation
+
+        if valid:
+            self.latest = generation
+
+        self.compact()
+        self.save()
+
+        return entry
+
+    def compact(self):
+        """
+        Drop the oldest generations beyond our retention count, deleting their
+        files as we go. The latest valid generation always survives, even if
+        it's old.
+        """
+
+        excess = len(self.generations) - self.retain
+
+        if excess <= 0:
+            return []
+
+        doomed = []
+        kept = []
+
+        for entry in self.generations:
+            if (excess > 0) and (entry['generation'] != self.latest):
+                doomed.append(entry)
+                excess -= 1
+            else:
+                kept.append(entry)
+
+        self.generations = kept
+
+        for entry in doomed:
+            config_dir = entry.get('config_dir')
+            envoy_config = entry.get('envoy_config')
+
+            if config_dir:
+                shutil.rmtree(config_dir, ignore_errors=True)
+
+            if envoy_config:
+                try:
+                    os.unlink(envoy_config)
+                except FileNotFoundError:
+                    pass
+
+            logger.debug("compacted generation %d" % entry['generation'])
+
+        return doomed
+
+
+if __name__ == "__main__":
+    # This is how start-envoy.sh finds the latest Envoy config:
+    #
+    # python3 -m ambassador.generations $CONFIG_DIR [field]
+    #
+    # prints the given field (default 'envoy_config') of the latest valid
+    # generation, and exits nonzero if there isn't one.
+
+    if len(sys.argv) < 2:
+        print("Usage: %s config_dir [field]" % sys.argv[0], file=sys.stderr)
+        sys.exit(2)
+
+    field = sys.argv[2] if (len(sys.argv) > 2) else 'envoy_config'
+
+    manifest = GenerationManifest(sys.argv[1])
+    entry = manifest.latest_entry() if manifest.load() else None
+    value = entry.get(field, None) if entry else None
+
+    if value is None:
+        sys.exit(1)
+
+    print(value)
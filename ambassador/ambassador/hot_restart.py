@@ -0,0 +1,64 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import json
+import logging
+import os
+import socket
+
+#############################################################################
+## hot_restart.py -- talk to hot-restarter.py's control socket
+##
+## The hot restarter answers every connection to its control socket with a
+## line of JSON describing the current Envoy epoch: its number, its state
+## ('starting', 'draining', or 'stable'), how long until it's stable, and
+## whether a restart is pending.
+
+logger = logging.getLogger("ambassador.hot_restart")
+
+DEFAULT_SOCKET = "/tmp/ambassador-restarter.sock"
+
+
+def control_socket_path():
+    return os.environ.get('AMBASSADOR_RESTARTER_SOCKET', DEFAULT_SOCKET)
+
+
+def restarter_status(path=None, timeout=1.0):
+    """
+    Return the hot restarter's status as a dict, or None if we can't get it.
+    """
+
+    path = path or control_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+
+    try:
+        sock.connect(path)
+
+        data = b""
+
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(4096)
+
+            if not chunk:
+                break
+
+            data += chunk
+
+        return json.loads(data.decode("utf-8"))
+    except (OSError, ValueError) as e:
+        logger.debug("could not read restarter status from %s: %s" % (path, e))
+        return None
+    finally:
+        sock.close()
@@ -0,0 +1,361 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import sys
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+
+from abc import ABC, abstractmethod
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+from .utils import kube_v1
+
+#############################################################################
+## leader.py -- leader election for kubewatch
+##
+## By default, every Ambassador replica watches every Service and generates
+## its own Envoy configuration. In leader mode, only one replica (the leader)
+## does that: it publishes each configuration it generates as a snapshot, and
+## the other replicas (followers) just pick up the latest snapshot and switch
+## to it. Followers still fetch the TLS Secrets the snapshot's inputs refer
+## to, since the certs have to be on their own filesystem, and still validate
+## the snapshot's config before restarting Envoy with it. Cert material never
+## goes through the channel.
+##
+## Leadership is a lease: a LeaderLock records who holds it and when they last
+## renewed it, and anyone can take it over once it expires. Snapshots go
+## through a channel. Both come in two flavors: a Kubernetes ConfigMap, for
+## real clusters, and a plain file, for testing (or for replicas sharing a
+## volume).
+##
+## A snapshot is a dict:
+##
+## generation:   the leader's generation number (informational only)
+## leader:       the leader's identity
+## digest:       the SHA-1 of envoy_config, which is how followers tell
+##               whether they already have this snapshot
+## envoy_config: the validated Envoy configuration, as text
+## inputs:       the Ambassador inputs it was generated from, filename => YAML
+
+logger = logging.getLogger("ambassador.leader")
+
+LEADER_KEY = "getambassador.io/leader"
+SNAPSHOT_KEY = "snapshot.json"
+
+DEFAULT_LEASE_DURATION = 15
+
+
+def leader_identity():
+    """
+    Figure out who we are. In Kubernetes, the hostname is the pod name.
+    """
+
+    return os.environ.get('AMBASSADOR_POD_NAME', None) or socket.gethostname()
+
+
+def make_snapshot(generation, leader, envoy_config, inputs, settings=None):
+    return {
+        'generation': generation,
+        'leader': leader,
+        'digest': hashlib.sha1(envoy_config.encode('utf-8')).hexdigest(),
+        'envoy_config': envoy_config,
+        'inputs': inputs,
+        'settings': settings or {}
+    }
+
+
+class LeaderLock (ABC):
+    """
+    A lease-based lock. Subclasses implement acquire() and release(), using
+    can_hold() and new_record() to decide who holds the lease.
+
+    Leases are timestamped with the wall clock, since they're compared across
+    processes (and probably nodes). Clock skew between replicas effectively
+    shortens or lengthens the lease by the skew, so keep the lease duration
+    comfortably larger than that.
+    """
+
+    def __init__(self, identity=None, lease_duration=DEFAULT_LEASE_DURATION, clock=time.time):
+        self.identity = identity or leader_identity()
+        self.lease_duration = lease_duration
+        self.clock = clock
+
+    def can_hold(self, record, now):
+        if not record or not record.get('holder'):
+            return True
+
+        if record['holder'] == self.identity:
+            return True
+
+        return (record.get('renewed', 0) + record.get('lease_duration', self.lease_duration)) < now
+
+    def new_record(self, now):
+        return {
+            'holder': self.identity,
+            'renewed': now,
+            'lease_duration': self.lease_duration
+        }
+
+    @abstractmethod
+    def acquire(self):
+        """
+        Try to acquire the lock, or renew it if we already hold it. Returns True
+        if we hold the lock afterward.
+        """
+        pass
+
+    @abstractmethod
+    def release(self):
+        """
+        Give up the lock if we hold it, so that someone else can take over
+        without waiting for the lease to expire.
+        """
+        pass
+
+
+class FileLock (LeaderLock):
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def locked(self, update):
+        # flock() makes the read-modify-write atomic across processes.
+        with open(self.path, "a+") as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            try:
+                fd.seek(0)
+                data = fd.read()
+
+                try:
+                    record = json.loads(data) if data else None
+                except ValueError:
+                    record = None
+
+                new_record = update(record)
+
+                if new_record is not record:
+                    fd.seek(0)
+                    fd.truncate()
+                    fd.write(json.dumps(new_record))
+                    fd.flush()
+
+                return new_record
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def acquire(self):
+        now = self.clock()
+
+        def update(record):
+            return self.new_record(now) if self.can_hold(record, now) else record
+
+        record = self.locked(update)
+
+        return bool(record) and (record.get('holder') == self.identity)
+
+    def release(self):
+        def update(record):
+            if record and (record.get('holder') == self.identity):
+                return {}
+
+            return record
+
+        self.locked(update)
+
+    def holder(self):
+        record = self.locked(lambda record: record)
+        return record.get('holder') if record else None
+
+
+class ConfigMapLock (LeaderLock):
+    """
+    Keep the lease in an annotation on a ConfigMap. Updates are conditional on
+    the ConfigMap's resourceVersion, so if two replicas race for the lease, one
+    of them gets a 409 Conflict and loses.
+    """
+
+    def __init__(self, v1, namespace, name, **kwargs):
+        super().__init__(**kwargs)
+        self.v1 = v1
+        self.namespace = namespace
+        self.name = name
+
+    def read(self):
+        try:
+            return self.v1.read_namespaced_config_map(self.name, self.namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+
+            raise
+
+    def write(self, cm, record):
+        try:
+            if cm is None:
+                body = client.V1ConfigMap(metadata=client.V1ObjectMeta(
+                    name=self.name, namespace=self.namespace,
+                    annotations={ LEADER_KEY: json.dumps(record) }
+                ))
+
+                self.v1.create_namespaced_config_map(self.namespace, body)
+            else:
+                if cm.metadata.annotations is None:
+                    cm.metadata.annotations = {}
+
+                cm.metadata.annotations[LEADER_KEY] = json.dumps(record)
+
+                # cm still carries the resourceVersion we read, so this fails
+                # if anyone else updated it in the meantime.
+                self.v1.replace_namespaced_config_map(self.name, self.namespace, cm)
+        except ApiException as e:
+            if e.status == 409:
+                logger.debug("%s: lost race for %s/%s" % (self.identity, self.namespace, self.name))
+                return False
+
+            raise
+
+        return True
+
+    def record(self, cm):
+        annotations = (cm.metadata.annotations or {}) if cm else {}
+
+        try:
+            return json.loads(annotations.get(LEADER_KEY, "{}"))
+        except ValueError:
+            return {}
+
+    def acquire(self):
+        now = self.clock()
+        cm = self.read()
+
+        if not self.can_hold(self.record(cm), now):
+            return False
+
+        return self.write(cm, self.new_record(now))
+
+    def release(self):
+        cm = self.read()
+
+        if cm and (self.record(cm).get('holder') == self.identity):
+            self.write(cm, {})
+
+
+class FileChannel (object):
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, snapshot):
+        # Write-and-rename so that followers never see a partial snapshot.
+        tmp_path = "%s.tmp" % self.path
+
+        with open(tmp_path, "w") as fd:
+            json.dump(snapshot, fd)
+
+        os.rename(tmp_path, self.path)
+
+    def fetch(self):
+        try:
+            with open(self.path, "r") as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return None
+
+
+class ConfigMapChannel (object):
+    """
+    Publish snapshots in a ConfigMap. Remember that a ConfigMap is limited to
+    1MB, which bounds the size of configuration leader mode can handle.
+    """
+
+    def __init__(self, v1, namespace, name):
+        self.v1 = v1
+        self.namespace = namespace
+        self.name = name
+
+    def publish(self, snapshot):
+        body = client.V1ConfigMap(
+            metadata=client.V1ObjectMeta(name=self.name, namespace=self.namespace),
+            data={ SNAPSHOT_KEY: json.dumps(snapshot) }
+        )
+
+        try:
+            self.v1.replace_namespaced_config_map(self.name, self.namespace, body)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+            self.v1.create_namespaced_config_map(self.namespace, body)
+
+    def fetch(self):
+        try:
+            cm = self.v1.read_namespaced_config_map(self.name, self.namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+
+            raise
+
+        data = (cm.data or {}).get(SNAPSHOT_KEY, None)
+
+        return json.loads(data) if data else None
+
+
+def leader_election(namespace, v1=None):
+    """
+    Set up leader election as configured by the environment. Returns a
+    (lock, channel) tuple, or None if leader mode isn't enabled.
+
+    AMBASSADOR_LEADER_ELECTION is "configmap" or "file". In configmap mode,
+    the lease and snapshots go in ConfigMaps named by AMBASSADOR_LEADER_CONFIGMAP
+    (default "ambassador-leader") in our namespace; in file mode, they go in the
+    directory AMBASSADOR_LEADER_PATH. AMBASSADOR_LEADER_LEASE sets the lease
+    duration in seconds.
+    """
+
+    mode = os.environ.get('AMBASSADOR_LEADER_ELECTION', '').lower()
+
+    if not mode:
+        return None
+
+    lease_duration = float(os.environ.get('AMBASSADOR_LEADER_LEASE', DEFAULT_LEASE_DURATION))
+
+    if mode == 'configmap':
+        v1 = v1 or kube_v1()
+
+        if not v1:
+            raise Exception("configmap leader election requires the Kubernetes API")
+
+        name = os.environ.get('AMBASSADOR_LEADER_CONFIGMAP', 'ambassador-leader')
+
+        return (ConfigMapLock(v1, namespace, name, lease_duration=lease_duration),
+                ConfigMapChannel(v1, namespace, "%s-snapshot" % name))
+    elif mode == 'file':
+        path = os.environ.get('AMBASSADOR_LEADER_PATH', None)
+
+        if not path:
+            raise Exception("file leader election requires AMBASSADOR_LEADER_PATH")
+
+        return (FileLock(os.path.join(path, "leader.json"), lease_duration=lease_duration),
+                FileChannel(os.path.join(path, SNAPSHOT_KEY)))
+    else:
+        raise Exception("unknown AMBASSADOR_LEADER_ELECTION mode %s" % mode)
@@ -0,0 +1,264 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import sys
+
+import bisect
+import logging
+import socket
+import socketserver
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+#############################################################################
+## metrics.py -- minimal operational metrics for Ambassador's own processes
+##
+## A Registry holds Counters, Gauges, and Histograms. It can render them in
+## the Prometheus text exposition format (which MetricsServer serves over
+## HTTP), and can also send every update to statsd, e.g. via the relay that
+## entrypoint.sh runs on 127.0.0.1:8125.
+##
+## Metrics can have labels: pass them as keyword arguments when updating,
+## e.g. failures.inc(stage="validate").
+
+logger = logging.getLogger("ambassador.metrics")
+
+DEFAULT_BUCKETS = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0 )
+
+
+def format_labels(items):
+    if not items:
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in items)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric (object):
+    kind = None
+
+    def __init__(self, registry, name, help):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        """ Yields (suffix, labels, value) tuples. """
+
+        with self.lock:
+            values = dict(self.values)
+
+        for key in sorted(values.keys()):
+            yield "", key, values[key]
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.kind)
+        ]
+
+        for suffix, labels, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, format_labels(labels), format_value(value)))
+
+        return "\n".join(lines)
+
+
+class Counter (Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+        self.registry.statsd(self.name, labels, "%d|c" % amount)
+
+
+class Gauge (Metric):
+    """
+    A Gauge is either set explicitly, or, if it was created with a function,
+    computed by calling that function every time it's rendered.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, registry, name, help, fn=None):
+        super().__init__(registry, name, help)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+        self.registry.statsd(self.name, labels, "%s|g" % value)
+
+    def samples(self):
+        if self.fn:
+            yield "", (), self.fn()
+        else:
+            yield from super().samples()
+
+
+class Histogram (Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            counts, total = self.values.get(key, ([ 0 ] * (len(self.buckets) + 1), 0))
+
+            # counts[i] is the number of observations in bucket i, with the
+            # last one being +Inf; they're made cumulative when rendered.
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+        self.registry.statsd(self.name, labels, "%d|ms" % (value * 1000))
+
+    def time(self, **labels):
+        return HistogramTimer(self, labels)
+
+    def count(self, **labels):
+        with self.lock:
+            counts, total = self.values.get(self.key(labels), ([ 0 ], 0))
+            return sum(counts)
+
+    def samples(self):
+        with self.lock:
+            values = { key: (list(counts), total) for key, (counts, total) in self.values.items() }
+
+        for key in sorted(values.keys()):
+            counts, total = values[key]
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield "_bucket", key + (("le", format_value(float(bound))),), cumulative
+
+            yield "_sum", key, total
+            yield "_count", key, cumulative
+
+
+class HistogramTimer (object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+
+class Registry (object):
+    def __init__(self):
+        self.metrics = []
+        self.statsd_address = None
+        self.statsd_prefix = ""
+        self.statsd_socket = None
+
+    def counter(self, name, help):
+        return self.add(Counter(self, name, help))
+
+    def gauge(self, name, help, fn=None):
+        return self.add(Gauge(self, name, help, fn=fn))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(self, name, help, buckets=buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+    def enable_statsd(self, host="127.0.0.1", port=8125, prefix=""):
+        self.statsd_address = (host, port)
+        self.statsd_prefix = prefix
+        self.statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def statsd(self, name, labels, value):
+        if not self.statsd_socket:
+            return
+
+        # statsd doesn't do labels, so fold them into the name.
+        stat = ".".join([ self.statsd_prefix + name ] + [ str(labels[key]) for key in sorted(labels.keys()) ])
+
+        try:
+            self.statsd_socket.sendto(("%s:%s" % (stat, value)).encode("utf-8"), self.statsd_address)
+        except OSError as e:
+            # Stats are best effort.
+            logger.debug("could not send %s to statsd: %s" % (stat, e))
+
+
+class MetricsServer (socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Serve a Registry's metrics at /metrics, in a daemon thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, registry, address="", port=8878):
+        self.registry = registry
+        HTTPServer.__init__(self, (address, port), MetricsHandler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="metrics", daemon=True)
+        thread.start()
+
+        return thread
+
+
+class MetricsHandler (BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s" % (self.address_string(), format % args))
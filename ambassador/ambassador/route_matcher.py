@@ -0,0 +1,317 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import collections
+import re
+
+#############################################################################
+## route_matcher.py -- which route would Envoy pick for this request?
+##
+## Envoy tries its routes in order -- for us, the order of
+## envoy_config['routes'], which is sorted by Mapping.route_weight() -- and
+## takes the first one that matches. A RouteMatcher does the same thing
+## without an Envoy, and also tells you how deep into the list the match
+## was, since Envoy pays for every route it tries first.
+##
+## Matching works the way Envoy 1.7 does it with the configuration that
+## envoy.j2 generates:
+##
+## - a prefix matches the start of the whole path, query string and all,
+##   and case matters. (envoy.j2 only passes case_sensitive on to Envoy when
+##   it's true, so Envoy never sees case_sensitive: false, and neither do we.)
+## - a regex has to match the whole path, minus the query string;
+## - a header with no value just has to be present, one with regex: true has
+##   to match the regex completely, and anything else has to be equal. Host
+##   and method Mappings are just :authority and :method headers.
+##
+## Trying every route in turn for every request would be slow with big
+## configurations, so the matcher indexes prefix routes by prefix: for a
+## given path, it looks up each of the path's prefixes that is some route's
+## prefix, and only tries those routes and the regex routes, in order.
+## Results are cached, so replaying a log full of the same few paths is
+## cheap.
+##
+## Envoy's regexes are ECMAScript, and we use Python's; they agree on
+## everything Ambassador users tend to write. A regex Python can't compile
+## never matches, and is listed in RouteMatcher.errors.
+
+# Access log lines, in envoy.j2's ACCESS format:
+#
+# ACCESS [START_TIME] "METHOD PATH PROTOCOL" RESPONSE_CODE RESPONSE_FLAGS BYTES_RECEIVED
+#   BYTES_SENT DURATION UPSTREAM_SERVICE_TIME "X-FORWARDED-FOR" "USER-AGENT" "X-REQUEST-ID"
+#   "AUTHORITY" "UPSTREAM_HOST"
+#
+# PATH is X-Envoy-Original-Path, if Envoy rewrote it, so it's what Envoy
+# matched against. Missing values show up as "-".
+ACCESS_LINE = re.compile(r'ACCESS \[([^\]]*)\] "(\S+) (\S+) ([^"]*)" (\S+) (\S+) (\S+) (\S+) (\S+) (\S+) '
+                         r'"([^"]*)" "([^"]*)" "([^"]*)" "([^"]*)" "([^"]*)"')
+
+ACCESS_FIELDS = [ 'start_time', 'method', 'path', 'protocol', 'response_code', 'response_flags',
+                  'bytes_received', 'bytes_sent', 'duration', 'upstream_service_time',
+                  'x-forwarded-for', 'user-agent', 'x-request-id', 'authority', 'upstream_host' ]
+
+# The request headers an access log line has.
+ACCESS_HEADERS = [ 'x-forwarded-for', 'user-agent', 'x-request-id' ]
+
+# How many results to cache before starting over.
+CACHE_SIZE = 65536
+
+
+def parse_access_line(line):
+    """
+    Parse an ACCESS line into a dict of ACCESS_FIELDS, or None if it isn't
+    one. Fields that Envoy logged as "-" are None.
+    """
+
+    match = ACCESS_LINE.search(line)
+
+    if not match:
+        return None
+
+    return { name: (value if value != '-' else None) for name, value in zip(ACCESS_FIELDS, match.groups()) }
+
+
+def full_match(pattern):
+    return re.compile(r'(?:%s)\Z' % pattern)
+
+
+class RouteMatcher (object):
+    """
+    A matcher for routes, a list of Envoy routes as in envoy_config['routes'],
+    in order. match() returns the index of the route that a request would
+    hit (or None), and the number of routes Envoy would have tried.
+    """
+
+    def __init__(self, routes, cache_size=CACHE_SIZE):
+        self.routes = routes
+        self.errors = []
+        self.cache = {}
+        self.cache_size = cache_size
+
+        # prefix => route indices
+        self.prefixes = collections.defaultdict(list)
+
+        # Routes that have to be tried for every path.
+        self.regex_routes = []
+
+        # For each route, a list of (header name, test) pairs, plus (for
+        # regex routes) the regex.
+        self.header_tests = []
+        self.regexes = []
+
+        # The headers any route looks at, other than :authority and :method.
+        self.header_names = set()
+
+        for index, route in enumerate(routes):
+            self.regexes.append(None)
+            self.header_tests.append(self.compile_headers(index, route.get('headers', [])))
+
+            if 'prefix' in route:
+                self.prefixes[route['prefix']].append(index)
+            elif 'regex' in route:
+                try:
+                    self.regexes[index] = full_match(route['regex'])
+                    self.regex_routes.append(index)
+                except re.error as e:
+                    self.errors.append((index, "bad regex %s: %s" % (route['regex'], e)))
+
+        self.prefix_lengths = sorted(set(len(prefix) for prefix in self.prefixes))
+
+        # A prefix can only match part of the query string if it has a "?" in
+        # it; if none do, the query string doesn't matter, and we can leave
+        # it out of the cache key.
+        self.match_queries = any('?' in prefix for prefix in self.prefixes)
+
+    def compile_headers(self, index, headers):
+        tests = []
+
+        for header in headers:
+            name = header['name'].lower()
+            value = header.get('value', None)
+
+            if not name.startswith(':'):
+                self.header_names.add(name)
+
+            if value is None:
+                test = None
+            elif header.get('regex', False):
+                try:
+                    test = full_match(value).match
+                except re.error as e:
+                    self.errors.append((index, "bad regex for header %s: %s" % (name, e)))
+                    test = lambda value: False
+            else:
+                test = value.__eq__
+
+            tests.append((name, test))
+
+        return tests
+
+    def candidates(self, path):
+        """
+        The indices of the routes that could match path, in order.
+        """
+
+        indices = list(self.regex_routes)
+
+        for length in self.prefix_lengths:
+            if length > len(path):
+                break
+
+            indices.extend(self.prefixes.get(path[:length], []))
+
+        return sorted(indices)
+
+    def route_matches(self, index, path, headers):
+        regex = self.regexes[index]
+
+        if regex and not regex.match(path.split('?', 1)[0]):
+            return False
+
+        for name, test in self.header_tests[index]:
+            value = headers.get(name, None)
+
+            if (value is None) or (test and not test(value)):
+                return False
+
+        return True
+
+    def match(self, path, method='GET', authority=None, headers=None):
+        """
+        Returns (index, depth): the index of the route that a request for
+        path would hit, or None if none would, and how many routes Envoy
+        would try to find it. headers is a dict of request headers, with
+        lowercase names.
+        """
+
+        headers = dict(headers or {})
+        headers[':method'] = method
+
+        if authority is not None:
+            headers[':authority'] = authority
+
+        key = (path if self.match_queries else path.split('?', 1)[0], method, authority,
+               tuple(headers.get(name, None) for name in sorted(self.header_names)))
+
+        result = self.cache.get(key, None)
+
+        if result is None:
+            result = (None, len(self.routes))
+
+            for index in self.candidates(path):
+                if self.route_matches(index, path, headers):
+                    result = (index, index + 1)
+                    break
+
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+
+            self.cache[key] = result
+
+        return result
+
+    def lookup(self, path, method='GET', authority=None, headers=None):
+        """
+        match(), for humans: a dict with the route (or None), its index, the
+        depth, and how many routes there are.
+        """
+
+        index, depth = self.match(path, method=method, authority=authority, headers=headers)
+
+        return {
+            'route': self.routes[index] if index is not None else None,
+            'index': index,
+            'depth': depth,
+            'route_count': len(self.routes)
+        }
+
+
+class ReplayStats (object):
+    """
+    Per-route hit counts and match depth for a bunch of requests replayed
+    through a RouteMatcher.
+    """
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.hits = collections.Counter()
+        self.requests = 0
+        self.unmatched = 0
+        self.skipped = 0
+        self.total_depth = 0
+
+    def add(self, path, method='GET', authority=None, headers=None):
+        index, depth = self.matcher.match(path, method=method, authority=authority, headers=headers)
+
+        self.requests += 1
+        self.total_depth += depth
+
+        if index is None:
+            self.unmatched += 1
+        else:
+            self.hits[index] += 1
+
+        return index
+
+    def add_line(self, line):
+        """
+        Replay an ACCESS log line. Anything else is counted as skipped.
+        """
+
+        entry = parse_access_line(line)
+
+        if not entry:
+            self.skipped += 1
+            return None
+
+        headers = { name: entry[name] for name in ACCESS_HEADERS if entry[name] is not None }
+
+        return self.add(entry['path'], method=entry['method'], authority=entry['authority'], headers=headers)
+
+    def average_depth(self):
+        return (self.total_depth / self.requests) if self.requests else 0.0
+
+    def report(self):
+        """
+        The results, as a dict. Routes are listed busiest first, each with
+        its position, the requests that hit it, and the route evaluations
+        those requests cost.
+        """
+
+        routes = []
+
+        for index, hits in self.hits.most_common():
+            route = self.matcher.routes[index]
+
+            routes.append({
+                'index': index,
+                'prefix': route['prefix'] if 'prefix' in route else route['regex'],
+                'regex': 'regex' in route,
+                'headers': route.get('headers', []),
+                'source': route.get('_source', None),
+                'group_id': route.get('_group_id', None),
+                'hits': hits,
+                'depth': index + 1,
+                'evaluations': hits * (index + 1)
+            })
+
+        return {
+            'requests': self.requests,
+            'unmatched': self.unmatched,
+            'skipped': self.skipped,
+            'route_count': len(self.matcher.routes),
+            'average_depth': self.average_depth(),
+            'errors': [ { 'index': index, 'error': error } for index, error in self.matcher.errors ],
+            'routes': routes
+        }
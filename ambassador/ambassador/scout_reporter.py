@@ -0,0 +1,322 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import atexit
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+#############################################################################
+## scout_reporter.py -- report to Scout without making anyone wait for it
+##
+## Scout is asked about every few hours, but the asking used to happen right
+## in the middle of whatever wanted the answer: a diag page, a kubewatch
+## generation, a CLI command. With no network, each of those stalled on
+## timeouts.
+##
+## Now ScoutReporter.report() never blocks. It answers from the last result
+## it has, and if that's stale, hands the report to a background thread,
+## which gives up on Scout after REPORT_TIMEOUT seconds no matter what.
+##
+## The last result lives in a small JSON file (a ScoutCache) that every
+## Ambassador process in the pod shares, so that diagd, its workers,
+## kubewatch, and the CLI all see the same answer, and only one of them at a
+## time -- whichever holds a lock on the lock file -- talks to Scout.
+##
+## That's a POSIX record lock (lockf()), not an flock(): diagd forks worker
+## processes, and a forked child would otherwise keep holding an flock()
+## its parent took.
+
+logger = logging.getLogger("ambassador.scout")
+
+SCOUT_CACHE_PATH = os.environ.get('AMBASSADOR_SCOUT_CACHE', '/tmp/ambassador-scout.json')
+
+# How old a result can get before we ask Scout again...
+UPDATE_FREQUENCY = 4 * 60 * 60
+
+# ...how long to wait before trying again when Scout couldn't be reached...
+RETRY_FREQUENCY = 10 * 60
+
+# ...and how long to give Scout before deciding it can't be.
+REPORT_TIMEOUT = 5
+
+# How long a process will wait at exit for a report that's still in flight.
+# Short, since nobody should have to wait for Scout to get their prompt back.
+EXIT_WAIT = 0.5
+
+
+class ScoutCache (object):
+    """
+    The last Scout result, in a file shared by every process. An entry is
+    a dict with the result, the time it arrived ("timestamp"), and the time
+    anyone last tried to report ("attempted"), all in time.time() seconds.
+
+    If the file can't be written, the cache still works, just only for this
+    process.
+    """
+
+    def __init__(self, path=SCOUT_CACHE_PATH):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.lock_fd = None
+
+        # What we last read or wrote, and the stat of the file it came from.
+        self.entry = None
+        self.stamp = None
+
+    def load(self):
+        """
+        Returns the latest entry, or None if there isn't one yet. Only reads
+        the file if it has changed since we last did.
+        """
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return self.entry
+
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+        if stamp != self.stamp:
+            try:
+                with open(self.path, "r") as fd:
+                    entry = json.load(fd)
+
+                if isinstance(entry, dict) and ('result' in entry):
+                    self.entry = entry
+            except (OSError, ValueError) as e:
+                logger.debug("could not read Scout cache %s: %s" % (self.path, e))
+
+            self.stamp = stamp
+
+        return self.entry
+
+    def save(self, entry):
+        self.entry = entry
+
+        # Write somewhere else and rename, so that nobody ever reads half of
+        # an entry.
+        tmp_path = "%s.%d" % (self.path, os.getpid())
+
+        try:
+            with open(tmp_path, "w") as fd:
+                json.dump(entry, fd, default=str)
+
+            os.rename(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("could not save Scout cache %s: %s" % (self.path, e))
+            return
+
+        st = os.stat(self.path)
+        self.stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def claim(self):
+        """
+        Try to become the one process reporting to Scout. Returns False if
+        another process already is.
+        """
+
+        try:
+            self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            # No lock file, no coordination, but we can still report.
+            logger.debug("could not open %s: %s" % (self.lock_path, e))
+            return True
+
+        try:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            self.release()
+
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+
+            raise
+
+        return True
+
+    def release(self):
+        if self.lock_fd is not None:
+            # Closing the file drops the lock.
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+
+class ScoutReporter (object):
+    """
+    Reports to scout (a scout.Scout) from a background thread, caching the
+    results in cache (a ScoutCache).
+    """
+
+    def __init__(self, scout, cache, frequency=UPDATE_FREQUENCY, retry=RETRY_FREQUENCY, timeout=REPORT_TIMEOUT):
+        self.scout = scout
+        self.cache = cache
+        self.frequency = frequency
+        self.retry = retry
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.idle = threading.Event()
+        self.idle.set()
+
+        # The keyword arguments of the next report to send.
+        self.pending = None
+        self.worker = None
+        self.flush_registered = False
+        self.reports = 0
+        self.timeouts = 0
+
+    def stale(self, entry, now):
+        if entry is None:
+            return True
+
+        if (now - entry.get('timestamp', 0)) < self.frequency:
+            return False
+
+        return (now - entry.get('attempted', 0)) >= self.retry
+
+    def latest(self):
+        """
+        Returns (result, timestamp) for the newest result any process has,
+        or (None, None) if there isn't one yet. Never blocks, and never
+        reports.
+        """
+
+        entry = self.cache.load()
+
+        if entry is None:
+            return None, None
+
+        return dict(entry['result']), entry.get('timestamp', None)
+
+    def report(self, **kwargs):
+        """
+        Returns (result, timestamp) like latest(), after arranging for the
+        background thread to report to Scout with kwargs, if it's time.
+        """
+
+        entry = self.cache.load()
+
+        if self.stale(entry, time.time()):
+            self.queue(kwargs)
+
+        return self.latest()
+
+    def queue(self, kwargs):
+        with self.lock:
+            # If a report is already waiting, this one replaces it: Scout only
+            # needs the latest.
+            self.pending = kwargs
+            self.idle.clear()
+
+            # (The worker doesn't survive a fork, so check that it's alive.)
+            if not (self.worker and self.worker.is_alive()):
+                self.worker = threading.Thread(target=self.run, name="scout-reporter", daemon=True)
+                self.worker.start()
+
+            if not self.flush_registered:
+                # Give a report that's in flight a brief chance to finish
+                # before a short-lived process (like the CLI) exits.
+                atexit.register(self.flush, EXIT_WAIT)
+                self.flush_registered = True
+
+            self.wakeup.set()
+
+    def flush(self, timeout=None):
+        """
+        Wait (up to timeout seconds, or a little longer than a report can
+        take) for any pending report. Returns True if there isn't one.
+        """
+
+        return self.idle.wait(self.timeout + 1 if timeout is None else timeout)
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+
+            with self.lock:
+                kwargs = self.pending
+                self.pending = None
+                self.wakeup.clear()
+
+            if kwargs is not None:
+                try:
+                    self.send(kwargs)
+                except Exception as e:
+                    logger.warning("Scout report failed: %s" % e)
+
+            with self.lock:
+                if self.pending is None:
+                    self.idle.set()
+
+    def send(self, kwargs):
+        if not self.cache.claim():
+            # Someone else is reporting; we'll see their result in the cache.
+            return
+
+        try:
+            # Someone else may have reported while we waited.
+            entry = self.cache.load()
+            now = time.time()
+
+            if not self.stale(entry, now):
+                return
+
+            result = self.call(kwargs)
+            new_entry = dict(entry) if entry else { 'timestamp': 0 }
+            new_entry['attempted'] = now
+
+            if 'exception' not in result:
+                new_entry.update(result=result, timestamp=time.time())
+            elif entry is None:
+                # A failed report is better than no result at all, but don't
+                # count it as fresh.
+                new_entry['result'] = result
+
+            self.cache.save(new_entry)
+        finally:
+            self.cache.release()
+
+    def call(self, kwargs):
+        """
+        Report to Scout, giving up after self.timeout seconds. (Scout does
+        have its own timeouts, but they don't cover things like DNS.)
+        """
+
+        self.reports += 1
+        results = []
+
+        def report():
+            try:
+                results.append(self.scout.report(**kwargs))
+            except Exception as e:
+                results.append({ 'exception': 'could not report: %s' % e })
+
+        thread = threading.Thread(target=report, name="scout-report", daemon=True)
+        thread.start()
+        thread.join(self.timeout)
+
+        if not results:
+            # Leave it behind; it's a daemon thread, and it can't hurt us now.
+            self.timeouts += 1
+            logger.warning("Scout did not answer within %s seconds" % self.timeout)
+            return { 'exception': 'timed out after %s seconds' % self.timeout }
+
+        # Scout can hand back exception objects; keep only what JSON can.
+        return json.loads(json.dumps(results[0], default=str))
@@ -22,6 +22,8 @@ import os
 import logging
 
 from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import HTTPError
 from enum import Enum
 
 from .VERSION import Version
@@ -170,18 +172,71 @@ class PeriodicTrigger(threading.Thread):
             self.onfired()
 
 
+class SecretCache (object):
+    """
+    A TTL cache of secret contents, so that building a Config doesn't have to
+    hit the API server for every TLS context. kubewatch watches secrets and
+    invalidates entries as they change, so the TTL (AMBASSADOR_SECRET_TTL,
+    default 300 seconds) is just a backstop.
+    """
+
+    def __init__(self, ttl=None, clock=time.monotonic):
+        if ttl is None:
+            ttl = float(os.environ.get("AMBASSADOR_SECRET_TTL", 300))
+
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, namespace, name):
+        """ Returns (True, value) for a fresh entry, (False, None) otherwise. """
+
+        with self.lock:
+            entry = self.entries.get((namespace, name), None)
+
+            if entry and (entry[0] > self.clock()):
+                return True, entry[1]
+
+        return False, None
+
+    def put(self, namespace, name, value):
+        with self.lock:
+            self.entries[(namespace, name)] = (self.clock() + self.ttl, value)
+
+    def invalidate(self, namespace, name=None):
+        with self.lock:
+            if name is None:
+                for key in [ key for key in self.entries.keys() if key[0] == namespace ]:
+                    del(self.entries[key])
+            else:
+                self.entries.pop((namespace, name), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+secret_cache = SecretCache()
+
+
 def read_cert_secret(k8s_api, secret_name, namespace):
     cert_data = None
     cert = None
     key = None
 
-    try:
-        cert_data = k8s_api.read_namespaced_secret(secret_name, namespace)
-    except client.rest.ApiException as e:
-        if e.reason == "Not Found":
-            pass
-        else:
-            logger.info("secret %s/%s could not be read: %s" % (namespace, secret_name, e))
+    cached, cert_data = secret_cache.get(namespace, secret_name)
+
+    if not cached:
+        try:
+            cert_data = k8s_api.read_namespaced_secret(secret_name, namespace)
+            secret_cache.put(namespace, secret_name, cert_data)
+        except client.rest.ApiException as e:
+            if e.reason == "Not Found":
+                # Remember that it doesn't exist, too.
+                secret_cache.put(namespace, secret_name, None)
+            else:
+                logger.info("secret %s/%s could not be read: %s" % (namespace, secret_name, e))
 
     if cert_data and cert_data.data:
         cert_data = cert_data.data
@@ -210,10 +265,114 @@ def save_cert(cert, key, dir):
         open(os.path.join(dir, "tls.key"), "w").write(key.decode("utf-8"))
 
 
+class TokenBucket (object):
+    """
+    A simple thread-safe token bucket: take() blocks until a token is
+    available. Tokens accumulate at rate per second, up to burst.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.last = self.clock()
+
+    def take(self):
+        if self.rate <= 0:
+            return
+
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + ((now - self.last) * self.rate))
+            self.last = now
+
+            # Claim our token now, even if that leaves us in debt; the debt is
+            # how long we have to wait. Doing it this way means concurrent
+            # callers queue up fairly instead of all waking at once.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if (self.tokens < 0) else 0
+
+        if wait > 0:
+            self.sleep(wait)
+
+
+class RateLimitedApiClient (client.ApiClient):
+    """
+    An ApiClient that limits the rate of requests to the API server. A watch
+    counts as a single request, no matter how long it streams.
+    """
+
+    def __init__(self, configuration, qps, burst):
+        super().__init__(configuration)
+        self.bucket = TokenBucket(qps, burst)
+
+    def request(self, *args, **kwargs):
+        self.bucket.take()
+        return super().request(*args, **kwargs)
+
+
+_kube_lock = threading.Lock()
+_kube_api = None
+_kube_loaded = False
+
+
 def kube_v1():
-    # Assume we got nothin'.
-    k8s_api = None
+    """
+    Return the process-wide CoreV1Api, or None if we don't have Kubernetes.
+
+    Everyone shares the one client, so loading credentials happens only once
+    (until reset_kube_v1()), everyone shares one connection pool
+    (AMBASSADOR_KUBE_POOL_SIZE connections, default 16), and requests are
+    limited to AMBASSADOR_KUBE_QPS per second (default 5) with bursts of up to
+    AMBASSADOR_KUBE_BURST (default 10).
+
+    If we couldn't load credentials, we try again on the next call.
+    """
+
+    global _kube_api, _kube_loaded
+
+    with _kube_lock:
+        if not _kube_loaded:
+            _kube_api = _load_kube_v1()
+            _kube_loaded = _kube_api is not None
+
+        return _kube_api
 
+
+def reset_kube_v1():
+    """
+    Drop the process-wide CoreV1Api, so that the next kube_v1() loads
+    credentials and connects all over again. Service account tokens expire
+    and get rotated, so do this whenever kube_reset_needed() says so.
+    """
+
+    global _kube_api, _kube_loaded
+
+    with _kube_lock:
+        if _kube_loaded:
+            logger.info("Reloading Kubernetes credentials")
+
+        _kube_api = None
+        _kube_loaded = False
+
+
+def kube_reset_needed(e):
+    """
+    Return True if the exception e means our Kubernetes client is no good any
+    more: the API server rejected our credentials, or we couldn't talk to it.
+    """
+
+    if isinstance(e, ApiException):
+        return e.status in (401, 403)
+
+    return isinstance(e, (HTTPError, ConnectionError))
+
+
+def _load_kube_v1():
     # XXX: is there a better way to check if we are inside a cluster or not?
     if "KUBERNETES_SERVICE_HOST" in os.environ:
         # If this goes horribly wrong and raises an exception (it shouldn't),
@@ -224,19 +383,26 @@ def kube_v1():
             configuration = client.Configuration()
             configuration.verify_ssl=False
             client.Configuration.set_default(configuration)
-        k8s_api = client.CoreV1Api()
     else:
         # Here, we might be running in docker, in which case we'll likely not
         # have any Kube secrets, and that's OK.
         try:
             config.load_kube_config()
-            k8s_api = client.CoreV1Api()
         except FileNotFoundError:
             # Meh, just ride through.
             logger.info("No K8s")
-            pass
+            return None
+
+    # client.Configuration() gives us a copy of the default configuration
+    # that the loaders above set up.
+    configuration = client.Configuration()
+    configuration.connection_pool_maxsize = int(os.environ.get("AMBASSADOR_KUBE_POOL_SIZE", 16))
+
+    api_client = RateLimitedApiClient(configuration,
+                                      float(os.environ.get("AMBASSADOR_KUBE_QPS", 5)),
+                                      int(os.environ.get("AMBASSADOR_KUBE_BURST", 10)))
 
-    return k8s_api
+    return client.CoreV1Api(api_client)
 
 
 def check_cert_file(path):
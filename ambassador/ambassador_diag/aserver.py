@@ -0,0 +1,265 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import sys
+
+import asyncio
+import concurrent.futures
+import io
+import logging
+import os
+import tempfile
+
+from aiohttp import web
+
+from .diagd import alive_status, ready_status
+
+#############################################################################
+## aserver.py -- serve diagd from an asyncio event loop
+##
+## The liveness and readiness probes are answered right on the event loop,
+## from EnvoyStats' in-memory state, so they never wait behind an expensive
+## diag page. Everything else goes to the Flask app through a small WSGI
+## bridge, running in a bounded pool of worker processes. (Processes, not
+## threads: a thread rendering a big page holds the GIL, and the probes
+## would wait for it.) If too many requests are already waiting for the
+## pool, we answer 503 rather than piling up more work.
+##
+## Each worker process has its own Config cache. Only the main process
+## polls Envoy for stats; the workers read what it collects from shared
+## memory (see shared.py).
+##
+## A response has to get from the worker back to the main process somehow.
+## Small ones come back pickled; anything bigger than SPOOL_SIZE (like a big
+## streamed overview) is spooled to a temporary file as the app produces it,
+## and the main process sends that file on in CHUNK_SIZE pieces. Neither
+## process ever holds more than SPOOL_SIZE of a response in memory, but a
+## response does have to be complete before any of it is sent.
+
+logger = logging.getLogger("ambassador.diagd.aserver")
+
+# Responses bigger than this go through a temporary file...
+SPOOL_SIZE = 256 * 1024
+
+# ...which gets sent this much at a time.
+CHUNK_SIZE = 64 * 1024
+
+# The Flask app, for the worker processes, which are forked after this is set.
+wsgi_app = None
+worker_pid = None
+
+
+def worker_setup():
+    global worker_pid
+
+    if worker_pid == os.getpid():
+        return
+
+    worker_pid = os.getpid()
+
+    # Leave polling Envoy to the main process.
+    wsgi_app.estats.elect = False
+
+
+def run_wsgi(environ, body):
+    """
+    Run the Flask app in a worker process. Returns (status, headers, body,
+    path): body is the response body, unless it was too big, in which case
+    it's None, and path is the temporary file it's in. Whoever gets a path
+    has to remove the file.
+    """
+
+    worker_setup()
+
+    environ.update({
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr
+    })
+
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [ status, headers ]
+
+    result = wsgi_app(environ, start_response)
+    data = bytearray()
+    spool = None
+
+    try:
+        for chunk in result:
+            if spool:
+                spool.write(chunk)
+                continue
+
+            data += chunk
+
+            if len(data) > SPOOL_SIZE:
+                spool = tempfile.NamedTemporaryFile(prefix="diagd-", delete=False)
+                spool.write(data)
+                data = None
+    except:
+        if spool:
+            spool.close()
+            os.unlink(spool.name)
+
+        raise
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    if spool:
+        spool.close()
+        return started[0], started[1], None, spool.name
+
+    return started[0], started[1], bytes(data), None
+
+
+class AsyncDiagServer (object):
+    def __init__(self, flask_app, workers=2, max_pending=None, loop=None):
+        global wsgi_app
+
+        wsgi_app = flask_app
+
+        self.flask_app = flask_app
+        self.workers = workers
+        self.max_pending = max_pending or (workers * 4)
+        self.loop = loop or asyncio.get_event_loop()
+        self.pending = 0
+        self.rejected = 0
+
+        # Fork the workers now, before anything starts any threads.
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.executor.submit(os.getpid).result()
+
+    def make_app(self):
+        app = web.Application(loop=self.loop)
+
+        app.router.add_get('/ambassador/v0/check_alive', self.check_alive)
+        app.router.add_get('/ambassador/v0/check_ready', self.check_ready)
+        app.router.add_route('*', '/{tail:.*}', self.handle_wsgi)
+
+        return app
+
+    async def check_alive(self, request):
+        text, status = alive_status(self.flask_app.estats)
+        return web.Response(text=text, status=status)
+
+    async def check_ready(self, request):
+        text, status = ready_status(self.flask_app.estats)
+        return web.Response(text=text, status=status)
+
+    def environ(self, request, body):
+        """
+        The WSGI environ for a request, minus the wsgi.input and wsgi.errors
+        that run_wsgi() adds, since it has to be pickled.
+        """
+
+        host, port = self.server_address(request)
+
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request.path,
+            'QUERY_STRING': request.query_string,
+            'SERVER_NAME': host,
+            'SERVER_PORT': str(port),
+            'SERVER_PROTOCOL': "HTTP/%d.%d" % request.version,
+            'REMOTE_ADDR': request.remote or '',
+            'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': request.scheme,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False
+        }
+
+        for name in set(request.headers.keys()):
+            key = "HTTP_%s" % name.upper().replace('-', '_')
+
+            if key not in [ 'HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH' ]:
+                environ[key] = ",".join(request.headers.getall(name))
+
+        return environ
+
+    def server_address(self, request):
+        sockname = request.transport.get_extra_info('sockname') if request.transport else None
+
+        if sockname:
+            return sockname[0], sockname[1]
+
+        return "localhost", 0
+
+    async def handle_wsgi(self, request):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            return web.Response(text="diagd is busy, try again later", status=503)
+
+        self.pending += 1
+
+        try:
+            body = await request.read()
+
+            try:
+                status, headers, data, path = await self.loop.run_in_executor(self.executor, run_wsgi,
+                                                                              self.environ(request, body), body)
+            except Exception as e:
+                logger.error("diag request %s failed: %s" % (request.path, e))
+                return web.Response(text="server error", status=500)
+
+            code, reason = status.split(' ', 1)
+
+            if path:
+                return await self.send_file(request, int(code), reason, headers, path)
+
+            response = web.Response(status=int(code), reason=reason, body=data)
+            self.add_headers(response, headers)
+
+            return response
+        finally:
+            self.pending -= 1
+
+    def add_headers(self, response, headers):
+        for name, value in headers:
+            if name.lower() != 'content-length':
+                response.headers.add(name, value)
+
+    async def send_file(self, request, code, reason, headers, path):
+        """
+        Send a response that run_wsgi() spooled to path, then remove it.
+        """
+
+        try:
+            with open(path, "rb") as fd:
+                response = web.StreamResponse(status=code, reason=reason)
+                self.add_headers(response, headers)
+                response.content_length = os.fstat(fd.fileno()).st_size
+
+                await response.prepare(request)
+
+                while True:
+                    chunk = await self.loop.run_in_executor(None, fd.read, CHUNK_SIZE)
+
+                    if not chunk:
+                        break
+
+                    await response.write(chunk)
+
+                await response.write_eof()
+                return response
+        finally:
+            os.unlink(path)
+
+    def run(self, host, port):
+        web.run_app(self.make_app(), host=host, port=port, print=None, access_log=None)
@@ -16,31 +16,44 @@
 
 import sys
 
+import atexit
+import calendar
 import datetime
 import functools
-import glob
+import gzip
+import hashlib
 import json
 import logging
 import multiprocessing
 import os
 import re
 import signal
+import threading
 import time
 import uuid
+import zlib
 
 from pkg_resources import Requirement, resource_filename
 
 import clize
 from clize import Parameter
-from flask import Flask, render_template, send_from_directory, request, jsonify # Response
+from flask import Flask, render_template, send_from_directory, request, jsonify, Response
+from flask import json as flask_json
 import gunicorn.app.base
 from gunicorn.six import iteritems
 
+from ambassador.cgroups import envoy_concurrency, manifest_concurrency
 from ambassador.config import Config
+from ambassador.generations import GenerationManifest
+from ambassador.hot_restart import restarter_status
+from ambassador.metrics import Registry
+from ambassador.route_matcher import RouteMatcher
 from ambassador.VERSION import Version
 from ambassador.utils import RichStatus, SystemInfo, PeriodicTrigger
 
 from .envoy import EnvoyStats
+from .shared import SharedEnvoyStats
+from .prometheus import render_envoy_stats
 
 def number_of_workers():
     return (multiprocessing.cpu_count() * 2) + 1
@@ -72,6 +85,9 @@ envoy_targets = {
     'cluster': 'https://envoyproxy.github.io/envoy/configuration/cluster_manager/cluster.html',
 }
 
+# JSON overviews with more routes and sources than this get streamed.
+STREAM_THRESHOLD = 1000
+
 ######## DECORATORS
 
 def standard_handler(f):
@@ -98,7 +114,7 @@ def standard_handler(f):
 
             status_to_log = result[1]
 
-            if (status_to_log // 100) == 2:
+            if (status_to_log // 100) in (2, 3):
                 result_log_level = logging.DEBUG
                 result_to_log = "success"
             else:
@@ -125,26 +141,288 @@ def standard_handler(f):
 app = Flask(__name__,
             template_folder=resource_filename(Requirement.parse("ambassador"), "templates"))
 
-# Next, various helpers.
-def aconf(app):
-    configs = glob.glob("%s-*" % app.config_dir_prefix)
+class ConfigCache (object):
+    """
+    Building a Config means parsing, validating, and processing every input,
+    so don't do it on every request: build one per configuration generation,
+    and share it across all the request threads.
+
+    The cache is keyed on the latest generation's config directory and its
+    modification time. kubewatch records its generations in a manifest, so
+    we only need to reread that when it changes. If there's no manifest,
+    we're probably running without kubewatch -- just use the base config
+    directory.
+    """
 
-    # # Test crap
-    # configs.append("%s-87-envoy.json" % app.config_dir_prefix)
+    def __init__(self, config_dir_prefix):
+        self.manifest = GenerationManifest(config_dir_prefix)
+        self.manifest_stat = None
+        self.lock = threading.Lock()
+        self.key = None
+        self.config = None
+        self.builds = 0
 
-    if configs:
-        keyfunc = lambda x: x.split("-")[-1]
-        key_match = lambda x: re.match('^\d+$', keyfunc(x))
-        key_as_int = lambda x: int(keyfunc(x))
+        self.overview_lock = threading.Lock()
+        self.overview_snapshot = None
 
-        configs = sorted(filter(key_match, configs), key=key_as_int)
+        self.matcher_lock = threading.Lock()
+        self.matcher_key = None
+        self.matcher = None
 
-        latest = configs[-1]
-    else:
-        latest = app.config_dir_prefix
+    def latest_config_dir(self):
+        try:
+            st = os.stat(self.manifest.path)
+            manifest_stat = (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            manifest_stat = None
+
+        if (manifest_stat is None) or (manifest_stat != self.manifest_stat):
+            self.manifest.load()
+            self.manifest_stat = manifest_stat
+
+        return self.manifest.latest_config_dir()
+
+    def current_key(self, config_dir):
+        # Inputs written in place don't change the directory's mtime, so
+        # check them too.
+        try:
+            mtime = os.stat(config_dir).st_mtime_ns
+
+            for entry in os.scandir(config_dir):
+                mtime = max(mtime, entry.stat().st_mtime_ns)
+        except FileNotFoundError:
+            mtime = None
+
+        return (config_dir, mtime)
+
+    def get(self):
+        """
+        Return (key, config) for the latest generation.
+        """
+
+        with self.lock:
+            config_dir = self.latest_config_dir()
+            key = self.current_key(config_dir)
+
+            if key != self.key:
+                app.logger.info("loading configuration from %s" % config_dir)
+
+                self.config = Config(config_dir)
+                self.key = key
+                self.builds += 1
+
+            return self.key, self.config
+
+    def overview(self):
+        """
+        Return the OverviewSnapshot for the latest generation.
+        """
+
+        key, config = self.get()
+
+        with self.overview_lock:
+            if not self.overview_snapshot or (self.overview_snapshot.key != key):
+                self.overview_snapshot = OverviewSnapshot(key, config)
+
+            return self.overview_snapshot
+
+    def route_matcher(self):
+        """
+        Return a RouteMatcher for the latest generation's routes.
+        """
+
+        key, config = self.get()
+
+        with self.matcher_lock:
+            if self.matcher_key != key:
+                self.matcher = RouteMatcher(config.envoy_config['routes'])
+                self.matcher_key = key
+
+            return self.matcher
+
+def json_members(obj):
+    """
+    Serialize a dict to JSON, minus the surrounding braces, so that several
+    can be spliced together into one object.
+    """
+
+    return flask_json.dumps(obj, sort_keys=True).strip()[1:-1].strip().encode('utf-8')
+
+class OverviewSnapshot (object):
+    """
+    The parts of the diagnostic overview that depend only on the
+    configuration, computed once per generation. Routes and sources are
+    serialized one by one, so that a filtered page of them can be spliced
+    together with the live parts of the overview without reserializing
+    anything. Clusters get live health merged into them, so they're
+    always serialized per request.
+    """
+
+    def __init__(self, key, config):
+        self.key = key
+        self.overview = config.diagnostic_overview()
+        self.errors = []
+        self.error_keys = set()
+
+        for source in self.overview['sources']:
+            for obj in source['objects'].values():
+                obj['target'] = ambassador_targets.get(obj['kind'].lower(), None)
+
+                if obj['errors']:
+                    self.error_keys.add(obj['key'])
+                    self.errors.extend([ (obj['key'], error['summary'])
+                                         for error in obj['errors'] ])
+
+        self.routes = [ (route, flask_json.dumps(route, sort_keys=True).encode('utf-8'))
+                        for route in self.overview['routes'] ]
+        self.sources = [ (source, flask_json.dumps(source, sort_keys=True).encode('utf-8'))
+                         for source in self.overview['sources'] ]
+        self.clusters = { cluster['name']: cluster for cluster in self.overview['clusters'] }
+
+        static = { key: value for key, value in self.overview.items()
+                   if key not in [ 'routes', 'sources', 'clusters' ] }
+        static['errors'] = self.errors
+
+        self.static_json = json_members(static)
+        self.tag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        self.last_modified = (key[1] / 1e9) if key[1] else time.time()
+
+    def stream(self, routes, sources, live, chunk_size=500):
+        """
+        Yield the JSON overview in pieces, given (object, json) pairs for the
+        routes and sources to include, and a dict of the live members.
+        """
+
+        yield b"{" + self.static_json
+
+        for name, items in [ ("routes", routes), ("sources", sources) ]:
+            yield (', "%s": [' % name).encode('utf-8')
+
+            for i in range(0, len(items), chunk_size):
+                yield (b", " if i else b"") + b", ".join(data for obj, data in items[i:i + chunk_size])
+
+            yield b"]"
+
+        yield b", " + json_members(live) + b"}"
+
+class OverviewFilter (object):
+    """
+    Filters and pages the overview, per the request's query parameters:
+
+    prefix:  routes whose prefix (or regex) starts with this
+    host:    routes for this host ("*" for routes that match any host)
+    cluster: routes using, and clusters named, this cluster (or service)
+    source:  objects from this source file or source object
+    errors:  only objects whose sources have errors
+    offset, limit: a page of each of the routes, clusters, and sources
+
+    When filtering by prefix, host, or cluster, the clusters and sources
+    are those of the matching routes.
+    """
+
+    def __init__(self, args):
+        self.prefix = args.get('prefix', None)
+        self.host = args.get('host', None)
+        self.cluster = args.get('cluster', None)
+        self.source = args.get('source', None)
+        self.errors = args.get('errors', 'false').lower() in [ 'true', '1', 'yes' ]
+
+        # These raise ValueError if they're bogus.
+        self.offset = int(args.get('offset', 0))
+        self.limit = int(args['limit']) if 'limit' in args else None
+
+        if (self.offset < 0) or ((self.limit is not None) and (self.limit < 0)):
+            raise ValueError("offset and limit must not be negative")
+
+    def page(self, items):
+        end = (self.offset + self.limit) if (self.limit is not None) else None
+        return items[self.offset:end]
+
+    def by_route(self):
+        return bool(self.prefix or self.host or self.cluster)
+
+    def source_matches(self, keys):
+        for key in keys:
+            if (key == self.source) or (key.rsplit('.', 1)[0] == self.source):
+                return True
+
+        return False
+
+    def route_matches(self, route, snapshot):
+        keys = [ route['_source'] ] + route.get('_referenced_by', [])
+
+        if self.prefix:
+            prefix = route['prefix'] if 'prefix' in route else route['regex']
+
+            if not prefix.startswith(self.prefix):
+                return False
+
+        if self.host:
+            host = '*'
+
+            for header in route.get('headers', []):
+                if header.get('name', None) == ':authority':
+                    host = header.get('value', None)
+
+            if host != self.host:
+                return False
+
+        if self.cluster:
+            names = [ cluster['name'] for cluster in route['clusters'] ]
+
+            if not [ name for name in names if self.cluster_matches(snapshot.clusters.get(name, { 'name': name })) ]:
+                return False
+
+        if self.source and not self.source_matches(keys):
+            return False
+
+        if self.errors and not snapshot.error_keys.intersection(keys):
+            return False
+
+        return True
+
+    def cluster_matches(self, cluster):
+        return self.cluster in [ cluster['name'], cluster.get('_service', None) ]
+
+    def filter(self, snapshot):
+        """
+        Return (routes, clusters, sources) that match, unpaged.
+        """
+
+        routes = [ item for item in snapshot.routes if self.route_matches(item[0], snapshot) ]
+        clusters = snapshot.overview['clusters']
+        sources = snapshot.sources
+
+        if self.by_route():
+            names = set(cluster['name'] for route, data in routes for cluster in route['clusters'])
+            keys = set(key for route, data in routes for key in [ route['_source'] ] + route.get('_referenced_by', []))
+
+            clusters = [ cluster for cluster in clusters if cluster['name'] in names ]
+            sources = [ item for item in sources if keys.intersection(item[0]['objects'].keys()) ]
+
+        if self.cluster:
+            clusters = [ cluster for cluster in clusters if self.cluster_matches(cluster) ]
+
+        if self.source:
+            clusters = [ cluster for cluster in clusters
+                         if self.source_matches([ cluster.get('_source', '') ] + cluster.get('_referenced_by', [])) ]
+            sources = [ item for item in sources if self.source_matches([ item[0]['filename'] ]) ]
+
+        if self.errors:
+            clusters = [ cluster for cluster in clusters
+                         if snapshot.error_keys.intersection([ cluster.get('_source', '') ] + cluster.get('_referenced_by', [])) ]
+            sources = [ item for item in sources if item[0]['error_count'] ]
+
+        return routes, clusters, sources
+
+# Next, various helpers.
+def aconf(app):
+    key, aconf = app.config_cache.get()
+    scout_report(app)
 
-    aconf = Config(latest)
+    return aconf
 
+def scout_report(app):
     uptime = datetime.datetime.now() - boot_time
     hr_uptime = td_format(uptime)
 
@@ -154,8 +432,6 @@ def aconf(app):
 
     app.logger.info("Scout reports %s" % json.dumps(result))
 
-    return aconf
-
 def td_format(td_object):
     seconds = int(td_object.total_seconds())
     periods = [
@@ -189,11 +465,16 @@ def interval_format(seconds, normal_format, now_message):
         return now_message
 
 def system_info():
+    # This is the same decision start-envoy.sh makes, from the same inputs.
+    concurrency, concurrency_source = envoy_concurrency(module_value=manifest_concurrency(app.config_dir_prefix))
+
     return {
         "version": __version__,
         "hostname": SystemInfo.MyHostName,
         "boot_time": boot_time,
-        "hr_uptime": td_format(datetime.datetime.now() - boot_time)
+        "hr_uptime": td_format(datetime.datetime.now() - boot_time),
+        "envoy_concurrency": concurrency,
+        "envoy_concurrency_source": concurrency_source
     }
 
 def cluster_stats(clusters):
@@ -232,6 +513,7 @@ def route_cluster_info(route, route_clusters, cluster, cluster_info, type_label)
         'weight': c_weight,
         '_health': c_health,
         '_hcolor': c_color,
+        '_latency': c_info.get('_latency', None),
         'service': c_service,
     }
 
@@ -243,7 +525,9 @@ def route_and_cluster_info(request, overview, clusters, cstats):
     request_scheme = request.headers.get('X-Forwarded-Proto', 'http').lower()
     tls_active = request_scheme == 'https'
 
-    cluster_info = { cluster['name']: cluster for cluster in clusters }
+    # The clusters are shared by every request for this generation, so merge
+    # the live health into copies.
+    cluster_info = { cluster['name']: dict(cluster) for cluster in clusters }
 
     for cluster_name, cstat in cstats.items():
         c_info = cluster_info.setdefault(cluster_name, {
@@ -253,6 +537,7 @@ def route_and_cluster_info(request, overview, clusters, cstats):
         c_info['_health'] = cstat['health']
         c_info['_hmetric'] = cstat['hmetric']
         c_info['_hcolor'] = cstat['hcolor']
+        c_info['_latency'] = cstat.get('latency', None)
 
     route_info = []
 
@@ -307,6 +592,12 @@ def route_and_cluster_info(request, overview, clusters, cstats):
                 else:
                     headers.append(header)
 
+            # If the route has a virtual cluster, it has its own stats,
+            # separate from those of the clusters it shares with other
+            # routes.
+            vcluster = route.get('_virtual_cluster', None)
+            mapping_stats = app.estats.virtual_cluster_stats(vcluster) if vcluster else None
+
             sep = "" if prefix.startswith("/") else "/"
 
             route_key = "%s://%s%s%s" % (request_scheme, host if host else request_host, sep, prefix)
@@ -321,6 +612,7 @@ def route_and_cluster_info(request, overview, clusters, cstats):
                 'method': method,
                 'headers': headers,
                 'clusters': route_clusters,
+                'mapping_stats': mapping_stats,
                 'host': host if host else '*'
             })
 
@@ -344,9 +636,58 @@ def envoy_status(estats):
         "alive": estats.is_alive(),
         "ready": estats.is_ready(),
         "uptime": since_boot,
-        "since_update": since_update
+        "since_update": since_update,
+        "downstream_latency": estats.stats.get('downstream_latency', {})
     }
 
+def rendered_health(estatus, cstats, route_info, loginfo):
+    """
+    The live values an overview shows, for its ETag: whether Envoy is up,
+    latencies, cluster health, per-Mapping stats (as rounded as we show
+    them), and log levels.
+    """
+
+    clusters = [ (name, cstat.get('hmetric', None), cstat.get('hcolor', None), cstat.get('latency', None))
+                 for name, cstat in sorted(cstats.items()) ]
+
+    mappings = []
+
+    for info in route_info:
+        stats = info.get('mapping_stats', None)
+
+        if stats:
+            recent = stats.get('rates', {}).get('5m', None)
+
+            if recent:
+                shown = ("%.2f" % recent['request_rate'], "%.2f" % recent['error_rate'])
+            else:
+                shown = (stats['upstream_total'], stats['upstream_5xx'])
+
+            mappings.append((info['key'], shown, stats.get('latency', None)))
+
+    return [ estatus['alive'], estatus['ready'], sorted(estatus['downstream_latency'].items()),
+             clusters, mappings, sorted((loginfo or {}).items()) ]
+
+def restart_history():
+    """
+    Recent Envoy epochs from the hot restarter, newest first, with times made
+    human-readable.
+    """
+
+    status = restarter_status(timeout=0.5)
+
+    if not status:
+        return []
+
+    history = []
+
+    for record in reversed(status.get('history', [])):
+        record = dict(record)
+        record['hr_forked'] = datetime.datetime.fromtimestamp(record['forked']).strftime("%Y-%m-%d %H:%M:%S")
+        history.append(record)
+
+    return history
+
 def clean_notices(notices):
     cleaned = []
 
@@ -366,34 +707,97 @@ def clean_notices(notices):
 
     return cleaned
 
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    since = request.if_modified_since
+
+    return bool(since) and (int(last_modified) <= calendar.timegm(since.utctimetuple()))
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(5, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+def cacheable_response(body, mimetype, etag, last_modified, status=200):
+    """
+    Build a (response, status) tuple for standard_handler, with validators
+    so that clients can poll with conditional requests, and gzipped if the
+    client accepts it. The body can be bytes, or an iterable of bytes to
+    stream.
+    """
+
+    streaming = not isinstance(body, bytes)
+    gzipped = (status == 200) and (streaming or (len(body) >= 1024)) and request.accept_encodings['gzip']
+
+    if gzipped:
+        body = gzip_stream(body) if streaming else gzip.compress(body, compresslevel=5)
+
+    response = Response(body, status=status, mimetype=mimetype)
+
+    # The body has live bits in it that don't merit a new ETag on their own
+    # (uptimes and the like), hence a weak ETag.
+    response.set_etag(etag, weak=True)
+    response.last_modified = datetime.datetime.utcfromtimestamp(int(last_modified))
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response, status
+
 @app.route('/ambassador/v0/favicon.ico', methods=[ 'GET' ])
 def favicon():
     template_path = resource_filename(Requirement.parse("ambassador"), "templates")
 
     return send_from_directory(template_path, "favicon.ico")
 
-@app.route('/ambassador/v0/check_alive', methods=[ 'GET' ])
-def check_alive():
-    status = envoy_status(app.estats)
+def alive_status(estats):
+    status = envoy_status(estats)
 
     if status['alive']:
         return "ambassador liveness check OK (%s)" % status['uptime'], 200
     else:
         return "ambassador seems to have died (%s)" % status['uptime'], 503
 
-@app.route('/ambassador/v0/check_ready', methods=[ 'GET' ])
-def check_ready():
-    status = envoy_status(app.estats)
+def ready_status(estats):
+    status = envoy_status(estats)
 
     if status['ready']:
         return "ambassador readiness check OK (%s)" % status['since_update'], 200
     else:
         return "ambassador not ready (%s)" % status['since_update'], 503
 
+@app.route('/ambassador/v0/check_alive', methods=[ 'GET' ])
+def check_alive():
+    return alive_status(app.estats)
+
+@app.route('/ambassador/v0/check_ready', methods=[ 'GET' ])
+def check_ready():
+    return ready_status(app.estats)
+
+@app.route('/metrics', methods=[ 'GET' ])
+@standard_handler
+def metrics(reqid=None):
+    # Envoy's stats come from the last poll (the collector's, if there is
+    # one), so a scrape costs Envoy nothing, however often it happens.
+    body = app.metrics.render() + render_envoy_stats(app.estats.stats['flat'])
+
+    return Response(body, content_type="text/plain; version=0.0.4; charset=utf-8"), 200
+
 @app.route('/ambassador/v0/diag/', methods=[ 'GET' ])
 @standard_handler
 def show_overview(reqid=None):
     app.logger.debug("OV %s - showing overview" % reqid)
+    app.estats.demand()
 
     notices = []
     loglevel = request.args.get('loglevel', None)
@@ -406,46 +810,121 @@ def show_overview(reqid=None):
         # else:
         #     return redirect("/ambassador/v0/diag/", code=302)
 
-    ov = aconf(app).diagnostic_overview()
-    clusters = ov['clusters']
-    cstats = cluster_stats(clusters)
+    try:
+        ofilter = OverviewFilter(request.args)
+    except ValueError as e:
+        return "invalid overview query: %s" % e, 400
+
+    snapshot = app.config_cache.overview()
+    scout_report(app)
+
+    ov = snapshot.overview
+    notices.extend(clean_notices(Config.get_scout_notices()))
+    history = restart_history()
+    want_json = bool(request.args.get('json', None))
+
+    # The HTML overview fetches its route table a page at a time, as JSON,
+    # so only the JSON overview has routes, clusters, and sources to filter.
+    routes, clusters, sources = ofilter.filter(snapshot) if want_json else ([], [], [])
+    totals = dict(routes=len(routes), clusters=len(clusters), sources=len(sources))
+
+    routes = ofilter.page(routes)
+    clusters = ofilter.page(clusters)
+    sources = ofilter.page(sources)
+
+    # We need live stats for the clusters we're showing, the clusters their
+    # routes use, and the Ambassador services' clusters.
+    names = [ cluster['name'] for cluster in clusters ]
+    names += [ cluster['name'] for route, data in routes for cluster in route['clusters'] ]
+    names += [ service['cluster'] for service in ov.get('ambassador_services', []) ]
+
+    seen = set()
+    needed = []
+
+    for name in names:
+        if (name in snapshot.clusters) and (name not in seen):
+            seen.add(name)
+            needed.append(snapshot.clusters[name])
+
+    cstats = cluster_stats(needed)
+    route_info, cluster_info = route_and_cluster_info(request, { 'routes': [ route for route, data in routes ] },
+                                                      needed, cstats)
+    estatus = envoy_status(app.estats)
+    loginfo = app.estats.loginfo
+
+    # Everything the response depends on: the generation, the query, the
+    # request bits that route_info depends on, and the live values we show.
+    # (Not when the stats were last updated, though: that changes with
+    # every poll, even when nothing we show does.)
+    validators = [ snapshot.tag, sorted(request.args.items(multi=True)), notices, history[:1],
+                   request.headers.get('Host', '*'), request.headers.get('X-Forwarded-Proto', 'http'),
+                   rendered_health(estatus, cstats, route_info, loginfo) ]
+
+    etag = "ov-%s" % hashlib.sha1(repr(validators).encode('utf-8')).hexdigest()[:16]
+    last_modified = max(snapshot.last_modified, app.estats.stats['last_update'])
+
+    if (not loglevel) and not_modified(etag, last_modified):
+        return cacheable_response(b"", None, etag, last_modified, status=304)
+
+    live = dict(system=system_info(),
+                envoy_status=estatus,
+                restart_history=history,
+                loginfo=loginfo,
+                cluster_stats=cstats,
+                notices=notices)
+
+    if want_json:
+        live.update(route_info=route_info,
+                    clusters=[ cluster_info[cluster['name']] for cluster in clusters ],
+                    pagination=dict(offset=ofilter.offset, limit=ofilter.limit, total=totals))
+
+        body = snapshot.stream(routes, sources, live)
+
+        # Don't bother streaming small responses.
+        if (len(routes) + len(sources)) < STREAM_THRESHOLD:
+            body = b"".join(body)
+
+        return cacheable_response(body, "application/json", etag, last_modified)
+    else:
+        tvars = dict(ov, errors=snapshot.errors, filters=ofilter, **live)
+        html = render_template("overview.html", **tvars)
 
-    route_info, cluster_info = route_and_cluster_info(request, ov, clusters, cstats)
+        return cacheable_response(html.encode('utf-8'), "text/html", etag, last_modified)
 
-    notices.extend(clean_notices(Config.scout_notices))
+@app.route('/ambassador/v0/diag/route', methods=[ 'GET' ])
+@standard_handler
+def route_lookup(reqid=None):
+    """
+    Which route would Envoy use for a request? Takes the request's path,
+    method, host, and any other headers (as header=name:value).
+    """
 
-    errors = []
+    path = request.args.get('path', None)
 
-    for source in ov['sources']:
-        for obj in source['objects'].values():
-            obj['target'] = ambassador_targets.get(obj['kind'].lower(), None)
+    if not path:
+        return "path is required", 400
 
-            if obj['errors']:
-                errors.extend([ (obj['key'], error['summary'])
-                                 for error in obj['errors'] ])
+    method = request.args.get('method', 'GET')
+    host = request.args.get('host', None)
+    headers = {}
 
-    tvars = dict(system=system_info(), 
-                 envoy_status=envoy_status(app.estats), 
-                 loginfo=app.estats.loginfo,
-                 cluster_stats=cstats,
-                 notices=notices,
-                 errors=errors,
-                 route_info=route_info,
-                 **ov)
+    for header in request.args.getlist('header'):
+        if ':' not in header:
+            return "invalid header %s: use name:value" % header, 400
 
-    if request.args.get('json', None):
-        result = jsonify(tvars)
-    else:
-        return render_template("overview.html", **tvars)
+        name, value = header.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
 
-    # app.logger.debug("OV %s from %s --- rendering complete" % (reqid, request.remote_addr))
+    result = app.config_cache.route_matcher().lookup(path, method=method, authority=host, headers=headers)
+    result['request'] = dict(path=path, method=method, host=host, headers=headers)
 
-    return result
+    return jsonify(result)
 
 @app.route('/ambassador/v0/diag/<path:source>', methods=[ 'GET' ])
 @standard_handler
 def show_intermediate(source=None, reqid=None):
     app.logger.debug("SRC %s - getting intermediate for '%s'" % (reqid, source))
+    app.estats.demand()
 
     result = aconf(app).get_intermediate_for(source)
 
@@ -462,6 +941,7 @@ def show_intermediate(source=None, reqid=None):
 
         route_info, cluster_info = route_and_cluster_info(request, result, clusters, cstats)
 
+        result['clusters'] = [ cluster_info[cluster['name']] for cluster in clusters ]
         result['cluster_stats'] = cstats
         result['sources'] = sorted_sources(result['sources'])
         result['source_dict'] = { source_key(source): source 
@@ -480,7 +960,7 @@ def show_intermediate(source=None, reqid=None):
                  method=method, resource=resource,
                  route_info=route_info,
                  errors=errors,
-                 notices=clean_notices(Config.scout_notices),
+                 notices=clean_notices(Config.get_scout_notices()),
                  **result)
 
     if request.args.get('json', None):
@@ -520,8 +1000,9 @@ def source_lookup(name, sources):
 
     return source.get('_source', name)
 
-def create_diag_app(config_dir_path, do_checks=False, debug=False, verbose=False):
-    app.estats = EnvoyStats()
+def create_diag_app(config_dir_path, do_checks=False, debug=False, verbose=False, stats_path=None):
+    # With a stats_path, several diagd processes can share one stats collector.
+    app.estats = SharedEnvoyStats(stats_path) if stats_path else EnvoyStats()
     app.health_checks = False
     app.debugging = debug
 
@@ -539,9 +1020,48 @@ def create_diag_app(config_dir_path, do_checks=False, debug=False, verbose=False
         app.health_checks = True
 
     app.config_dir_prefix = config_dir_path
+    app.config_cache = ConfigCache(config_dir_path)
+    app.metrics = diag_metrics(app)
 
     return app
 
+def diag_metrics(app):
+    """
+    diagd's own metrics, served at /metrics along with Envoy's.
+    """
+
+    registry = Registry()
+
+    def snapshot_count(name):
+        def count():
+            snapshot = app.config_cache.overview_snapshot
+            return len(getattr(snapshot, name)) if snapshot else 0
+
+        return count
+
+    registry.gauge("ambassador_diagd_config_builds", "Configurations built by diagd",
+                   fn=lambda: app.config_cache.builds)
+    registry.gauge("ambassador_diagd_routes", "Routes in the current configuration",
+                   fn=snapshot_count('routes'))
+    registry.gauge("ambassador_diagd_clusters", "Clusters in the current configuration",
+                   fn=snapshot_count('clusters'))
+    registry.gauge("ambassador_diagd_config_errors", "Errors in the current configuration",
+                   fn=snapshot_count('errors'))
+    registry.gauge("ambassador_diagd_envoy_stats_last_update_seconds", "When Envoy's stats were last fetched",
+                   fn=lambda: app.estats.stats['last_update'])
+    registry.gauge("ambassador_diagd_envoy_stats_update_errors", "Failed attempts to fetch Envoy's stats",
+                   fn=lambda: app.estats.stats['update_errors'])
+    registry.gauge("ambassador_diagd_envoy_ready", "Whether Envoy is ready",
+                   fn=lambda: int(app.estats.is_ready()))
+    registry.gauge("ambassador_diagd_envoy_stats_polls", "Polls of Envoy's /stats",
+                   fn=lambda: app.estats.stats['stats_polls'])
+    registry.gauge("ambassador_diagd_envoy_logging_polls", "Polls of Envoy's /logging",
+                   fn=lambda: app.estats.stats['logging_polls'])
+    registry.gauge("ambassador_diagd_envoy_poll_period_seconds", "How often diagd is polling Envoy",
+                   fn=lambda: app.estats.poll_period())
+
+    return registry
+
 class StandaloneApplication(gunicorn.app.base.BaseApplication):
     def __init__(self, app, options=None):
         self.options = options or {}
@@ -557,13 +1077,13 @@ class StandaloneApplication(gunicorn.app.base.BaseApplication):
     def load(self):
         if self.application.health_checks:
             self.application.logger.info("Starting periodic updates")
-            self.application.stats_updater = PeriodicTrigger(self.application.estats.update, period=5)
+            self.application.stats_updater = PeriodicTrigger(self.application.estats.tick, period=1)
 
         return self.application
 
 
 def _main(config_dir_path:Parameter.REQUIRED, *, no_checks=False, no_debugging=False, verbose=False,
-          workers=None, port=8877, host='0.0.0.0'):
+          workers:int=None, port=8877, host='0.0.0.0', server='gunicorn'):
     """
     Run the diagnostic daemon.
 
@@ -571,13 +1091,43 @@ def _main(config_dir_path:Parameter.REQUIRED, *, no_checks=False, no_debugging=F
     :param no_checks: If True, don't do Envoy-cluster health checking
     :param no_debugging: If True, don't run Flask in debug mode
     :param verbose: If True, be more verbose
-    :param workers: Number of workers; default is based on the number of CPUs present
+    :param workers: Number of workers (threads for gunicorn, processes for aiohttp); default is based on the number of CPUs present
     :param host: Interface on which to listen (default 0.0.0.0)
     :param port: Port on which to listen (default 8877)
+    :param server: 'gunicorn' (default), or 'aiohttp' to answer probes from an event loop and everything else from a pool of worker threads
     """
     
+    stats_path = None
+
+    if server == 'aiohttp':
+        # The worker processes read Envoy's stats from a file that this
+        # process keeps up to date.
+        stats_path = "/tmp/ambassador-diagd-%d.stats" % os.getpid()
+        atexit.register(remove_stats_files, stats_path, os.getpid())
+
     # Create the application itself.
-    flask_app = create_diag_app(config_dir_path, not no_checks, not no_debugging, verbose)
+    flask_app = create_diag_app(config_dir_path, not no_checks, not no_debugging, verbose, stats_path=stats_path)
+
+    if server == 'aiohttp':
+        from .aserver import AsyncDiagServer
+
+        if workers == None:
+            workers = max(multiprocessing.cpu_count(), 2)
+
+        # This forks the worker processes, so it has to happen before we
+        # start any threads.
+        diag_server = AsyncDiagServer(flask_app, workers=workers)
+
+        if flask_app.health_checks:
+            flask_app.logger.info("Starting periodic updates")
+            flask_app.stats_updater = PeriodicTrigger(flask_app.estats.tick, period=1)
+
+        app.logger.info("aiohttp with %d worker processes, listening on %s:%s" % (workers, host, port))
+
+        diag_server.run(host, port)
+        return
+    elif server != 'gunicorn':
+        raise Exception("unknown server %s; use gunicorn or aiohttp" % server)
 
     if workers == None:
         workers = number_of_workers()
@@ -592,6 +1142,16 @@ def _main(config_dir_path:Parameter.REQUIRED, *, no_checks=False, no_debugging=F
 
     StandaloneApplication(flask_app, gunicorn_config).run()
 
+def remove_stats_files(stats_path, pid):
+    if os.getpid() != pid:
+        return
+
+    for path in [ stats_path, stats_path + ".lock" ]:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
 def main():
     clize.run(_main)
 
@@ -13,9 +13,36 @@
 # limitations under the License
 
 import logging
+import os
+import re
 import time
 
 import requests
+import requests.adapters
+
+from .history import StatsHistory
+
+# Envoy's admin API.
+ADMIN_URL = os.environ.get('AMBASSADOR_ADMIN_URL', 'http://127.0.0.1:8001')
+
+# The stats that EnvoyStats polls for: what the diagnostics show (clusters,
+# the HTTP connection managers' downstream latency, and virtual clusters --
+# see generate_virtual_clusters() in config.py), plus the listener, server,
+# and TCP proxy stats that /metrics exports along with them. That leaves out
+# the likes of runtime.* and stats.*, which nobody's looking at.
+STAT_PREFIXES = [ 'cluster.', 'cluster_manager.', 'http.', 'listener.', 'listener_manager.', 'server.', 'tcp.',
+                  'vhost.' ]
+
+# EnvoyStats polls Envoy every ACTIVE_PERIOD seconds while anyone has looked
+# at the diagnostics in the last ACTIVE_WINDOW seconds. Otherwise it polls
+# only often enough to keep is_alive() and is_ready() accurate.
+ACTIVE_PERIOD = 5
+ACTIVE_WINDOW = 60
+
+# Log levels only change when someone sets them, and we fetch the new levels
+# then, so while the diagnostics are active we recheck them only this often
+# (in case someone went straight to Envoy, or Envoy restarted).
+LOGINFO_MAX_AGE = 60
 
 def percentage(x, y):
     if y == 0:
@@ -23,21 +50,340 @@ def percentage(x, y):
     else:
         return int(((x * 100) / y) + 0.5)
 
+class EnvoyAdminError (Exception):
+    pass
+
+class RequestsTransport (object):
+    """
+    Talks HTTP to Envoy's admin API over a single keep-alive session, so that
+    polling doesn't pay for a new connection every time.
+    """
+
+    def __init__(self, base_url=ADMIN_URL, timeout=(1, 5), pool_size=4):
+        self.base_url = base_url
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def request(self, method, path, params=None):
+        """
+        Returns (status_code, text). Raises OSError if Envoy can't be reached.
+        """
+
+        r = self.session.request(method, self.base_url + path, params=params, timeout=self.timeout)
+
+        return r.status_code, r.text
+
+class EnvoyAdminClient (object):
+    """
+    The bits of Envoy's admin API that diagd uses. The transport is anything
+    with RequestsTransport's request() method, so that this can be pointed at
+    a fake admin server.
+    """
+
+    def __init__(self, transport=None):
+        self.transport = transport or RequestsTransport()
+
+    def stats(self, prefixes=None):
+        """
+        Returns the text of /stats, asking Envoy for just the stats whose
+        names start with any of prefixes (if given). Older Envoys ignore
+        /stats?filter=, so callers still have to filter -- see parse_stats().
+        """
+
+        params = None
+
+        if prefixes:
+            params = { 'filter': "^(%s)" % "|".join(re.escape(prefix) for prefix in prefixes) }
+
+        status, text = self.transport.request('GET', '/stats', params=params)
+
+        if status != 200:
+            raise EnvoyAdminError("/stats returned %d: %s" % (status, text))
+
+        return text
+
+    def logging(self, level=None):
+        """
+        Sets the log level for everything, if level is given, and returns the
+        text of Envoy's list of log levels.
+        """
+
+        status, text = self.transport.request('POST', '/logging', params={ 'level': level } if level else None)
+
+        # OMFG. Querying log levels returns with a 404 code.
+        if (status != 200) and (status != 404):
+            raise EnvoyAdminError("/logging returned %d: %s" % (status, text))
+
+        return text
+
+# The per-cluster stats that cluster_health() needs.
+CLUSTER_STATS = [ 'membership_healthy', 'membership_total', 'update_attempt', 'update_success',
+                  'upstream_rq_pending_total', 'upstream_rq_4xx', 'upstream_rq_5xx' ]
+
+# A counter or gauge. Histograms (and anything else that isn't a plain
+# integer) just don't match.
+STAT_LINE = r'^(%s[^:\n]*): (\d+)$'
+
+CLUSTER_LINE = re.compile(r'^cluster\.([^.:\n]+)\.(%s): (\d+)$' % "|".join(CLUSTER_STATS), re.MULTILINE)
+
+def stat_line_re(prefixes=None):
+    prefix = "(?:%s)" % "|".join(re.escape(prefix) for prefix in prefixes) if prefixes else ""
+
+    return re.compile(STAT_LINE % prefix, re.MULTILINE)
+
+def parse_stats(text, prefixes=None):
+    """
+    Parse the text of /stats into a flat dict of stat name => integer value,
+    for the stats starting with any of prefixes (or all of them).
+    """
+
+    return { name: int(value) for name, value in stat_line_re(prefixes).findall(text) }
+
+def parse_cluster_stats(text):
+    """
+    Pull just the CLUSTER_STATS out of the text of /stats, in a single pass.
+    Returns a dict of cluster name => { stat: value }.
+    """
+
+    clusters = {}
+
+    for cluster_name, stat, value in CLUSTER_LINE.findall(text):
+        clusters.setdefault(cluster_name, {})[stat] = int(value)
+
+    return clusters
+
+# Histogram summaries look like
+#
+# cluster.cluster_qotm.upstream_rq_time: P0(nan,1) P25(nan,2.05) ... P100(nan,51)
+#
+# where each quantile has the value over the last flush interval, then the
+# value over Envoy's whole life. Either may be nan.
+UPSTREAM_LATENCY_LINE = re.compile(r'^cluster\.([^.:\n]+)\.upstream_rq_time: (P[^\n]*)$', re.MULTILINE)
+DOWNSTREAM_LATENCY_LINE = re.compile(r'^http\.([^.:\n]+)\.downstream_rq_time: (P[^\n]*)$', re.MULTILINE)
+QUANTILE = re.compile(r'P([\d.]+)\(([^,]+),([^)]+)\)')
+
+LATENCY_QUANTILES = [ ('p50', '50'), ('p90', '90'), ('p95', '95'), ('p99', '99') ]
+
+def parse_latency(summary):
+    """
+    Parse a histogram summary into { 'p50': ms, ... } over Envoy's life,
+    plus the same over the last flush interval as 'recent', if Envoy had
+    any values then. Returns None if there are no values at all.
+    """
+
+    interval = {}
+    cumulative = {}
+
+    for quantile, recent, total in QUANTILE.findall(summary):
+        interval[quantile] = recent
+        cumulative[quantile] = total
+
+    def quantiles(values):
+        result = {}
+
+        for name, quantile in LATENCY_QUANTILES:
+            try:
+                value = float(values[quantile])
+            except (KeyError, ValueError):
+                return None
+
+            if value != value:
+                # nan
+                return None
+
+            result[name] = value
+
+        return result
+
+    latency = quantiles(cumulative)
+
+    if latency:
+        latency['recent'] = quantiles(interval)
+
+    return latency
+
+def parse_latencies(text):
+    """
+    Returns (upstream, downstream): the latency of each cluster's requests,
+    by cluster name, and of each HTTP connection manager's, by stat prefix.
+    """
+
+    results = []
+
+    for regex in [ UPSTREAM_LATENCY_LINE, DOWNSTREAM_LATENCY_LINE ]:
+        latencies = {}
+
+        for name, summary in regex.findall(text):
+            latency = parse_latency(summary)
+
+            if latency:
+                latencies[name] = latency
+
+        results.append(latencies)
+
+    return tuple(results)
+
+# Virtual clusters' stats look like
+#
+# vhost.backend.vcluster.qotm_mapping.upstream_rq_2xx: 12
+#
+# There's no total, so we add up the response classes. Envoy puts any request
+# that doesn't match a virtual cluster in one called "other", which tells us
+# nothing about any Mapping.
+VCLUSTER_LINE = re.compile(r'^vhost\.[^.:\n]+\.vcluster\.([^.:\n]+)\.upstream_rq_(\d)xx: (\d+)$', re.MULTILINE)
+VCLUSTER_LATENCY_LINE = re.compile(r'^vhost\.[^.:\n]+\.vcluster\.([^.:\n]+)\.upstream_rq_time: (P[^\n]*)$',
+                                   re.MULTILINE)
+
+def parse_virtual_cluster_stats(text):
+    """
+    Returns a dict of virtual cluster name => { 'upstream_total': requests,
+    'upstream_4xx': 4xx responses, 'upstream_5xx': 5xx responses, 'latency':
+    parse_latency() or None }.
+    """
+
+    vclusters = {}
+
+    for name, code_class, value in VCLUSTER_LINE.findall(text):
+        if name == 'other':
+            continue
+
+        vcluster = vclusters.setdefault(name, { 'upstream_total': 0, 'upstream_4xx': 0, 'upstream_5xx': 0,
+                                                'latency': None })
+        vcluster['upstream_total'] += int(value)
+
+        if code_class in [ '4', '5' ]:
+            vcluster['upstream_%sxx' % code_class] += int(value)
+
+    for name, summary in VCLUSTER_LATENCY_LINE.findall(text):
+        if name in vclusters:
+            vclusters[name]['latency'] = parse_latency(summary)
+
+    return vclusters
+
+def stats_tree(flat):
+    """
+    The stats as a hierarchy, keyed by each dotted element of their names.
+    """
+
+    tree = {}
+
+    for name, value in flat.items():
+        keypath = name.split('.')
+        node = tree
+
+        for element in keypath[:-1]:
+            node = node.setdefault(element, {})
+
+        node[keypath[-1]] = value
+
+    return tree
+
+def cluster_health(cluster):
+    """
+    Summarize a cluster's CLUSTER_STATS for cluster_stats().
+    """
+
+    healthy_members = cluster.get('membership_healthy', 0)
+    total_members = cluster.get('membership_total', 0)
+
+    update_attempts = cluster.get('update_attempt', 0)
+    update_successes = cluster.get('update_success', 0)
+    update_percent = percentage(update_successes, update_attempts)
+
+    # Weird.
+    # upstream_ok = cluster.get('upstream_rq_2xx', 0)
+    upstream_total = cluster.get('upstream_rq_pending_total', 0)
+
+    upstream_4xx = cluster.get('upstream_rq_4xx', 0)
+    upstream_5xx = cluster.get('upstream_rq_5xx', 0)
+    upstream_bad = upstream_5xx # used to include 4XX here, but that seems wrong.
+
+    upstream_ok = upstream_total - upstream_bad
+
+    if upstream_total > 0:
+        healthy_percent = percentage(upstream_ok, upstream_total)
+    else:
+        healthy_percent = None
+
+    return {
+        'healthy_members': healthy_members,
+        'total_members': total_members,
+        'healthy_percent': healthy_percent,
+
+        'update_attempts': update_attempts,
+        'update_successes': update_successes,
+        'update_percent': update_percent,
+
+        'upstream_total': upstream_total,
+        'upstream_ok': upstream_ok,
+        'upstream_4xx': upstream_4xx,
+        'upstream_5xx': upstream_5xx,
+        'upstream_bad': upstream_bad
+    }
+
+class StatsDict (dict):
+    """
+    EnvoyStats.stats. Envoy can have hundreds of thousands of stats, and
+    diagd usually only needs a few per cluster, so we keep the text of /stats
+    and parse the rest only when asked: "flat" is every stat by name, and
+    "envoy" is the same stats as a hierarchy.
+    """
+
+    def __init__(self, values, text="", prefixes=None):
+        super().__init__(values)
+        self.text = text
+        self.prefixes = prefixes
+
+    def __missing__(self, key):
+        if key == 'flat':
+            value = parse_stats(self.text, self.prefixes)
+        elif key == 'envoy':
+            value = stats_tree(self['flat'])
+        else:
+            raise KeyError(key)
+
+        self[key] = value
+        return value
+
 class EnvoyStats (object):
-    def __init__(self, max_live_age=20, max_ready_age=20):
+    """
+    Envoy's stats, as of the last time we polled. Call tick() every second
+    or so to keep them up to date, and demand() whenever someone looks at
+    them.
+    """
+
+    def __init__(self, max_live_age=20, max_ready_age=20, admin=None, stat_prefixes=STAT_PREFIXES,
+                 active_period=ACTIVE_PERIOD, idle_period=None):
         self.update_errors = 0
         self.max_live_age = max_live_age
         self.max_ready_age = max_ready_age
         self.loginfo = None
-
-        self.stats = {
+        self.loginfo_updated = 0
+        self.admin = admin or EnvoyAdminClient()
+        self.stat_prefixes = stat_prefixes
+        self.history = StatsHistory()
+        self.vcluster_history = StatsHistory()
+
+        # When idle, poll twice as often as is_alive() and is_ready() need,
+        # so that one failed poll doesn't make Envoy look dead.
+        self.active_period = active_period
+        self.idle_period = idle_period or (min(max_live_age, max_ready_age) / 2)
+        self.last_poll = None
+        self.demanded = None
+
+        self.stats = StatsDict({
             "created": time.time(),
             "last_update": 0,
             "last_attempt": 0,
             "update_errors": 0,
+            "stats_polls": 0,
+            "logging_polls": 0,
             "services": {},
-            "envoy": {}
-        }
+            "downstream_latency": {},
+            "virtual_clusters": {}
+        })
 
     def is_alive(self):
         """
@@ -118,6 +464,22 @@ class EnvoyStats (object):
 
         pct = cstat.get('healthy_percent', None)
 
+        # Prefer how the cluster has been doing lately, if it's had any
+        # requests lately.
+        history = self.history.get(name)
+
+        if history:
+            rates = history.rates()
+            cstat.update({
+                'rates': rates,
+                'sparkline': history.sparkline()
+            })
+
+            recent = rates['5m']
+
+            if recent and (recent['success_percent'] != None):
+                pct = recent['success_percent']
+
         if pct != None:
             color = 'green'
 
@@ -140,28 +502,51 @@ class EnvoyStats (object):
 
         return cstat
 
-    def update_log_levels(self, last_attempt, level=None):
-        try:
-            url = "http://127.0.0.1:8001/logging"
+    def virtual_cluster_stats(self, name):
+        """
+        Requests, errors, and latency for the Mapping whose virtual cluster is
+        name, with rates like cluster_stats() has, or None if Envoy hasn't
+        told us about it (yet).
+        """
+
+        vcstat = self.stats.get('virtual_clusters', {}).get(name, None)
+
+        if vcstat is None:
+            return None
+
+        vcstat = dict(vcstat, name=name)
+        history = self.vcluster_history.get(name)
+
+        if history:
+            vcstat['rates'] = history.rates()
+
+        return vcstat
+
+    def count(self, key):
+        """ Bump one of the counters in stats (update_errors and the like). """
+        self.stats[key] += 1
+
+    def loginfo_stale(self, now):
+        """
+        Is it time to fetch the log levels again? Always, if we don't have
+        them; otherwise every LOGINFO_MAX_AGE seconds, while anyone's looking.
+        """
+
+        return (self.loginfo is None) or (self.active(now) and ((now - self.loginfo_updated) >= LOGINFO_MAX_AGE))
 
-            if level:
-                url += "?level=%s" % level
+    def update_log_levels(self, last_attempt, level=None):
+        self.count('logging_polls')
 
-            r = requests.post(url)
-        except OSError as e:
+        try:
+            text = self.admin.logging(level)
+        except (OSError, EnvoyAdminError) as e:
             logging.warning("EnvoyStats.update_log_levels failed: %s" % e)
-            self.stats['update_errors'] += 1
+            self.count('update_errors')
             return False
 
-        # OMFG. Querying log levels returns with a 404 code.
-        if (r.status_code != 200) and (r.status_code != 404):
-            logging.warning("EnvoyStats.update_log_levels failed: %s" % r.text)
-            self.stats['update_errors'] += 1
-            return False   
-
         levels = {}
 
-        for line in r.text.split("\n"):
+        for line in text.split("\n"):
             if not line:
                 continue
 
@@ -179,131 +564,103 @@ class EnvoyStats (object):
             self.loginfo = { x: levels[x] for x in sorted(levels.keys()) }
 
         # logging.info("loginfo: %s" % self.loginfo)
+        self.loginfo_updated = time.monotonic()
         return True
         
     def update_envoy_stats(self, last_attempt):
+        self.count('stats_polls')
+
         try:
-            r = requests.get("http://127.0.0.1:8001/stats")
-        except OSError as e:
+            text = self.admin.stats(self.stat_prefixes)
+        except (OSError, EnvoyAdminError) as e:
             logging.warning("EnvoyStats.update failed: %s" % e)
-            self.stats['update_errors'] += 1
+            self.count('update_errors')
             return
 
-        if r.status_code != 200:
-            logging.warning("EnvoyStats.update failed: %s" % r.text)
-            self.stats['update_errors'] += 1
-            return
-
-        # Parse stats into a hierarchy.
-
-        envoy_stats = {}
+        active_clusters = { cluster_name: cluster_health(cluster)
+                            for cluster_name, cluster in parse_cluster_stats(text).items() }
 
-        for line in r.text.split("\n"):
-            if not line:
-                continue
+        self.history.record(active_clusters)
 
-            # logging.info('line: %s' % line)
-            key, value = line.split(":")
-            keypath = key.split('.')
+        upstream_latency, downstream_latency = parse_latencies(text)
 
-            node = envoy_stats
+        for cluster_name, latency in upstream_latency.items():
+            if cluster_name in active_clusters:
+                active_clusters[cluster_name]['latency'] = latency
 
-            for key in keypath[:-1]:
-                if key not in node:
-                    node[key] = {}
+        virtual_clusters = parse_virtual_cluster_stats(text)
+        self.vcluster_history.record(virtual_clusters)
 
-                node = node[key]
-
-            value = value.strip()
-
-            # Skip histograms for the moment.
-            # if value.startswith("P0("):
-            #     continue
-            #     # for field in value.split(' '):
-            #     #     if field.startswith('P95('):
-            #     #         value = field.split(',')
-
-            try:
-                node[keypath[-1]] = int(value)
-            except:
-                continue
-
-        # Now dig into clusters a bit more.
-
-        active_clusters = {}
-
-        if "cluster" in envoy_stats:
-            for cluster_name in envoy_stats['cluster']:
-                cluster = envoy_stats['cluster'][cluster_name]
+        # OK, we're now officially finished with all the hard stuff.
+        last_update = time.time()
 
-                # # Toss any _%d -- that's madness with our Istio code at the moment.
-                # cluster_name = re.sub('_\d+$', '', cluster_name)
+        # Swap in a whole new StatsDict, without the old (now stale) parsed
+        # stats, so that readers never see a mix of old and new.
+        stats = StatsDict({ key: value for key, value in self.stats.items() if key not in [ 'flat', 'envoy' ] },
+                          text=text, prefixes=self.stat_prefixes)
 
-                # mapping_name = active_cluster_map[cluster_name]
-                # active_mappings[mapping_name] = {}
+        stats.update({
+            "last_update": last_update,
+            "last_attempt": last_attempt,
+            "clusters": active_clusters,
+            "downstream_latency": downstream_latency,
+            "virtual_clusters": virtual_clusters
+        })
 
-                # logging.info("cluster %s stats: %s" % (cluster_name, cluster))
+        self.stats = stats
 
-                healthy_members = cluster['membership_healthy']
-                total_members = cluster['membership_total']
-                healthy_percent = percentage(healthy_members, total_members)
+    def all_stats(self):
+        """
+        Fetch every one of Envoy's stats, right now, as a flat dict.
+        """
 
-                update_attempts = cluster['update_attempt']
-                update_successes = cluster['update_success']
-                update_percent = percentage(update_successes, update_attempts)
+        try:
+            return parse_stats(self.admin.stats())
+        except (OSError, EnvoyAdminError) as e:
+            logging.warning("EnvoyStats.all_stats failed: %s" % e)
+            self.count('update_errors')
+            return {}
 
-                # Weird.
-                # upstream_ok = cluster.get('upstream_rq_2xx', 0)
-                upstream_total = cluster.get('upstream_rq_pending_total', 0)
+    def demand(self):
+        """
+        Note that someone is looking at the diagnostics.
+        """
 
-                upstream_4xx = cluster.get('upstream_rq_4xx', 0)
-                upstream_5xx = cluster.get('upstream_rq_5xx', 0)
-                upstream_bad = upstream_5xx # used to include 4XX here, but that seems wrong.
+        self.demanded = time.monotonic()
 
-                upstream_ok = upstream_total - upstream_bad
+    def last_demand(self):
+        return self.demanded
 
-                # logging.info("%s total %s bad %s ok %s" % (cluster_name, upstream_total, upstream_bad, upstream_ok))
+    def active(self, now):
+        demanded = self.last_demand()
 
-                if upstream_total > 0:
-                    healthy_percent = percentage(upstream_ok, upstream_total)
-                    # logging.debug("cluster %s is %d%% healthy" % (cluster_name, healthy_percent))
-                else:
-                    healthy_percent = None
-                    # logging.debug("cluster %s has had no requests" % cluster_name)
+        return (demanded is not None) and ((now - demanded) < ACTIVE_WINDOW)
 
-                # active_mappings[mapping_name] = {
-                active_clusters[cluster_name] = {
-                    'healthy_members': healthy_members,
-                    'total_members': total_members,
-                    'healthy_percent': healthy_percent,
+    def poll_period(self, now=None):
+        now = time.monotonic() if now is None else now
 
-                    'update_attempts': update_attempts,
-                    'update_successes': update_successes,
-                    'update_percent': update_percent,
+        return self.active_period if self.active(now) else self.idle_period
 
-                    'upstream_ok': upstream_ok,
-                    'upstream_4xx': upstream_4xx,
-                    'upstream_5xx': upstream_5xx,
-                    'upstream_bad': upstream_bad
-                }
+    def tick(self):
+        """
+        Poll Envoy, if it's time.
+        """
 
-        # OK, we're now officially finished with all the hard stuff.
-        last_update = time.time()
+        now = time.monotonic()
 
-        self.stats.update({
-            "last_update": last_update,
-            "last_attempt": last_attempt,
-            "clusters": active_clusters,
-            "envoy": envoy_stats
-        })
+        if (self.last_poll is None) or ((now - self.last_poll) >= self.poll_period(now)):
+            self.update()
 
     # def update(self, active_mapping_names):
     def update(self):
         try:
             # Remember when we started.
+            self.last_poll = time.monotonic()
             last_attempt = time.time()
 
-            self.update_log_levels(last_attempt)
+            if self.loginfo_stale(self.last_poll):
+                self.update_log_levels(last_attempt)
+
             self.update_envoy_stats(last_attempt)
         except Exception as e:
             logging.error("could not update Envoy stats: %s" % e)
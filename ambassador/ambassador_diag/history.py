@@ -0,0 +1,185 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import time
+
+from array import array
+
+#############################################################################
+## history.py -- recent request history for Envoy clusters
+##
+## Envoy's counters cover the whole life of the Envoy, so a cluster that
+## started failing five minutes ago can still look 99% healthy. Every time
+## EnvoyStats polls Envoy, we record each cluster's request and 5xx counters
+## in a fixed-size ring buffer, and compute rates over the last 1, 5, and 15
+## minutes from that.
+##
+## Counters go back to zero when Envoy restarts (or when a cluster is
+## removed and added back). We treat any counter that goes down as having
+## been reset, and carry its last value forward, so that what's in the ring
+## only ever goes up.
+
+# Enough for 15 minutes of polls every 5 seconds, with a little slack.
+HISTORY_SIZE = 192
+
+WINDOWS = [ ('1m', 60), ('5m', 300), ('15m', 900) ]
+
+# How far back the sparkline history goes.
+SPARKLINE_SECONDS = 300
+
+
+class ClusterHistory (object):
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.times = array('d', [ 0.0 ] * size)
+        self.requests = array('q', [ 0 ] * size)
+        self.errors = array('q', [ 0 ] * size)
+
+        # Number of samples so far, and where the next one goes.
+        self.count = 0
+        self.next = 0
+
+        # The last raw counter values, and what to add to raw values to
+        # account for resets.
+        self.last_raw = None
+        self.offsets = [ 0, 0 ]
+
+    def add(self, when, requests, errors):
+        raw = [ requests, errors ]
+
+        if self.last_raw:
+            for i in range(2):
+                if raw[i] < self.last_raw[i]:
+                    self.offsets[i] += self.last_raw[i]
+
+        self.last_raw = raw
+
+        self.times[self.next] = when
+        self.requests[self.next] = requests + self.offsets[0]
+        self.errors[self.next] = errors + self.offsets[1]
+
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def index(self, age):
+        """ The ring index of the sample age samples before the latest. """
+        return (self.next - 1 - age) % self.size
+
+    def window(self, seconds):
+        """
+        Rates over (up to) the last seconds seconds, or None if there aren't
+        two samples in that window yet.
+        """
+
+        if self.count < 2:
+            return None
+
+        latest = self.index(0)
+        oldest = None
+
+        for age in range(1, self.count):
+            i = self.index(age)
+
+            if self.times[latest] - self.times[i] > seconds:
+                break
+
+            oldest = i
+
+        if oldest is None:
+            return None
+
+        elapsed = self.times[latest] - self.times[oldest]
+        requests = self.requests[latest] - self.requests[oldest]
+        errors = self.errors[latest] - self.errors[oldest]
+
+        success_percent = None
+
+        if requests > 0:
+            success_percent = int((((requests - errors) * 100) / requests) + 0.5)
+
+        return {
+            'seconds': int(elapsed + 0.5),
+            'requests': requests,
+            'errors': errors,
+            'request_rate': requests / elapsed if elapsed else 0.0,
+            'error_rate': errors / elapsed if elapsed else 0.0,
+            'success_percent': success_percent
+        }
+
+    def sparkline(self, seconds=SPARKLINE_SECONDS, now=None):
+        """
+        [ timestamp, requests/sec, 5xx/sec ] between each pair of samples in
+        the last seconds seconds, oldest first, with wall-clock timestamps.
+        """
+
+        if self.count < 2:
+            return []
+
+        # The samples have monotonic timestamps.
+        offset = (now or time.time()) - time.monotonic()
+        latest = self.times[self.index(0)]
+        points = []
+
+        for age in range(0, self.count - 1):
+            i = self.index(age)
+            previous = self.index(age + 1)
+
+            if latest - self.times[previous] > seconds:
+                break
+
+            elapsed = self.times[i] - self.times[previous]
+
+            if elapsed > 0:
+                points.append([ round(self.times[i] + offset, 3),
+                                round((self.requests[i] - self.requests[previous]) / elapsed, 3),
+                                round((self.errors[i] - self.errors[previous]) / elapsed, 3) ])
+
+        points.reverse()
+        return points
+
+    def rates(self):
+        return { name: self.window(seconds) for name, seconds in WINDOWS }
+
+
+class StatsHistory (object):
+    """
+    A ClusterHistory for each cluster (or virtual cluster) Envoy knows about.
+    """
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.clusters = {}
+
+    def record(self, clusters, when=None):
+        """
+        Record a poll's worth of cluster_health() results, dropping the
+        history of clusters that have gone away.
+        """
+
+        when = time.monotonic() if when is None else when
+
+        for name in list(self.clusters.keys()):
+            if name not in clusters:
+                del(self.clusters[name])
+
+        for name, cluster in clusters.items():
+            history = self.clusters.get(name)
+
+            if not history:
+                history = self.clusters[name] = ClusterHistory(self.size)
+
+            history.add(when, cluster['upstream_total'], cluster['upstream_5xx'])
+
+    def get(self, name):
+        return self.clusters.get(name)
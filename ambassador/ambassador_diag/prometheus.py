@@ -0,0 +1,113 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import re
+
+from ambassador.metrics import format_labels
+
+#############################################################################
+## prometheus.py -- render Envoy's stats in the Prometheus text format
+##
+## Envoy's stat names have things like cluster names embedded in them:
+## cluster.cluster_qotm.upstream_rq_2xx. We pull those out into labels, the
+## same way Envoy's own tag extraction does, so that this becomes
+##
+## envoy_cluster_upstream_rq_xx{envoy_cluster_name="cluster_qotm",envoy_response_code_class="2"}
+##
+## and the same metric covers every cluster. Likewise, each Mapping's
+## virtual cluster (vhost.backend.vcluster.qotm.upstream_rq_2xx) becomes
+##
+## envoy_vhost_vcluster_upstream_rq_xx{envoy_response_code_class="2",envoy_virtual_cluster_name="qotm",envoy_virtual_host_name="backend"}
+##
+## Envoy's plain-text /stats doesn't say which stats are counters and which
+## are gauges, so we go by name: Envoy's gauges are a fairly small, fixed
+## set, and everything else is a counter.
+
+# (label, regex) pairs, applied in order. Each regex has two groups: the
+# first is removed from the name, the second is the label value.
+TAG_EXTRACTORS = [
+    ( 'envoy_response_code', re.compile(r'_rq(_(\d{3}))$') ),
+    ( 'envoy_response_code_class', re.compile(r'_rq_((\d))xx$') ),
+    ( 'envoy_http_user_agent', re.compile(r'^http(?=\.).*?\.user_agent((?:\.)(\w+?))\.') ),
+    ( 'envoy_http_conn_manager_prefix', re.compile(r'^http((?:\.)((?:[^.]+)))\.') ),
+    ( 'envoy_listener_address', re.compile(r'^listener((?:\.)((?:[_.\d]+|[_\[\]a-fA-F\d]+)))\.') ),
+    ( 'envoy_cluster_name', re.compile(r'^cluster((?:\.)([^.]+))\.') ),
+    ( 'envoy_virtual_cluster_name', re.compile(r'^vhost\.[^.]+\.vcluster((?:\.)([^.]+))\.') ),
+    ( 'envoy_virtual_host_name', re.compile(r'^vhost((?:\.)([^.]+))\.') ),
+    ( 'envoy_tcp_prefix', re.compile(r'^tcp((?:\.)([^.]+))\.') ),
+]
+
+GAUGE_NAMES = set([
+    'concurrency', 'days_until_first_cert_expiring', 'hot_restart_epoch', 'live',
+    'max_host_weight', 'membership_healthy', 'membership_total', 'parent_connections',
+    'total_connections', 'uptime', 'version', 'memory_allocated', 'memory_heap_size',
+    'lb_subsets_active', 'watched_directories', 'state'
+])
+
+GAUGE_SUFFIXES = ( '_active', '_open', '_buffered', '_healthy', '_outstanding' )
+
+METRIC_NAME_UNSAFE = re.compile(r'[^a-zA-Z0-9_:]')
+
+
+def extract_tags(name):
+    """
+    Split an Envoy stat name into a Prometheus metric name and a list of
+    (label, value) pairs.
+    """
+
+    tags = []
+
+    for label, regex in TAG_EXTRACTORS:
+        match = regex.search(name)
+
+        if match:
+            tags.append((label, match.group(2)))
+            name = name[:match.start(1)] + name[match.end(1):]
+
+    return "envoy_%s" % METRIC_NAME_UNSAFE.sub('_', name), tags
+
+
+def metric_type(name):
+    last = name.rsplit('.', 1)[-1]
+
+    if (last in GAUGE_NAMES) or last.endswith(GAUGE_SUFFIXES):
+        return 'gauge'
+
+    return 'counter'
+
+
+def render_envoy_stats(stats):
+    """
+    Render a dict of Envoy stat name => integer value as Prometheus text,
+    grouped by metric.
+    """
+
+    metrics = {}
+
+    for name, value in stats.items():
+        metric, tags = extract_tags(name)
+        kind, samples = metrics.setdefault(metric, (metric_type(name), []))
+        samples.append((sorted(tags), value))
+
+    lines = []
+
+    for metric in sorted(metrics.keys()):
+        kind, samples = metrics[metric]
+
+        lines.append("# TYPE %s %s" % (metric, kind))
+
+        for tags, value in sorted(samples):
+            lines.append("%s%s %d" % (metric, format_labels(tags), value))
+
+    return "\n".join(lines) + "\n" if lines else ""
@@ -0,0 +1,365 @@
+# Copyright 2018 Datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+import collections
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import pickle
+import struct
+import time
+
+from .envoy import EnvoyStats, StatsDict
+
+#############################################################################
+## shared.py -- one Envoy stats collector for all of diagd's processes
+##
+## When diagd runs more than one process, we don't want each of them polling
+## Envoy's admin API. Instead, one process -- whichever holds an flock() on
+## the lock file -- polls, and publishes what it gets in a file that every
+## process mmap()s.
+##
+## The file is a 48-byte header followed by a pickled snapshot of the stats.
+## The header has a generation number, which the collector makes odd while
+## it's writing a new snapshot and even again when it's done (a seqlock), so
+## a reader that sees the same even generation before and after reading has
+## a consistent snapshot. Readers only unpickle a snapshot when the
+## generation changes; the rest of the time, checking for a new one is just
+## reading eight bytes.
+##
+## The header also has the last time any process saw demand for the stats
+## (see EnvoyStats.demand()), so that the collector knows how often to poll,
+## and the last time any other process changed Envoy's log levels, so that
+## the collector knows to fetch them again instead of publishing the old ones.
+
+logger = logging.getLogger("ambassador.diagd.shared")
+
+MAGIC = b"AMBSTAT2"
+
+# magic, generation, length of the snapshot; then the demand time and the
+# log level change time
+HEADER = struct.Struct("=8sQQ")
+HEADER_SIZE = 48
+GENERATION_OFFSET = 8
+LENGTH_OFFSET = 16
+DEMAND_OFFSET = 24
+LOGGING_OFFSET = 32
+
+INITIAL_SIZE = 1024 * 1024
+
+
+class SharedSnapshot (object):
+    """
+    A seqlocked blob of bytes in an mmap()ed file. Only one process may
+    write() at a time; any number may read().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.mm = None
+
+    def map(self, size=None):
+        """
+        (Re)map the whole file, growing it to at least size bytes first.
+        Returns False if there's nothing to map yet.
+        """
+
+        if size and (os.fstat(self.fd).st_size < size):
+            os.ftruncate(self.fd, size)
+
+        size = os.fstat(self.fd).st_size
+
+        if size < HEADER_SIZE:
+            return False
+
+        if self.mm:
+            self.mm.close()
+
+        self.mm = mmap.mmap(self.fd, size)
+        return True
+
+    def generation(self):
+        if not self.mm and not self.map():
+            return 0
+
+        magic, generation, length = HEADER.unpack_from(self.mm, 0)
+
+        return generation if magic == MAGIC else 0
+
+    def set_demand(self, when):
+        if self.generation():
+            struct.pack_into("=d", self.mm, DEMAND_OFFSET, when)
+
+    def demand(self):
+        if not self.generation():
+            return None
+
+        return struct.unpack_from("=d", self.mm, DEMAND_OFFSET)[0] or None
+
+    def set_logging_changed(self, when):
+        if self.generation():
+            struct.pack_into("=d", self.mm, LOGGING_OFFSET, when)
+
+    def logging_changed(self):
+        if not self.generation():
+            return 0
+
+        return struct.unpack_from("=d", self.mm, LOGGING_OFFSET)[0]
+
+    def write(self, data):
+        needed = HEADER_SIZE + len(data)
+
+        if (not self.mm) or (len(self.mm) < needed):
+            size = INITIAL_SIZE
+
+            while size < needed:
+                size *= 2
+
+            self.map(size)
+
+        generation = self.generation()
+
+        # Odd while we're writing...
+        generation += 1 if (generation % 2 == 0) else 2
+        HEADER.pack_into(self.mm, 0, MAGIC, generation, 0)
+
+        self.mm[HEADER_SIZE:needed] = data
+
+        # ...and even when we're done.
+        HEADER.pack_into(self.mm, 0, MAGIC, generation + 1, len(data))
+
+        return generation + 1
+
+    def read(self, since=None, loads=pickle.loads, retries=100):
+        """
+        Returns (generation, loads(data)), or (generation, None) if the
+        generation is still since, or there's no snapshot yet. The data is
+        handed to loads without copying it out of the file; if it changes
+        underneath loads, we just try again.
+        """
+
+        for attempt in range(retries):
+            generation = self.generation()
+
+            if (generation == 0) or (generation == since):
+                return generation, None
+
+            if generation % 2:
+                # Mid-write.
+                time.sleep(0.001)
+                continue
+
+            length = struct.unpack_from("=Q", self.mm, LENGTH_OFFSET)[0]
+
+            if len(self.mm) < HEADER_SIZE + length:
+                # The file has grown since we mapped it.
+                self.map()
+                continue
+
+            view = memoryview(self.mm)[HEADER_SIZE:HEADER_SIZE + length]
+
+            try:
+                value = loads(view)
+            except Exception:
+                value = None
+            finally:
+                view.release()
+
+            if self.generation() == generation:
+                return generation, value
+
+        raise Exception("could not read a consistent snapshot from %s" % self.path)
+
+
+class SharedEnvoyStats (EnvoyStats):
+    """
+    EnvoyStats shared between processes through a SharedSnapshot at path.
+    update() only polls Envoy in the process that is the collector; every
+    other process sees the collector's stats.
+
+    If elect is True, update() tries to become the collector by taking an
+    flock() on path + ".lock"; if it's False, this process only reads.
+
+    Other processes can still change Envoy's log levels. When one does, it
+    shows its own log levels until the collector has published newer ones,
+    and it keeps its own count of the polls and errors involved on top of
+    the collector's.
+    """
+
+    def __init__(self, path, elect=True, **kwargs):
+        self.shared = SharedSnapshot(path)
+        self.lock_path = path + ".lock"
+        self.lock_fd = None
+        self.elect = elect
+        self.collecting = False
+        self.generation = None
+
+        # Counters bumped in this process while it isn't the collector.
+        self.local_counts = collections.Counter()
+
+        # (loginfo, loginfo_updated) from our last log level change, if the
+        # collector hasn't caught up with it yet.
+        self.local_loginfo = None
+
+        super().__init__(**kwargs)
+
+    @property
+    def stats(self):
+        self.sync()
+        return self._stats
+
+    @stats.setter
+    def stats(self, value):
+        self._stats = value
+
+    @property
+    def loginfo(self):
+        self.sync()
+        return self._loginfo
+
+    @loginfo.setter
+    def loginfo(self, value):
+        self._loginfo = value
+
+    @property
+    def history(self):
+        self.sync()
+        return self._history
+
+    @history.setter
+    def history(self, value):
+        self._history = value
+
+    @property
+    def vcluster_history(self):
+        self.sync()
+        return self._vcluster_history
+
+    @vcluster_history.setter
+    def vcluster_history(self, value):
+        self._vcluster_history = value
+
+    def try_collect(self):
+        if self.collecting:
+            return True
+
+        if not self.elect:
+            return False
+
+        if self.lock_fd is None:
+            self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+
+            raise
+
+        logger.info("PID %d is collecting Envoy stats" % os.getpid())
+        self.collecting = True
+        return True
+
+    def demand(self):
+        super().demand()
+        self.shared.set_demand(self.demanded)
+
+    def last_demand(self):
+        # CLOCK_MONOTONIC is the same for every process.
+        demands = [ when for when in [ self.demanded, self.shared.demand() ] if when ]
+
+        return max(demands) if demands else None
+
+    def update(self):
+        if not self.try_collect():
+            return
+
+        super().update()
+        self.publish()
+
+    def count(self, key):
+        super().count(key)
+
+        if not self.collecting:
+            self.local_counts[key] += 1
+
+    def loginfo_stale(self, now):
+        # Somebody else changed the log levels since we last fetched them.
+        return super().loginfo_stale(now) or (self.shared.logging_changed() > self.loginfo_updated)
+
+    def update_log_levels(self, last_attempt, level=None):
+        if not super().update_log_levels(last_attempt, level=level):
+            return False
+
+        if self.collecting:
+            # Let everyone else see the change now.
+            self.publish()
+        else:
+            self.local_loginfo = (self._loginfo, self.loginfo_updated)
+            self.shared.set_logging_changed(self.loginfo_updated)
+
+        return True
+
+    def publish(self):
+        stats = self._stats
+
+        snapshot = {
+            'stats': { key: value for key, value in stats.items() if key not in [ 'flat', 'envoy' ] },
+            'text': stats.text,
+            'prefixes': stats.prefixes,
+            'history': self._history,
+            'vcluster_history': self._vcluster_history,
+            'loginfo': self._loginfo,
+            'loginfo_updated': self.loginfo_updated
+        }
+
+        self.generation = self.shared.write(pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def sync(self):
+        """
+        Pick up the collector's latest snapshot, if there's a new one.
+        """
+
+        if self.collecting:
+            return
+
+        generation, snapshot = self.shared.read(since=self.generation)
+
+        if snapshot is None:
+            return
+
+        self._stats = StatsDict(snapshot['stats'], text=snapshot['text'], prefixes=snapshot['prefixes'])
+        self._history = snapshot['history']
+        self._vcluster_history = snapshot['vcluster_history']
+        self._loginfo = snapshot['loginfo']
+        self.loginfo_updated = snapshot['loginfo_updated']
+        self.generation = generation
+
+        for key, count in self.local_counts.items():
+            self._stats[key] += count
+
+        # Until the collector has fetched the log levels since we changed
+        # them, ours are newer than its.
+        if self.local_loginfo:
+            loginfo, updated = self.local_loginfo
+
+            if self.loginfo_updated < updated:
+                self._loginfo = loginfo
+                self.loginfo_updated = updated
+            else:
+                self.local_loginfo = None
@@ -27,6 +27,9 @@ if [ "$1" == "--demo" ]; then
     CONFIG_DIR="$AMBASSADOR_ROOT/ambassador-demo-config"
 fi
 
+# start-envoy.sh needs this to find the generation manifest.
+export AMBASSADOR_CONFIG_DIR="$CONFIG_DIR"
+
 DELAY=${AMBASSADOR_RESTART_TIME:-15}
 
 APPDIR=${APPDIR:-"$AMBASSADOR_ROOT"}
@@ -62,7 +65,10 @@ diediedie() {
     fi
 
     echo "Here's the envoy.json we were trying to run with:"
-    LATEST="$(ls -v $AMBASSADOR_ROOT/envoy*.json | tail -1)"
+    LATEST="$(/usr/bin/python3 -m ambassador.generations "$CONFIG_DIR")"
+    if [ -z "$LATEST" ]; then
+        LATEST="$(ls -v $AMBASSADOR_ROOT/envoy*.json | tail -1)"
+    fi
     if [ -e "$LATEST" ]; then
         cat "$LATEST"
     else
@@ -137,7 +143,7 @@ if [ $STATUS -ne 0 ]; then
 fi
 
 echo "AMBASSADOR: starting diagd"
-diagd --no-debugging "$CONFIG_DIR" &
+diagd --no-debugging --server "${AMBASSADOR_DIAGD_SERVER:-gunicorn}" "$CONFIG_DIR" &
 pids="${pids:+${pids} }$!:diagd"
 
 echo "AMBASSADOR: starting Envoy"
@@ -14,14 +14,49 @@
 # See the License for the specific language governing permissions and
 # limitations under the License
 
+import collections
+import json
 import os
+import select
 import signal
+import socket
 import sys
 import time
+import urllib.request
 
 restart_epoch = 0
 pid_list = []
 
+# Admission control: Envoy's hot restart fails (taking every epoch down with it) if a new epoch starts
+# while the previous one is still starting up or shutting down its parent. So we track the state of the
+# current epoch -- 'starting', 'draining' (its parent is still around), or 'stable' -- and only fork a new
+# epoch when it's stable. SIGHUPs that arrive before then collapse into a single pending restart, which
+# fires (via SIGALRM) as soon as the current epoch is stable.
+DRAIN_TIME = float(os.environ.get('AMBASSADOR_DRAIN_TIME', 5))
+SHUTDOWN_TIME = float(os.environ.get('AMBASSADOR_SHUTDOWN_TIME', 10))
+STARTUP_TIME = float(os.environ.get('AMBASSADOR_RESTARTER_STARTUP_TIME', 2))
+SHUTDOWN_MARGIN = 1.0
+
+# The current epoch and its timing are available as JSON on this socket.
+CONTROL_SOCKET = os.environ.get('AMBASSADOR_RESTARTER_SOCKET', '/tmp/ambassador-restarter.sock')
+
+# Readiness: after forking a new epoch, we poll Envoy's admin /server_info until it reports that the new
+# epoch is live. Until then (or until READY_TIMEOUT passes) the epoch is still 'starting'. A READY_TIMEOUT
+# of 0 turns this off, leaving just STARTUP_TIME.
+ADMIN_URL = os.environ.get('AMBASSADOR_ADMIN_URL', 'http://127.0.0.1:8001')
+READY_TIMEOUT = float(os.environ.get('AMBASSADOR_RESTARTER_READY_TIMEOUT', 60))
+READY_POLL_INTERVAL = 0.25
+
+# The last few epochs: which configuration generation each one loaded, and how long it took to get from
+# the change that triggered that generation to serving it.
+history = collections.deque(maxlen=20)
+
+epoch_started = None
+epoch_started_wall = None
+pending_restart = False
+pending_since = None
+coalesced = 0
+
 def force_kill_all_children():
   """ Iterate through all known child processes and force kill them. In the future we might consider
       possibly giving the child processes time to exit but this is fine for now. If someone force kills
@@ -50,12 +85,172 @@ def sigterm_handler(signum, frame):
   sys.exit(0)
 
 
+def epoch_state(now):
+  """ Return the state of the current epoch: 'starting' until it has had STARTUP_TIME to get going,
+      then 'draining' for as long as its parent might still be around, then 'stable'. """
+
+  if epoch_started is None:
+    return "starting"
+
+  elapsed = now - epoch_started
+
+  if (elapsed < STARTUP_TIME) or awaiting_readiness():
+    return "starting"
+
+  if (len(pid_list) > 1) and (elapsed < SHUTDOWN_TIME + SHUTDOWN_MARGIN):
+    return "draining"
+
+  return "stable"
+
+
+def stable_in(now):
+  """ How long until the current epoch is stable, assuming its parent doesn't exit early. """
+
+  if epoch_started is None:
+    return STARTUP_TIME
+
+  target = STARTUP_TIME
+
+  if len(pid_list) > 1:
+    target = max(target, SHUTDOWN_TIME + SHUTDOWN_MARGIN)
+
+  remaining = max(target - (now - epoch_started), 0)
+
+  if awaiting_readiness():
+    # We can't know; check back soon.
+    remaining = max(remaining, READY_POLL_INTERVAL)
+
+  return remaining
+
+
+def awaiting_readiness():
+  return bool(history) and (history[-1]["state"] == "waiting")
+
+
+def latest_generation():
+  """ Find out which generation start-envoy.sh is about to load, from kubewatch's manifest. """
+
+  config_dir = os.environ.get('AMBASSADOR_CONFIG_DIR', None)
+
+  if not config_dir:
+    return None
+
+  try:
+    from ambassador.generations import GenerationManifest
+
+    manifest = GenerationManifest(config_dir)
+
+    if manifest.load():
+      return manifest.latest_entry()
+  except Exception as e:
+    print ("could not read generation manifest: {}".format(e))
+
+  return None
+
+
+def record_epoch(epoch):
+  entry = latest_generation() or {}
+
+  history.append({
+    "epoch": epoch,
+    "generation": entry.get("generation", None),
+    "changed_at": entry.get("changed_at", None),
+    "forked": time.time(),
+    "ready": None,
+    "state": "waiting" if READY_TIMEOUT > 0 else "unchecked",
+    "startup_seconds": None,
+    "propagation_seconds": None
+  })
+
+
+def check_readiness():
+  """ Poll the admin endpoint to see whether the current epoch is live yet. """
+
+  record = history[-1]
+  now = time.time()
+
+  if now - record["forked"] > READY_TIMEOUT:
+    print ("epoch {} not ready after {:.0f}s, giving up on it".format(record["epoch"], READY_TIMEOUT))
+    record["state"] = "timeout"
+    maybe_restart()
+    return
+
+  try:
+    info = urllib.request.urlopen(ADMIN_URL + "/server_info", timeout=READY_POLL_INTERVAL).read()
+  except Exception:
+    # Not up yet.
+    return
+
+  # envoy <version> <state> <uptime current epoch> <uptime all epochs> <epoch>
+  fields = info.decode("utf-8", "replace").split()
+
+  try:
+    live = (fields[2] == "live") and (int(fields[5]) == record["epoch"])
+  except (IndexError, ValueError):
+    live = False
+
+  if not live:
+    return
+
+  record["ready"] = now
+  record["state"] = "ready"
+  record["startup_seconds"] = now - record["forked"]
+
+  if record["changed_at"]:
+    record["propagation_seconds"] = now - record["changed_at"]
+
+  print ("epoch {} (generation {}) ready after {:.2f}s{}".format(
+    record["epoch"], record["generation"], record["startup_seconds"],
+    ", {:.2f}s after change".format(record["propagation_seconds"]) if record["propagation_seconds"] else ""))
+
+  maybe_restart()
+
+
+def arm_timer():
+  signal.setitimer(signal.ITIMER_REAL, max(stable_in(time.monotonic()), 0.1))
+
+
+def maybe_restart():
+  """ Fire the pending restart, if there is one and the current epoch is stable. """
+
+  global pending_restart
+  if not pending_restart:
+    return
+
+  if epoch_state(time.monotonic()) == "stable":
+    print ("epoch {} is stable, starting deferred restart".format(restart_epoch - 1))
+    pending_restart = False
+    fork_and_exec()
+  else:
+    arm_timer()
+
+
 def sighup_handler(signum, frame):
   """ Handler for SIGUP. This signal is used to cause the restarter to fork and exec a new
-      child. """
+      child, as soon as it's safe to do so. """
+
+  global pending_restart, pending_since, coalesced
 
   print ("got SIGHUP")
-  fork_and_exec()
+  now = time.monotonic()
+  state = epoch_state(now)
+
+  if state == "stable" and not pending_restart:
+    fork_and_exec()
+  elif pending_restart:
+    coalesced += 1
+    print ("epoch {} is {}, coalescing with pending restart".format(restart_epoch - 1, state))
+  else:
+    print ("epoch {} is {}, deferring restart for {:.1f}s".format(restart_epoch - 1, state, stable_in(now)))
+    pending_restart = True
+    pending_since = time.time()
+    arm_timer()
+
+
+def sigalrm_handler(signum, frame):
+  """ Handler for SIGALRM, which we use to fire deferred restarts. """
+
+  maybe_restart()
 
 def sigusr1_handler(signum, frame):
   """ Handler for SIGUSR1. Propagate SIGUSR1 to all of the child processes """
@@ -114,15 +309,21 @@ def sigchld_handler(signum, frame):
     print ("exiting due to lack of child processes")
     sys.exit(1 if kill_all_and_exit else 0)
 
+  # If the old epoch just finished shutting down, the current one may be stable early.
+  maybe_restart()
+
 
 def fork_and_exec():
   """ This routine forks and execs a new child process and keeps track of its PID. Before we fork,
       set the current restart epoch in an env variable that processes can read if they care. """
 
-  global restart_epoch
+  global restart_epoch, epoch_started, epoch_started_wall
   os.environ['RESTART_EPOCH'] = str(restart_epoch)
   print ("forking and execing new child process at epoch {}".format(restart_epoch))
   restart_epoch += 1
+  epoch_started = time.monotonic()
+  epoch_started_wall = time.time()
+  record_epoch(restart_epoch - 1)
 
   child_pid = os.fork()
   if child_pid == 0:
@@ -134,6 +335,80 @@ def fork_and_exec():
     pid_list.append(child_pid)
 
 
+def status():
+  """ The current epoch and its timing, for the control socket. """
+
+  now = time.monotonic()
+
+  return {
+    "epoch": restart_epoch - 1,
+    "state": epoch_state(now),
+    "pids": list(pid_list),
+    "epoch_started": epoch_started_wall,
+    "epoch_age": (now - epoch_started) if epoch_started is not None else None,
+    "stable_in": stable_in(now),
+    "pending_restart": pending_restart,
+    "pending_since": pending_since if pending_restart else None,
+    "coalesced": coalesced,
+    "ready": bool(history) and (history[-1]["state"] == "ready"),
+    "history": list(history),
+    "startup_time": STARTUP_TIME,
+    "drain_time": DRAIN_TIME,
+    "shutdown_time": SHUTDOWN_TIME
+  }
+
+
+def open_control_socket(path):
+  try:
+    os.unlink(path)
+  except FileNotFoundError:
+    pass
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.bind(path)
+  sock.listen(5)
+  return sock
+
+
+def main_loop(sock):
+  """ Answer every connection to the control socket (if we have one) with our status, as a line of JSON,
+      and check the readiness of new epochs. Signals are handled between (or during) these. """
+
+  # select() doesn't return early for a signal (it's just restarted with the remaining timeout), so have
+  # signals write to a pipe that we also select on. Otherwise we wouldn't notice that we need to poll for
+  # readiness until the timeout ran out.
+  wakeup_r, wakeup_w = os.pipe()
+  os.set_blocking(wakeup_r, False)
+  os.set_blocking(wakeup_w, False)
+  signal.set_wakeup_fd(wakeup_w)
+
+  fds = [ wakeup_r ] + ([ sock ] if sock else [])
+
+  while True:
+    readable, _, _ = select.select(fds, [], [], READY_POLL_INTERVAL if awaiting_readiness() else 60)
+
+    if wakeup_r in readable:
+      try:
+        os.read(wakeup_r, 4096)
+      except BlockingIOError:
+        pass
+
+    if awaiting_readiness():
+      check_readiness()
+
+    if sock not in readable:
+      continue
+
+    conn, _ = sock.accept()
+
+    try:
+      conn.sendall(json.dumps(status()).encode("utf-8") + b"\n")
+    except OSError as e:
+      print ("error answering control socket: {}".format(e))
+    finally:
+      conn.close()
+
+
 def main():
   """ Script main. This script is designed so that a process watcher like runit or monit can watch
       this process and take corrective action if it ever goes away. """
@@ -144,12 +419,18 @@ def main():
   signal.signal(signal.SIGHUP, sighup_handler)
   signal.signal(signal.SIGCHLD, sigchld_handler)
   signal.signal(signal.SIGUSR1, sigusr1_handler)
+  signal.signal(signal.SIGALRM, sigalrm_handler)
+
+  try:
+    control = open_control_socket(CONTROL_SOCKET)
+  except OSError as e:
+    print ("could not open control socket {}: {}".format(CONTROL_SOCKET, e))
+    control = None
 
   # Start the first child process and then go into an endless loop since everything else happens via
   # signals.
   fork_and_exec()
-  while True:
-    time.sleep(60)
+  main_loop(control)
 
 if __name__ == '__main__':
   main()
@@ -14,7 +14,10 @@
 
 import sys
 
+import asyncio
 import click
+import collections
+import concurrent.futures
 import json
 import logging
 import os
@@ -31,7 +34,11 @@ from urllib3.exceptions import ProtocolError
 
 from kubernetes import watch
 from ambassador.config import Config
-from ambassador.utils import kube_v1, read_cert_secret, save_cert, check_cert_file, TLSPaths
+from ambassador.generations import GenerationManifest, GenerationWriter
+from ambassador.hot_restart import restarter_status
+from ambassador.leader import leader_election, make_snapshot
+from ambassador.metrics import MetricsServer, Registry
+from ambassador.utils import kube_v1, kube_reset_needed, reset_kube_v1, read_cert_secret, save_cert, check_cert_file, TLSPaths, secret_cache
 
 from ambassador.VERSION import Version
 
@@ -50,6 +57,17 @@ logger.setLevel(logging.INFO)
 
 KEY = "getambassador.io/config"
 
+metrics = Registry()
+
+events_total = metrics.counter("kubewatch_events_total", "Kubernetes watch events received")
+restarts_total = metrics.counter("kubewatch_restarts_total", "Envoy restarts requested")
+failures_total = metrics.counter("kubewatch_failures_total", "Failed generations, by stage")
+abandoned_total = metrics.counter("kubewatch_abandoned_total", "Generations abandoned as superseded")
+generation_seconds = metrics.histogram("kubewatch_generation_seconds", "Time to generate an Envoy config")
+validation_seconds = metrics.histogram("kubewatch_validation_seconds", "Time to validate an Envoy config")
+propagation_seconds = metrics.histogram("kubewatch_propagation_seconds",
+                                        "Time from the first unprocessed change to the restart that includes it")
+
 def is_annotated(svc):
     annotations = svc.metadata.annotations
     return annotations and KEY in annotations
@@ -63,11 +81,26 @@ def get_source(svc):
 def get_filename(svc):
     return "%s-%s.yaml" % (svc.metadata.name, svc.metadata.namespace)
 
-class Restarter(threading.Thread):
+def watched_namespaces(restarter):
+    """
+    Return the list of namespaces we should be looking at, or None if we should
+    look at all namespaces.
+    """
+
+    if "AMBASSADOR_SINGLE_NAMESPACE" in os.environ:
+        return [ restarter.namespace ]
+
+    namespaces = os.environ.get("AMBASSADOR_WATCH_NAMESPACES", "")
+    namespaces = [ ns for ns in re.split(r'[\s,]+', namespaces) if ns ]
 
-    def __init__(self, ambassador_config_dir, namespace, envoy_config_file, delay, pid):
-        threading.Thread.__init__(self, daemon=True)
+    return namespaces or None
 
+class Restarter(object):
+    # If changes keep arriving, we could abandon generations forever. Don't
+    # abandon more than this many in a row.
+    max_skips = 5
+
+    def __init__(self, ambassador_config_dir, namespace, envoy_config_file, delay, pid, retain=None):
         self.ambassador_config_dir = ambassador_config_dir
         self.namespace = namespace
         self.envoy_config_file = envoy_config_file
@@ -81,20 +114,54 @@ class Restarter(threading.Thread):
         self.processed = self.pokes
         self.restart_count = 0
 
+        # When the oldest change that we haven't processed yet arrived, by the
+        # monotonic clock (for our metrics) and the wall clock (for the
+        # manifest, so the hot restarter can work out when it went live).
+        self.pending_since = None
+        self.changed_at = None
+
+        # How many generations we've abandoned because newer input arrived
+        # before they could be used, in total and since the last restart.
+        self.skipped = 0
+        self.consecutive_skips = 0
+
+        # If set, this gets called (from whatever thread did the poking) every
+        # time we're poked. The RestartPipeline uses it to find out about changes.
+        self.on_poke = None
+
         self.configs = {}
 
+        # The generation manifest tells us which generations exist, so we don't
+        # have to go hunting around the filesystem for them.
+        self.manifest = GenerationManifest(self.ambassador_config_dir, retain=retain)
+
+        if not self.manifest.load():
+            self.manifest.scan()
+
+        self.restart_count = self.manifest.last_generation
+
         # Read the base configuration...
         self.read_fs(self.ambassador_config_dir)
 
         # ...then pull in anything updated by the restarter logic.
-        while True:
-            if not os.path.exists("%s-%s" % (self.ambassador_config_dir, self.restart_count + 1)):
-                break
-            else:
-                self.restart_count += 1
+        newest = self.manifest.newest_entry()
+
+        # This is where generate_config() will link unchanged inputs from.
+        self.previous_inputs = None
+
+        # In leader mode, this is the digest of the last snapshot we published
+        # or applied.
+        self.digest = None
+
+        # Envoy settings from the ambassador Module (envoy_concurrency, for
+        # start-envoy.sh), by generation, to be recorded in the manifest when
+        # the generation is committed.
+        self.envoy_settings = {}
 
-        path = "%s-%s" % (self.ambassador_config_dir, self.restart_count)
-        self.read_fs(path)
+        if newest:
+            self.read_fs(newest['config_dir'])
+            self.previous_inputs = newest['config_dir']
+            self.digest = newest.get('digest', None)
 
     def read_fs(self, path):
         if os.path.exists(path):
@@ -114,28 +181,109 @@ class Restarter(threading.Thread):
             delta = self.pokes - self.processed
         return delta
 
-    def run(self):
-        while True:
-            # This sleep rate limits the number of restart attempts.
-            time.sleep(self.delay)
-            with self.mutex:
-                changes = self.changes()
-                if changes > 0:
-                    logger.debug("Processing %s changes" % (changes))
-                    try:
-                        self.restart()
-                    except:
-                        logging.exception("could not restart Envoy")
-
-                    self.processed += changes
+    def snapshot(self):
+        """
+        Return a copy of our current config inputs, and the poke count that
+        they reflect.
+        """
+
+        with self.mutex:
+            return dict(self.configs), self.pokes
+
+    def mark_processed(self, pokes):
+        with self.mutex:
+            if pokes > self.processed:
+                self.processed = pokes
+
+            if self.processed >= self.pokes:
+                self.pending_since = None
+                self.changed_at = None
+
+    def superseded(self, pokes):
+        """
+        Return True if a generation built from the inputs as of pokes should be
+        abandoned because newer inputs have arrived since.
+        """
+
+        with self.mutex:
+            newer = self.pokes > pokes
+
+        return newer and (self.consecutive_skips < self.max_skips)
+
+    def abandon(self, generation, output):
+        self.skipped += 1
+        self.consecutive_skips += 1
+
+        logger.info("abandoning generation %d, superseded by newer input (%d skipped)" %
+                    (generation, self.skipped))
+
+        abandoned_total.inc()
+
+        self.record_failure(generation, output, abandoned=True)
+
+    def generation_dir(self, generation):
+        return "%s-%s" % (self.ambassador_config_dir, generation)
 
     def restart(self):
-        self.restart_count += 1
-        output = "%s-%s" % (self.ambassador_config_dir, self.restart_count)
-        config = self.generate_config(output)
+        """
+        Synchronously generate, validate, and switch to a new configuration.
+        This is what sync mode uses; watch mode uses the RestartPipeline, which
+        does the same steps without blocking everything else.
+        """
+
+        while True:
+            generation = self.manifest.next_generation()
+            output = self.generation_dir(generation)
+            configs, pokes = self.snapshot()
+
+            try:
+                try:
+                    config = self.generate_config(generation, output, configs)
+                except:
+                    failures_total.inc(stage="generate")
+                    raise
+
+                # Don't bother validating, or restarting with, a generation
+                # that's already out of date: start over with the new inputs.
+                if self.superseded(pokes):
+                    self.abandon(generation, output)
+                    continue
+
+                if not self.validate_config(config):
+                    failures_total.inc(stage="validate")
+                    raise ValueError("Unable to generate config")
+            except:
+                self.record_failure(generation, output)
+                raise
+
+            if self.superseded(pokes):
+                self.abandon(generation, output)
+                continue
+
+            self.commit(generation, output, config)
+            self.signal()
+            self.mark_processed(pokes)
+            break
+
+    def record_failure(self, generation, output, **kwargs):
+        self.envoy_settings.pop(generation, None)
+
+        # Record the failed generation too, so that it gets compacted
+        # eventually, but leave it around for debugging until then.
+        failed = "%s-%s" % (output, "envoy.json")
+
+        self.manifest.add(generation, output,
+                          failed if os.path.exists(failed) else None, valid=False, **kwargs)
+
+    def commit(self, generation, output, config, **kwargs):
+        """
+        Move a validated Envoy config into place as envoy-N.json, and record the
+        new generation in the manifest. Any kwargs are recorded in the manifest
+        entry.
+        """
 
         base, ext = os.path.splitext(self.envoy_config_file)
-        target = "%s-%s%s" % (base, self.restart_count, ext)
+        target = "%s-%s%s" % (base, generation, ext)
 
         # This has happened sometimes. Hmmmm.
         m = re.match(r'^envoy-\d+\.json$', os.path.basename(target))
@@ -146,44 +294,75 @@ class Restarter(threading.Thread):
         os.rename(config, target)
 
         logger.debug("Moved valid configuration %s to %s" % (config, target))
+
+        kwargs.setdefault('changed_at', self.changed_at)
+
+        for key, value in self.envoy_settings.pop(generation, {}).items():
+            kwargs.setdefault(key, value)
+
+        self.manifest.add(generation, output, os.path.abspath(target),
+                          skipped=self.consecutive_skips, **kwargs)
+        self.consecutive_skips = 0
+
+        return target
+
+    def signal(self):
         if self.pid:
             os.kill(self.pid, signal.SIGHUP)
 
-    def generate_config(self, output):
+        restarts_total.inc()
+
+        with self.mutex:
+            pending_since = self.pending_since
+
+        if pending_since is not None:
+            propagation_seconds.observe(time.monotonic() - pending_since)
+
+    def generate_config(self, generation, output, configs):
+        """
+        Write configs into the generation directory output, and generate an
+        Envoy config from them. Returns the path of the (not yet validated)
+        Envoy config.
+        """
+
+        self.restart_count = generation
+
         if os.path.exists(output):
             shutil.rmtree(output)
         os.makedirs(output)
-        for filename, config in self.configs.items():
-            path = os.path.join(output, filename)
-            with open(path, "w") as fd:
-                fd.write(config)
-            logger.debug("Wrote %s to %s" % (filename, path))
+
+        # Only write the inputs that changed since the last generation; the
+        # rest are linked from there.
+        writer = GenerationWriter(self.previous_inputs)
+        writer.write(output, configs)
+        self.previous_inputs = output
+
+        logger.debug("Wrote %d input%s to %s (%d unchanged)" %
+                     (writer.written, "" if (writer.written == 1) else "s", output, writer.linked))
 
         changes = self.changes()
         plural = "" if (changes == 1) else "s"
 
         logger.info("generating config with gencount %d (%d change%s)" % 
-                    (self.restart_count, changes, plural))
+                    (generation, changes, plural))
 
-        aconf = Config(output)
-        rc = aconf.generate_envoy_config(mode="kubewatch",
-                                         generation_count=self.restart_count)
+        with generation_seconds.time():
+            aconf = Config(output)
+            rc = aconf.generate_envoy_config(mode="kubewatch",
+                                             generation_count=generation)
 
         logger.info("Scout reports %s" % json.dumps(rc.scout_result))       
 
         if rc:
             envoy_config = "%s-%s" % (output, "envoy.json")
             aconf.pretty(rc.envoy_config, out=open(envoy_config, "w"))
-            try:
-                result = subprocess.check_output(["/usr/local/bin/envoy", "--base-id", "1", "--mode", "validate",
-                                                  "-c", envoy_config])
-                if result.strip().endswith(b" OK"):
-                    logger.debug("Configuration %s valid" % envoy_config)
-                    return envoy_config
-            except subprocess.CalledProcessError:
-                logger.info("Invalid envoy config")
-                with open(envoy_config) as fd:
-                    logger.info(fd.read())
+
+            concurrency = aconf.ambassador_module.get('envoy_concurrency', None)
+
+            if concurrency is not None:
+                self.envoy_settings[generation] = { 'envoy_concurrency': concurrency }
+
+            return envoy_config
         else:
             logger.info("Could not generate new Envoy configuration: %s" % rc.error)
             logger.info("Raw template output:")
@@ -191,6 +370,92 @@ class Restarter(threading.Thread):
 
         raise ValueError("Unable to generate config")
 
+    def snapshot_generation(self, generation, output, target, leader):
+        """
+        Build a leader-mode snapshot of a committed generation.
+        """
+
+        inputs = {}
+
+        for name in os.listdir(output):
+            if name.endswith(".yaml"):
+                with open(os.path.join(output, name), "r") as fd:
+                    inputs[name] = fd.read()
+
+        with open(target, "r") as fd:
+            envoy_config = fd.read()
+
+        entry = self.manifest.entry(generation) or {}
+        settings = { key: entry[key] for key in [ 'envoy_concurrency' ] if key in entry }
+
+        return make_snapshot(generation, leader, envoy_config, inputs, settings=settings)
+
+    def write_snapshot(self, generation, output, snapshot):
+        """
+        Write a snapshot published by the leader into the generation directory
+        output, and make its inputs our inputs. Returns the path of the Envoy
+        config, which still needs validating: the leader validated it against
+        its own filesystem, not ours.
+        """
+
+        self.restart_count = generation
+
+        if os.path.exists(output):
+            shutil.rmtree(output)
+        os.makedirs(output)
+
+        writer = GenerationWriter(self.previous_inputs)
+        writer.write(output, snapshot['inputs'])
+        self.previous_inputs = output
+
+        with self.mutex:
+            self.configs = dict(snapshot['inputs'])
+
+        self.save_certs(output)
+
+        envoy_config = "%s-%s" % (output, "envoy.json")
+
+        with open(envoy_config, "w") as fd:
+            fd.write(snapshot['envoy_config'])
+
+        self.envoy_settings[generation] = dict(snapshot.get('settings', {}))
+
+        return envoy_config
+
+    def save_certs(self, output):
+        """
+        Fetch the TLS Secrets that the inputs in output refer to, and save
+        their certs where the Envoy config expects them. Generating the config
+        does this as a side effect, but a follower doesn't generate; loading
+        the inputs is enough.
+        """
+
+        Config(output)
+
+    def validate_command(self, envoy_config):
+        return [ "/usr/local/bin/envoy", "--base-id", "1", "--mode", "validate", "-c", envoy_config ]
+
+    def check_validation(self, envoy_config, returncode, output):
+        if (returncode == 0) and output.strip().endswith(b" OK"):
+            logger.debug("Configuration %s valid" % envoy_config)
+            return True
+
+        logger.info("Invalid envoy config")
+
+        with open(envoy_config) as fd:
+            logger.info(fd.read())
+
+        return False
+
+    def validate_config(self, envoy_config):
+        try:
+            with validation_seconds.time():
+                result = subprocess.check_output(self.validate_command(envoy_config))
+
+            return self.check_validation(envoy_config, 0, result)
+        except subprocess.CalledProcessError as e:
+            return self.check_validation(envoy_config, e.returncode, e.output)
+
     def update_from_service(self, svc):
         key = get_filename(svc)
         source = get_source(svc)
@@ -249,8 +514,320 @@ class Restarter(threading.Thread):
         with self.mutex:
             if self.processed == self.pokes:
                 logger.debug("Scheduling restart")
+                self.pending_since = time.monotonic()
+                self.changed_at = time.time()
             self.pokes += 1
 
+        if self.on_poke:
+            self.on_poke()
+
+
+def put_latest(queue, item):
+    """
+    Put item on a bounded queue, making room by discarding the oldest items
+    if need be. Returns the list of discarded items.
+    """
+
+    discarded = []
+
+    while queue.full():
+        discarded.append(queue.get_nowait())
+
+    queue.put_nowait(item)
+
+    return discarded
+
+
+class RestartPipeline(object):
+    """
+    The asyncio core of watch mode. A change flows through three stages:
+
+    - generate: snapshot the Restarter's inputs and generate an Envoy config
+      from them. Config generation is CPU-bound, so it runs in an executor.
+    - validate: run envoy --mode validate as an async subprocess.
+    - restart: move the config into place and SIGHUP the hot restarter.
+
+    The ServiceWatcher threads keep feeding the Restarter the whole time, and
+    the Restarter pokes us through loop.call_soon_threadsafe(). The stages are
+    connected by one-slot queues: if a stage is still busy when a newer item
+    arrives, the older item is discarded, since only the latest state matters.
+    Likewise, before validating and again before restarting, a generation is
+    abandoned if the Restarter has been poked since its inputs were snapshotted;
+    a newer generation is already on its way. (Restarter.max_skips keeps a
+    constant stream of changes from starving restarts forever.)
+
+    Both generation and restart attempts are spaced at least restarter.delay
+    seconds apart.
+
+    In leader mode (election is a (lock, channel) tuple from leader_election()),
+    only the replica holding the lock watches services and runs the stages
+    above, publishing every generation it restarts with to the channel. The
+    others just apply the latest published snapshot, after fetching any TLS
+    Secrets it needs and validating it themselves.
+    """
+
+    def __init__(self, restarter, loop=None, election=None):
+        self.restarter = restarter
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self.lock, self.channel = election if election else (None, None)
+        self.leading = not election
+        self.watch_stopped = None
+
+        self.to_generate = asyncio.Queue(maxsize=1)
+        self.to_validate = asyncio.Queue(maxsize=1)
+        self.to_restart = asyncio.Queue(maxsize=1)
+
+        self.last_generation = None
+        self.last_restart = None
+
+    def poked(self):
+        # Called from whatever thread poked the Restarter.
+        self.loop.call_soon_threadsafe(self.changed)
+
+    def changed(self):
+        # Followers don't generate anything, even if a watch that's shutting
+        # down manages to sneak in one last event.
+        if self.leading:
+            put_latest(self.to_generate, self.restarter.pokes)
+
+    def start_watching(self):
+        self.watch_stopped = threading.Event()
+
+        # The watches run in their own threads, feeding the Restarter.
+        watcher = threading.Thread(target=watch_forever, args=(self.restarter, self.watch_stopped),
+                                   name="watch", daemon=True)
+        watcher.start()
+
+    def stop_watching(self):
+        if self.watch_stopped:
+            self.watch_stopped.set()
+            self.watch_stopped = None
+
+    def discard(self, items):
+        # Anything we discarded has already been generated, so it's taking up
+        # space on disk. Record it as abandoned so that it gets compacted.
+        for generation, output, config, pokes in items:
+            self.restarter.abandon(generation, output)
+
+    async def wait_for_delay(self, last):
+        if last is not None:
+            remaining = last + self.restarter.delay - self.loop.time()
+
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+
+    async def generate_stage(self):
+        while True:
+            await self.to_generate.get()
+
+            # This sleep rate limits the number of generations. Anything that
+            # changes while we sleep will just be part of this generation.
+            await self.wait_for_delay(self.last_generation)
+            self.last_generation = self.loop.time()
+
+            # Drop any pokes that arrived while we were waiting.
+            while not self.to_generate.empty():
+                self.to_generate.get_nowait()
+
+            generation = self.restarter.manifest.next_generation()
+            output = self.restarter.generation_dir(generation)
+            configs, pokes = self.restarter.snapshot()
+
+            try:
+                config = await self.loop.run_in_executor(self.executor, self.restarter.generate_config,
+                                                         generation, output, configs)
+            except Exception:
+                logger.exception("could not generate configuration")
+                failures_total.inc(stage="generate")
+                self.restarter.record_failure(generation, output)
+                self.restarter.mark_processed(pokes)
+                continue
+
+            self.discard(put_latest(self.to_validate, (generation, output, config, pokes)))
+
+    async def validate(self, config):
+        try:
+            with validation_seconds.time():
+                proc = await asyncio.create_subprocess_exec(*self.restarter.validate_command(config),
+                                                            stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.STDOUT)
+                result, _ = await proc.communicate()
+
+            return self.restarter.check_validation(config, proc.returncode, result)
+        except Exception:
+            logger.exception("could not validate configuration")
+            return False
+
+    async def validate_stage(self):
+        while True:
+            generation, output, config, pokes = await self.to_validate.get()
+
+            if self.restarter.superseded(pokes):
+                self.restarter.abandon(generation, output)
+                continue
+
+            valid = await self.validate(config)
+
+            if valid:
+                self.discard(put_latest(self.to_restart, (generation, output, config, pokes)))
+            else:
+                failures_total.inc(stage="validate")
+                self.restarter.record_failure(generation, output)
+                self.restarter.mark_processed(pokes)
+
+    async def restart_stage(self):
+        while True:
+            generation, output, config, pokes = await self.to_restart.get()
+
+            # This sleep rate limits the number of restart attempts.
+            await self.wait_for_delay(self.last_restart)
+            await self.wait_for_stable_epoch()
+
+            if self.restarter.superseded(pokes):
+                self.restarter.abandon(generation, output)
+                continue
+
+            self.last_restart = self.loop.time()
+
+            try:
+                target = self.restarter.commit(generation, output, config)
+                self.restarter.signal()
+            except Exception:
+                logger.exception("could not restart Envoy")
+                failures_total.inc(stage="restart")
+                target = None
+
+            self.restarter.mark_processed(pokes)
+
+            if target and self.leading and self.channel:
+                try:
+                    digest = await self.loop.run_in_executor(None, self.publish, generation, output, target)
+                except Exception:
+                    logger.exception("could not publish generation %d" % generation)
+                else:
+                    # Remember what we published, so that if we become a
+                    # follower later we don't apply it all over again.
+                    self.restarter.digest = digest
+                    self.restarter.manifest.entry(generation)['digest'] = digest
+                    self.restarter.manifest.save()
+
+    async def wait_for_stable_epoch(self):
+        """
+        The hot restarter won't start a new Envoy epoch until the current one
+        is stable; it just queues our SIGHUP. Rather than committing to a
+        generation that might be superseded while it sits in that queue, wait
+        here until the restarter is ready.
+        """
+
+        if not self.restarter.pid:
+            return
+
+        while True:
+            status = await self.loop.run_in_executor(None, restarter_status)
+
+            # No status means an old restarter, or none at all; just go.
+            if not status or (status.get('state') == 'stable'):
+                return
+
+            logger.debug("epoch %s is %s, waiting %.1fs" %
+                         (status.get('epoch'), status.get('state'), status.get('stable_in', 0)))
+
+            await asyncio.sleep(min(max(status.get('stable_in', 1), 0.1), 5))
+
+    def publish(self, generation, output, target):
+        snapshot = self.restarter.snapshot_generation(generation, output, target, self.lock.identity)
+        self.channel.publish(snapshot)
+
+        logger.info("published generation %d (%s)" % (generation, snapshot['digest']))
+
+        return snapshot['digest']
+
+    async def follow(self):
+        snapshot = await self.loop.run_in_executor(None, self.channel.fetch)
+
+        if not snapshot or (snapshot.get('digest') == self.restarter.digest):
+            return
+
+        await self.wait_for_delay(self.last_restart)
+        self.last_restart = self.loop.time()
+
+        generation = self.restarter.manifest.next_generation()
+        output = self.restarter.generation_dir(generation)
+
+        logger.info("applying generation %d from leader %s as generation %d" %
+                    (snapshot['generation'], snapshot['leader'], generation))
+
+        try:
+            config = await self.loop.run_in_executor(self.executor, self.restarter.write_snapshot,
+                                                     generation, output, snapshot)
+        except Exception:
+            logger.exception("could not apply snapshot from leader %s" % snapshot['leader'])
+            self.restarter.record_failure(generation, output)
+            return
+
+        if not await self.validate(config):
+            logger.warning("generation %d from leader %s is not valid here" %
+                           (snapshot['generation'], snapshot['leader']))
+            failures_total.inc(stage="validate")
+            self.restarter.record_failure(generation, output)
+
+            # Don't keep retrying it; wait for the leader's next generation.
+            self.restarter.digest = snapshot['digest']
+            return
+
+        self.restarter.commit(generation, output, config,
+                              digest=snapshot['digest'], leader=snapshot['leader'])
+        self.restarter.digest = snapshot['digest']
+        self.restarter.signal()
+
+    async def election_stage(self):
+        interval = self.lock.lease_duration / 3
+
+        while True:
+            try:
+                leading = await self.loop.run_in_executor(None, self.lock.acquire)
+            except Exception:
+                logger.exception("could not check leadership")
+                leading = False
+
+            if leading and not self.leading:
+                logger.info("%s is now the leader" % self.lock.identity)
+                self.leading = True
+                self.start_watching()
+
+                if self.restarter.changes() > 0:
+                    self.changed()
+            elif self.leading and not leading:
+                logger.info("%s is no longer the leader" % self.lock.identity)
+                self.leading = False
+                self.stop_watching()
+
+            if not self.leading:
+                try:
+                    await self.follow()
+                except Exception:
+                    logger.exception("could not follow leader")
+
+            await asyncio.sleep(interval)
+
+    async def run(self):
+        self.restarter.on_poke = self.poked
+
+        stages = [ self.generate_stage(), self.validate_stage(), self.restart_stage() ]
+
+        if self.lock:
+            stages.append(self.election_stage())
+        else:
+            self.start_watching()
+
+            # If anything changed before we got going, make sure we notice.
+            if self.restarter.changes() > 0:
+                self.changed()
+
+        await asyncio.gather(*stages)
+
 
 def sync(restarter):
     v1 = kube_v1()
@@ -309,18 +886,13 @@ def sync(restarter):
                 restarter.update("tls.yaml", tls_yaml)
 
         # Next, check for annotations and such.
-        svc_list = None
-
-        if "AMBASSADOR_SINGLE_NAMESPACE" in os.environ:
-            svc_list = v1.list_namespaced_service(restarter.namespace)
-        else:
-            svc_list = v1.list_service_for_all_namespaces()
+        svc_list = list_services(v1, watched_namespaces(restarter))
 
         if svc_list:
             logger.debug("sync: found %d service%s" % 
-                         (len(svc_list.items), ("" if (len(svc_list.items) == 1) else "s")))
+                         (len(svc_list), ("" if (len(svc_list) == 1) else "s")))
 
-            for svc in svc_list.items:
+            for svc in svc_list:
                 restarter.update_from_service(svc)
         else:
             logger.debug("sync: no services found")
@@ -329,37 +901,158 @@ def sync(restarter):
     logger.debug("Generating initial Envoy config")
     restarter.restart()
 
-def watch_loop(restarter):
+def list_services(v1, namespaces):
+    """
+    List services in the given namespaces (or everywhere, if namespaces is None).
+    Multiple namespaces are listed concurrently.
+    """
+
+    if namespaces is None:
+        return v1.list_service_for_all_namespaces().items
+
+    services = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(namespaces), 16)) as pool:
+        for svc_list in pool.map(lambda ns: v1.list_namespaced_service(ns).items, namespaces):
+            services.extend(svc_list)
+
+    return services
+
+class ServiceWatcher(threading.Thread):
+    """
+    Watch services in a single namespace (or in all namespaces, if namespace is
+    None) and feed the events to the Restarter. Each ServiceWatcher reconnects
+    on its own, so one broken stream doesn't disturb the others.
+    """
+
+    kind = "service"
+
+    def __init__(self, restarter, namespace=None, retry_delay=60, stopped=None):
+        threading.Thread.__init__(self, daemon=True, name="watch-%s" % (namespace or "all"))
+
+        self.restarter = restarter
+        self.namespace = namespace
+        self.retry_delay = retry_delay
+        self.stopped = stopped or threading.Event()
+
+        # Event counts by type, plus 'reconnects' and 'errors'.
+        self.counters = collections.Counter()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.watch()
+                logger.debug("%s: watch stream ended, reconnecting" % self.name)
+            except ProtocolError:
+                logger.debug("%s: watch connection has been broken. retry automatically." % self.name)
+            except Exception as e:
+                logger.exception("%s: could not watch for Kubernetes changes" % self.name)
+                self.counters['errors'] += 1
+
+                if kube_reset_needed(e):
+                    reset_kube_v1()
+
+                self.stopped.wait(self.retry_delay)
+
+            self.counters['reconnects'] += 1
+
+    def stream(self, w, v1):
+        if self.namespace:
+            return w.stream(v1.list_namespaced_service, namespace=self.namespace)
+        else:
+            return w.stream(v1.list_service_for_all_namespaces)
+
+    def handle(self, evt):
+        if evt["type"] == "DELETED":
+            self.restarter.delete(evt["object"])
+        else:
+            self.restarter.update_from_service(evt["object"])
+
+    def watch(self):
+        v1 = kube_v1()
+        w = watch.Watch()
+
+        for evt in self.stream(w, v1):
+            if self.stopped.is_set():
+                w.stop()
+                break
+
+            logger.debug("Event: %s %s/%s" % 
+                         (evt["type"], 
+                          evt["object"].metadata.namespace, evt["object"].metadata.name))
+            sys.stdout.flush()
+
+            self.counters[evt["type"]] += 1
+            events_total.inc(kind=self.kind, type=evt["type"])
+            self.handle(evt)
+
+class SecretWatcher(ServiceWatcher):
+    """
+    Watch secrets in Ambassador's namespace, and drop them from the secret
+    cache as they change, so that the next Config build picks up the change.
+    """
+
+    kind = "secret"
+
+    def __init__(self, restarter, namespace, **kwargs):
+        ServiceWatcher.__init__(self, restarter, namespace, **kwargs)
+        self.name = "secrets-%s" % namespace
+
+    def stream(self, w, v1):
+        return w.stream(v1.list_namespaced_secret, namespace=self.namespace)
+
+    def handle(self, evt):
+        secret_cache.invalidate(self.namespace, evt["object"].metadata.name)
+
+    def watch(self):
+        # We might have missed changes while we weren't watching.
+        secret_cache.invalidate(self.namespace)
+        ServiceWatcher.watch(self)
+
+def watch_loop(restarter, stopped):
     v1 = kube_v1()
 
     if v1:
-        while True:
-            try:
-                w = watch.Watch()
+        namespaces = watched_namespaces(restarter)
+        watchers = [ ServiceWatcher(restarter, namespace, stopped=stopped)
+                     for namespace in (namespaces or [ None ]) ]
+        watchers.append(SecretWatcher(restarter, restarter.namespace, stopped=stopped))
 
-                if "AMBASSADOR_SINGLE_NAMESPACE" in os.environ:
-                    watched = w.stream(v1.list_namespaced_service, namespace=restarter.namespace)
-                else:
-                    watched = w.stream(v1.list_service_for_all_namespaces)
+        logger.info("watching %s" % (", ".join(namespaces) if namespaces else "all namespaces"))
 
-                for evt in watched:
-                    logger.debug("Event: %s %s/%s" % 
-                                 (evt["type"], 
-                                  evt["object"].metadata.namespace, evt["object"].metadata.name))
-                    sys.stdout.flush()
+        for watcher in watchers:
+            watcher.start()
 
-                    if evt["type"] == "DELETED":
-                        restarter.delete(evt["object"])
-                    else:
-                        restarter.update_from_service(evt["object"])
+        while not stopped.wait(60):
+            for watcher in watchers:
+                logger.debug("%s: %s" % (watcher.name, 
+                                         ", ".join("%s %d" % (key, watcher.counters[key])
+                                                   for key in sorted(watcher.counters.keys()))))
 
-                logger.info("watch loop exited?")
-            except ProtocolError:
-                logger.debug("watch connection has been broken. retry automatically.")
-                continue
+            logger.debug("generation %d, %d abandoned as superseded" %
+                         (restarter.restart_count, restarter.skipped))
     else:
         logger.info("No K8s, idling")
 
+def watch_forever(restarter, stopped):
+    while not stopped.is_set():
+        try:
+            # this is in a loop because sometimes the auth expires
+            # or the connection dies
+            logger.debug("starting watch loop")
+            watch_loop(restarter, stopped)
+        except Exception as e:
+            logger.exception("could not watch for Kubernetes service changes")
+
+            # If our credentials expired or the API server went away, start
+            # over with a new client next time around.
+            if kube_reset_needed(e):
+                reset_kube_v1()
+        finally:
+            stopped.wait(60)
+
+    logger.debug("stopped watching")
+
 @click.command()
 @click.argument("mode", type=click.Choice(["sync", "watch"]))
 @click.argument("ambassador_config_dir")
@@ -368,7 +1061,13 @@ def watch_loop(restarter):
               help="The minimum delay in seconds between restart attempts.")
 @click.option("-p", "--pid", type=click.INT,
               help="The pid to kill with SIGHUP in order to iniate a restart.")
-def main(mode, ambassador_config_dir, envoy_config_file, delay, pid):
+@click.option("-r", "--retain", type=click.INT, envvar="AMBASSADOR_GENERATION_RETENTION",
+              default=10, help="The number of configuration generations to keep on disk.")
+@click.option("-m", "--metrics-port", type=click.INT, envvar="AMBASSADOR_KUBEWATCH_METRICS_PORT",
+              default=8878, help="The port on which to serve metrics in watch mode (0 to disable).")
+@click.option("--statsd/--no-statsd", envvar="STATSD_ENABLED", default=False,
+              help="Also send metrics to statsd on 127.0.0.1:8125.")
+def main(mode, ambassador_config_dir, envoy_config_file, delay, pid, retain, metrics_port, statsd):
     """This script watches the kubernetes API for changes in services. It
     collects ambassador configuration imput from the ambassador
     annotation on any services, and whenever these change, it will
@@ -422,35 +1121,39 @@ def main(mode, ambassador_config_dir, envoy_config_file, delay, pid):
     envoy is supplied with an invalid configuration. This script takes
     care to ensure that all inputs are fully validated using envoy's
     --mode validate option in order to ensure that we never attempt to
-    restart with an invalid configuration. It also keeps a full
-    history of all configurations along with the errors from any
-    invalid configurations to aid in debugging if invalid
-    configuration inputs are supplied in any annotations, or if there
-    is an ambassador bug encountered when processing an annotation.
+    restart with an invalid configuration. It also keeps a history of
+    the most recent configurations (see --retain) along with the
+    errors from any invalid configurations to aid in debugging if
+    invalid configuration inputs are supplied in any annotations, or
+    if there is an ambassador bug encountered when processing an
+    annotation. The retained generations are recorded in a manifest
+    next to the configuration directory, which is how diagd and
+    start-envoy.sh find the latest one.
 
     """
 
     namespace = os.environ.get('AMBASSADOR_NAMESPACE', 'default')
 
-    restarter = Restarter(ambassador_config_dir, namespace, envoy_config_file, delay, pid)
+    restarter = Restarter(ambassador_config_dir, namespace, envoy_config_file, delay, pid, retain=retain)
 
     if mode == "sync":
         sync(restarter)
     elif mode == "watch":
-        restarter.start()
+        metrics.gauge("kubewatch_queue_depth", "Changes not yet processed", fn=restarter.changes)
+        metrics.gauge("kubewatch_generation", "Current generation", fn=lambda: restarter.restart_count)
 
-        while True:
-            try:
-                # this is in a loop because sometimes the auth expires
-                # or the connection dies
-                logger.debug("starting watch loop")
-                watch_loop(restarter)
-            except KeyboardInterrupt:
-                raise
-            except:
-                logger.exception("could not watch for Kubernetes service changes")
-            finally:
-                time.sleep(60)
+        if statsd:
+            metrics.enable_statsd(prefix="ambassador.")
+
+        if metrics_port:
+            MetricsServer(metrics, port=metrics_port).start()
+
+        # The RestartPipeline starts the watches and handles generation and
+        # restarts on the main thread's event loop.
+        election = leader_election(namespace)
+
+        pipeline = RestartPipeline(restarter, election=election)
+        pipeline.loop.run_until_complete(pipeline.run())
     else:
          raise ValueError(mode)
 
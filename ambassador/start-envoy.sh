@@ -17,6 +17,24 @@
 DRAIN_TIME=${AMBASSADOR_DRAIN_TIME:-5}
 SHUTDOWN_TIME=${AMBASSADOR_SHUTDOWN_TIME:-10}
 AMBASSADOR_ROOT="/ambassador"
+CONFIG_DIR=${AMBASSADOR_CONFIG_DIR:-"$AMBASSADOR_ROOT/ambassador-config"}
 
-LATEST=$(ls -1v "$AMBASSADOR_ROOT"/envoy*.json | tail -1)
-exec /usr/local/bin/envoy -c ${LATEST} --restart-epoch $RESTART_EPOCH --drain-time-s "${DRAIN_TIME}" --service-cluster "${AMBASSADOR_ID:-ambassador}-${AMBASSADOR_NAMESPACE}" --parent-shutdown-time-s "${SHUTDOWN_TIME}"
+# kubewatch records the latest valid generation in its manifest. Fall back
+# to looking for the newest envoy-N.json if we don't have a manifest.
+LATEST=$(/usr/bin/python3 -m ambassador.generations "$CONFIG_DIR")
+
+if [ -z "$LATEST" ]; then
+    LATEST=$(ls -1v "$AMBASSADOR_ROOT"/envoy*.json | tail -1)
+fi
+
+# Size Envoy's worker pool to the container's CPU limit, unless it's been
+# set in the environment or the ambassador module. No output means leave it
+# to Envoy.
+CONCURRENCY=$(/usr/bin/python3 -m ambassador.cgroups "$CONFIG_DIR")
+CONCURRENCY_ARGS=""
+
+if [ -n "$CONCURRENCY" ]; then
+    CONCURRENCY_ARGS="--concurrency ${CONCURRENCY}"
+fi
+
+exec /usr/local/bin/envoy -c ${LATEST} --restart-epoch $RESTART_EPOCH ${CONCURRENCY_ARGS} --drain-time-s "${DRAIN_TIME}" --service-cluster "${AMBASSADOR_ID:-ambassador}-${AMBASSADOR_NAMESPACE}" --parent-shutdown-time-s "${SHUTDOWN_TIME}"
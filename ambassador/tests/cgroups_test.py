@@ -0,0 +1,83 @@
+import os
+
+from ambassador.cgroups import cpu_quota, envoy_concurrency, manifest_concurrency
+from ambassador.generations import GenerationManifest
+
+def write(root, path, contents):
+    path = os.path.join(str(root), path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, "w") as fd:
+        fd.write(contents)
+
+def v2_tree(tmpdir, cpu_max, parent_max=None):
+    root = tmpdir.join("cgroup")
+    write(root, "cgroup.controllers", "cpuset cpu io memory pids\n")
+    write(root, "kubepods/pod1/ctr/cpu.max", cpu_max + "\n")
+
+    if parent_max:
+        write(root, "kubepods/pod1/cpu.max", parent_max + "\n")
+
+    write(tmpdir, "proc-cgroup", "0::/kubepods/pod1/ctr\n")
+
+    return str(root), str(tmpdir.join("proc-cgroup"))
+
+def v1_tree(tmpdir, quota, period="100000", mount="cpu,cpuacct"):
+    root = tmpdir.join("cgroup")
+    write(root, "memory/memory.limit_in_bytes", "536870912\n")
+    write(root, mount + "/cpu.cfs_quota_us", quota + "\n")
+    write(root, mount + "/cpu.cfs_period_us", period + "\n")
+
+    # No cgroup namespace here: our path doesn't exist under the mount, which
+    # is what you see inside a typical Docker container.
+    write(tmpdir, "proc-cgroup", "11:memory:/docker/abc\n4:cpu,cpuacct:/docker/abc\n")
+
+    return str(root), str(tmpdir.join("proc-cgroup"))
+
+def concurrency(root, proc_cgroup, module_value=None, environ={}, cpus=16):
+    return envoy_concurrency(module_value=module_value, environ=environ,
+                             root=root, proc_cgroup=proc_cgroup, cpus=cpus)
+
+def test_v2(tmpdir):
+    root, proc = v2_tree(tmpdir, "150000 100000")
+
+    assert cpu_quota(root=root, proc_cgroup=proc) == 1.5
+    assert concurrency(root, proc) == (2, 'cgroup')
+    assert concurrency(root, proc, cpus=1) == (1, 'cgroup')
+
+def test_v2_nested(tmpdir):
+    root, proc = v2_tree(tmpdir, "max 100000", parent_max="400000 100000")
+    assert concurrency(root, proc) == (4, 'cgroup')
+
+    root, proc = v2_tree(tmpdir.mkdir("unlimited"), "max 100000")
+    assert concurrency(root, proc) == (None, 'default')
+
+def test_v1(tmpdir):
+    root, proc = v1_tree(tmpdir, "50000")
+    assert concurrency(root, proc) == (1, 'cgroup')
+
+    root, proc = v1_tree(tmpdir.mkdir("unlimited"), "-1", mount="cpu")
+    assert cpu_quota(root=root, proc_cgroup=proc) is None
+    assert concurrency(root, proc) == (None, 'default')
+
+def test_overrides(tmpdir):
+    root, proc = v1_tree(tmpdir, "300000")
+
+    assert concurrency(root, proc, module_value=2) == (2, 'module')
+    assert concurrency(root, proc, module_value="bogus") == (3, 'cgroup')
+    assert concurrency(root, proc, module_value=2,
+                       environ={ 'AMBASSADOR_ENVOY_CONCURRENCY': '8' }) == (8, 'environment')
+
+    # No cgroup filesystem at all.
+    missing = str(tmpdir.join("missing"))
+    assert concurrency(missing, missing) == (None, 'default')
+
+def test_manifest(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+
+    assert manifest_concurrency(prefix) is None
+
+    manifest = GenerationManifest(prefix)
+    manifest.add(1, "%s-1" % prefix, "/tmp/envoy-1.json", envoy_concurrency=4)
+
+    assert manifest_concurrency(prefix) == 4
@@ -0,0 +1,247 @@
+import asyncio
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+from aiohttp import test_utils
+from flask import Flask, Response
+
+from ambassador_diag import aserver
+from ambassador_diag.aserver import AsyncDiagServer
+from ambassador_diag.envoy import EnvoyStats
+
+MAPPING = """---
+apiVersion: ambassador/v0
+kind: Mapping
+name: m%d
+prefix: /m%d/
+service: s%d
+"""
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DIAGD = "from ambassador_diag.diagd import main; main()"
+
+# Diag load comes from another process, so it doesn't compete with the
+# probes in this one for the GIL.
+LOADER = """
+import http.client, sys, threading
+
+port, clients = int(sys.argv[1]), int(sys.argv[2])
+
+def load():
+    while True:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.request("GET", "/ambassador/v0/diag/?json=true")
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        print(response.status, flush=True)
+
+for i in range(clients):
+    threading.Thread(target=load, daemon=True).start()
+
+sys.stdin.read()
+"""
+
+def wait_for_server(port, timeout=30):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            return get(port, "/ambassador/v0/check_alive")
+        except OSError:
+            time.sleep(0.1)
+
+    raise Exception("diagd never started")
+
+def get(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+def test_diag_under_load(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+    os.makedirs(prefix)
+
+    for i in range(200):
+        with open(os.path.join(prefix, "m%d.yaml" % i), "w") as fd:
+            fd.write(MAPPING % (i, i, i))
+
+    port = free_port()
+    diagd = subprocess.Popen([ sys.executable, "-c", DIAGD, prefix, "--no-checks", "--server", "aiohttp",
+                               "--workers", "2", "--host", "127.0.0.1", "--port", str(port) ],
+                             cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    loader = None
+
+    try:
+        wait_for_server(port)
+
+        # The overview goes through the WSGI bridge, unfiltered and in full.
+        status, body = get(port, "/ambassador/v0/diag/?json=true")
+        assert status == 200
+        assert len(json.loads(body.decode("utf-8"))["routes"]) > 200
+
+        status, body = get(port, "/ambassador/v0/diag/?json=true&limit=5")
+        assert len(json.loads(body.decode("utf-8"))["routes"]) == 5
+
+        # Now hammer the overview from more clients than diagd has workers.
+        loader = subprocess.Popen([ sys.executable, "-c", LOADER, str(port), "4" ],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        time.sleep(1)
+
+        for i in range(20):
+            # (Alive or not, there's no Envoy here.)
+            assert get(port, "/ambassador/v0/check_alive")[0] in [ 200, 503 ]
+
+        loader.kill()
+        statuses = [ int(line) for line in loader.stdout.read().decode("utf-8").split() ]
+
+        assert statuses.count(200) > 0
+        assert set(statuses) <= { 200, 503 }
+    finally:
+        if loader:
+            loader.kill()
+
+        diagd.terminate()
+        diagd.wait(10)
+
+BIG = [ b"%05d" % i * 100 for i in range(2000) ]
+
+def blocker_app(release):
+    """
+    A Flask app with a page that doesn't finish until release exists, and a
+    big streamed one.
+    """
+
+    flask_app = Flask("blocker")
+    flask_app.estats = EnvoyStats()
+
+    @flask_app.route('/block')
+    def block():
+        while not os.path.exists(release):
+            time.sleep(0.01)
+
+        return "done"
+
+    @flask_app.route('/big')
+    def big():
+        return Response(iter(BIG), mimetype="application/octet-stream")
+
+    return flask_app
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+def test_probes_with_busy_workers(tmpdir, loop, monkeypatch):
+    release = str(tmpdir.join("release"))
+    spool_dir = tmpdir.mkdir("spool")
+
+    # The worker is forked with these.
+    monkeypatch.setattr(tempfile, "tempdir", str(spool_dir))
+
+    server = AsyncDiagServer(blocker_app(release), workers=1, max_pending=2, loop=loop)
+    client = test_utils.TestClient(test_utils.TestServer(server.make_app(), loop=loop), loop=loop)
+
+    async def until(done):
+        for i in range(1000):
+            if done():
+                return
+
+            await asyncio.sleep(0.01)
+
+        assert done()
+
+    async def check():
+        await client.start_server()
+
+        try:
+            # Tie up the only worker, and fill the queue behind it.
+            blocked = [ loop.create_task(client.get("/block")) ]
+            await until(lambda: server.pending == 1)
+            blocked.append(loop.create_task(client.get("/block")))
+            await until(lambda: server.pending == 2)
+
+            # The probes are still answered, from the event loop...
+            for path in [ "/ambassador/v0/check_alive", "/ambassador/v0/check_ready" ]:
+                response = await client.get(path)
+                assert response.status in [ 200, 503 ]
+                assert "ambassador" in await response.text()
+
+            # ...while anything else is turned away.
+            response = await client.get("/block")
+            assert response.status == 503
+            assert server.rejected == 1
+
+            assert not any(task.done() for task in blocked)
+
+            with open(release, "w") as fd:
+                fd.write("go")
+
+            for task in blocked:
+                response = await task
+                assert response.status == 200
+                assert await response.text() == "done"
+
+            # A big response comes back through a spool file, which is
+            # cleaned up afterward.
+            response = await client.get("/big")
+            assert response.status == 200
+            assert await response.read() == b"".join(BIG)
+            assert spool_dir.listdir() == []
+        finally:
+            await client.close()
+
+    try:
+        loop.run_until_complete(check())
+    finally:
+        server.executor.shutdown()
+
+class FakeApp (object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.estats = EnvoyStats()
+
+    def __call__(self, environ, start_response):
+        start_response("200 OK", [ ("Content-Type", "text/plain") ])
+        return iter(self.chunks)
+
+def test_run_wsgi_spools(tmpdir, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmpdir))
+    monkeypatch.setattr(aserver, "SPOOL_SIZE", 10)
+    monkeypatch.setattr(aserver, "worker_pid", None)
+
+    monkeypatch.setattr(aserver, "wsgi_app", FakeApp([ b"small" ]))
+    assert aserver.run_wsgi({}, b"") == ("200 OK", [ ("Content-Type", "text/plain") ], b"small", None)
+
+    monkeypatch.setattr(aserver, "wsgi_app", FakeApp([ b"0123456789" ] * 5))
+    status, headers, data, path = aserver.run_wsgi({}, b"")
+
+    assert data is None
+
+    with open(path, "rb") as fd:
+        assert fd.read() == b"0123456789" * 5
+
+    os.unlink(path)
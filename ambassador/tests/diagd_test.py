@@ -0,0 +1,391 @@
+import gzip
+import json
+import os
+import re
+import threading
+
+from ambassador.generations import GenerationManifest
+from ambassador_diag.diagd import ConfigCache, create_diag_app
+from ambassador_diag.envoy import EnvoyAdminClient
+
+MAPPING = """---
+apiVersion: ambassador/v0
+kind: Mapping
+name: %s
+prefix: /%s/
+service: %s
+"""
+
+def write_config(config_dir, name):
+    os.makedirs(config_dir, exist_ok=True)
+
+    with open(os.path.join(config_dir, "%s.yaml" % name), "w") as fd:
+        fd.write(MAPPING % (name, name, name))
+
+def test_config_cache(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+    write_config(prefix, "base")
+
+    cache = ConfigCache(prefix)
+
+    # No manifest yet: everyone shares one Config from the base directory.
+    results = []
+    threads = [ threading.Thread(target=lambda: results.append(cache.get())) for i in range(4) ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert cache.builds == 1
+    assert len(set(id(config) for key, config in results)) == 1
+    assert results[0][0][0] == prefix
+
+    # A new generation means a new Config.
+    write_config("%s-1" % prefix, "one")
+    GenerationManifest(prefix).add(1, "%s-1" % prefix, "/tmp/envoy-1.json")
+
+    key, config = cache.get()
+
+    assert cache.builds == 2
+    assert key[0] == "%s-1" % prefix
+    assert "one.yaml" in config.source_map
+
+    assert cache.get()[1] is config
+    assert cache.builds == 2
+
+def test_overview_conditional(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+    write_config(prefix, "base")
+
+    client = create_diag_app(prefix).test_client()
+
+    r = client.get("/ambassador/v0/diag/?json=true", headers={ "Accept-Encoding": "gzip" })
+
+    assert r.status_code == 200
+    assert r.headers["Content-Encoding"] == "gzip"
+
+    overview = json.loads(gzip.decompress(r.data).decode("utf-8"))
+
+    assert "/base/" in [ route["prefix"] for route in overview["routes"] ]
+    assert overview["cluster_stats"]["cluster_base"]["health"] == "no stats yet"
+
+    etag = r.headers["ETag"]
+
+    r = client.get("/ambassador/v0/diag/?json=true", headers={ "If-None-Match": etag })
+    assert r.status_code == 304
+    assert not r.data
+
+    # A new generation changes the ETag.
+    write_config("%s-1" % prefix, "one")
+    GenerationManifest(prefix).add(1, "%s-1" % prefix, "/tmp/envoy-1.json")
+
+    r = client.get("/ambassador/v0/diag/?json=true", headers={ "If-None-Match": etag })
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+    assert "/one/" in [ route["prefix"] for route in json.loads(r.data.decode("utf-8"))["routes"] ]
+
+def test_overview_etag_follows_health(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+    write_config(prefix, "base")
+
+    app = create_diag_app(prefix)
+    client = app.test_client()
+
+    latency = "P0(1,1) P25(2,2) P50(%d,%d) P75(4,4) P90(5,5) P95(6,6) P99(7,7) P99.9(8,8) P100(8,8)"
+
+    def poll(errors=0, p50=3):
+        app.estats.admin = EnvoyAdminClient(FakeTransport("\n".join([
+            "cluster.cluster_base.upstream_rq_pending_total: 100",
+            "cluster.cluster_base.upstream_rq_5xx: %d" % errors,
+            "http.ingress_http.downstream_rq_time: %s" % (latency % (p50, p50))
+        ])))
+        app.estats.update_envoy_stats(0)
+
+    # The JSON overview shows cluster health; the HTML one doesn't (its
+    # route table comes separately), but it does show request latency.
+    for url, change in [ ("/ambassador/v0/diag/?json=true&prefix=/base/", dict(errors=50)),
+                         ("/ambassador/v0/diag/", dict(p50=4)) ]:
+        poll()
+        etag = client.get(url).headers["ETag"]
+
+        # Polling again changes last_update, but nothing we show...
+        poll()
+        r = client.get(url, headers={ "If-None-Match": etag })
+        assert r.status_code == 304
+
+        # ...until something we show changes.
+        poll(**change)
+        r = client.get(url, headers={ "If-None-Match": etag })
+        assert r.status_code == 200
+        assert r.headers["ETag"] != etag
+
+def test_overview_filters(tmpdir, monkeypatch):
+    prefix = str(tmpdir.join("ambassador-config"))
+
+    for name in [ "alpha", "beta", "gamma" ]:
+        write_config(prefix, name)
+
+    client = create_diag_app(prefix).test_client()
+
+    def overview(query):
+        r = client.get("/ambassador/v0/diag/?json=true&%s" % query)
+        assert r.status_code == 200
+        return json.loads(r.data.decode("utf-8"))
+
+    page = overview("prefix=/beta")
+    assert [ route["prefix"] for route in page["routes"] ] == [ "/beta/" ]
+    assert [ cluster["name"] for cluster in page["clusters"] ] == [ "cluster_beta" ]
+    assert [ source["filename"] for source in page["sources"] ] == [ "beta.yaml" ]
+    assert page["route_info"][0]["prefix"] == "/beta/"
+
+    page = overview("source=gamma.yaml")
+    assert [ route["prefix"] for route in page["routes"] ] == [ "/gamma/" ]
+
+    page = overview("errors=true")
+    assert page["pagination"]["total"] == { "routes": 0, "clusters": 0, "sources": 0 }
+
+    # Page through the mappings' routes, streaming the responses.
+    monkeypatch.setattr("ambassador_diag.diagd.STREAM_THRESHOLD", 0)
+
+    prefixes = []
+
+    for offset in range(0, 10, 2):
+        page = overview("cluster=cluster_alpha&offset=%d&limit=2" % offset)
+        prefixes.extend(route["prefix"] for route in page["routes"])
+
+        page = overview("prefix=/&offset=%d&limit=2" % offset)
+        assert len(page["routes"]) == len(page["route_info"])
+        prefixes.extend(route["prefix"] for route in page["routes"] if route["prefix"] in [ "/beta/", "/gamma/" ])
+
+    assert sorted(prefixes) == [ "/alpha/", "/beta/", "/gamma/" ]
+
+    assert client.get("/ambassador/v0/diag/?json=true&offset=-1").status_code == 400
+
+ENVOY_STATS = """cluster.cluster_qotm.membership_healthy: 1
+cluster.cluster_qotm.membership_total: 1
+cluster.cluster_qotm.update_attempt: 4
+cluster.cluster_qotm.update_success: 4
+cluster.cluster_qotm.upstream_rq_200: 7
+cluster.cluster_qotm.upstream_rq_2xx: 7
+cluster.cluster_qotm.upstream_rq_pending_total: 7
+http.ingress_http.downstream_cx_active: 2
+vhost.backend.vcluster.qotm.upstream_rq_2xx: 5
+vhost.backend.vcluster.qotm_post.upstream_rq_503: 1
+vhost.backend.vcluster.other.upstream_rq_2xx: 2
+listener.0.0.0.0_80.downstream_cx_total: 9
+server.uptime: 42
+tcp.mongo.downstream_cx_total: 3
+runtime.load_success: 1
+cluster.cluster_qotm.upstream_rq_time: P0(nan,0) P25(nan,0)
+"""
+
+class FakeTransport (object):
+    def __init__(self, text):
+        self.text = text
+
+    def request(self, method, path, params=None):
+        return 200, self.text
+
+def test_metrics(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+    write_config(prefix, "base")
+
+    app = create_diag_app(prefix)
+    client = app.test_client()
+
+    app.estats.admin = EnvoyAdminClient(FakeTransport(ENVOY_STATS))
+    app.estats.update_envoy_stats(0)
+
+    # Scrapes don't talk to Envoy; they see what the last poll saw.
+    app.estats.admin = None
+
+    r = client.get("/metrics")
+
+    assert r.status_code == 200
+    assert r.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+
+    lines = r.data.decode("utf-8").split("\n")
+
+    assert "# TYPE envoy_cluster_upstream_rq counter" in lines
+    assert 'envoy_cluster_upstream_rq{envoy_cluster_name="cluster_qotm",envoy_response_code="200"} 7' in lines
+    assert 'envoy_cluster_upstream_rq_xx{envoy_cluster_name="cluster_qotm",envoy_response_code_class="2"} 7' in lines
+    assert "# TYPE envoy_vhost_vcluster_upstream_rq_xx counter" in lines
+    assert ('envoy_vhost_vcluster_upstream_rq_xx{envoy_response_code_class="2",envoy_virtual_cluster_name="qotm",'
+            'envoy_virtual_host_name="backend"} 5') in lines
+    assert ('envoy_vhost_vcluster_upstream_rq_xx{envoy_response_code_class="2",envoy_virtual_cluster_name="other",'
+            'envoy_virtual_host_name="backend"} 2') in lines
+    assert ('envoy_vhost_vcluster_upstream_rq{envoy_response_code="503",envoy_virtual_cluster_name="qotm_post",'
+            'envoy_virtual_host_name="backend"} 1') in lines
+    assert "# TYPE envoy_cluster_membership_healthy gauge" in lines
+    assert "# TYPE envoy_http_downstream_cx_active gauge" in lines
+    assert "ambassador_diagd_envoy_stats_update_errors 0" in lines
+
+    # Listener, server, and TCP proxy stats are there too...
+    assert 'envoy_listener_downstream_cx_total{envoy_listener_address="0.0.0.0_80"} 9' in lines
+    assert "envoy_server_uptime 42" in lines
+    assert 'envoy_tcp_downstream_cx_total{envoy_tcp_prefix="mongo"} 3' in lines
+
+    # ...but not the ones diagd doesn't poll for.
+    assert not [ line for line in lines if line.startswith("envoy_runtime_") ]
+
+    # Histograms aren't exported (yet).
+    assert not [ line for line in lines if "upstream_rq_time" in line ]
+
+def test_overview_latency(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+    write_config(prefix, "base")
+
+    app = create_diag_app(prefix)
+    client = app.test_client()
+
+    latency = "P0(1,1) P25(2,2) P50(3,3) P75(4,4) P90(5,5) P95(6,6) P99(7,7) P99.9(8,8) P100(8,8)"
+    app.estats.admin = EnvoyAdminClient(FakeTransport("\n".join([
+        "cluster.cluster_base.membership_total: 1",
+        "cluster.cluster_base.upstream_rq_time: %s" % latency,
+        "http.ingress_http.downstream_rq_time: %s" % latency
+    ])))
+    app.estats.update_envoy_stats(0)
+
+    overview = json.loads(client.get("/ambassador/v0/diag/?json=true&prefix=/base/").data.decode("utf-8"))
+
+    assert overview["cluster_stats"]["cluster_base"]["latency"]["p99"] == 7.0
+    assert overview["envoy_status"]["downstream_latency"]["ingress_http"]["p50"] == 3.0
+    assert list(overview["route_info"][0]["clusters"].values())[0]["_latency"]["p90"] == 5.0
+
+    r = client.get("/ambassador/v0/diag/")
+    assert r.status_code == 200
+    assert b"p50 3.0ms, p90 5.0ms, p95 6.0ms, p99 7.0ms" in r.data
+
+    r = client.get("/ambassador/v0/diag/base.yaml")
+    assert r.status_code == 200
+    assert b"Latency p50 3.0ms" in r.data
+
+VIRTUAL_CLUSTERS = """---
+apiVersion: ambassador/v0
+kind: Module
+name: ambassador
+config:
+  virtual_clusters: true
+---
+apiVersion: ambassador/v0
+kind: Mapping
+name: qotm.list
+prefix: /qotm/
+service: qotm
+---
+apiVersion: ambassador/v0
+kind: Mapping
+name: qotm_post
+prefix: /qotm/quote/
+method: POST
+service: qotm
+---
+apiVersion: ambassador/v0
+kind: Mapping
+name: qotm_id
+prefix: "/qotm/[0-9]+"
+prefix_regex: true
+service: qotm
+"""
+
+def test_virtual_clusters(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+    os.makedirs(prefix)
+
+    with open(os.path.join(prefix, "qotm.yaml"), "w") as fd:
+        fd.write(VIRTUAL_CLUSTERS)
+
+    app = create_diag_app(prefix)
+    client = app.test_client()
+
+    config = app.config_cache.get()[1]
+    vclusters = { vcluster["name"]: vcluster for vcluster in config.envoy_config["virtual_clusters"] }
+
+    assert sorted(vclusters.keys()) == [ "qotm_id", "qotm_list", "qotm_post" ]
+    assert vclusters["qotm_list"]["pattern"] == "/qotm/.*"
+    assert "method" not in vclusters["qotm_list"]
+    assert vclusters["qotm_post"]["pattern"] == "/qotm/quote/.*"
+    assert vclusters["qotm_post"]["method"] == "POST"
+    assert vclusters["qotm_id"]["pattern"] == "(?:/qotm/[0-9]+)(?:\\?.*)?"
+
+    # Same order as the routes, since Envoy takes the first match.
+    assert [ vcluster["name"] for vcluster in config.envoy_config["virtual_clusters"] ] == \
+           [ route["_virtual_cluster"] for route in config.envoy_config["routes"] if "_virtual_cluster" in route ]
+
+    envoy_vhost = json.loads(config.to_json())["listeners"][0]["filters"][0]["config"]["route_config"]["virtual_hosts"][0]
+    assert { "method": "POST", "pattern": "/qotm/quote/.*", "name": "qotm_post" } in envoy_vhost["virtual_clusters"]
+
+    app.estats.admin = EnvoyAdminClient(FakeTransport("\n".join([
+        "cluster.cluster_qotm.membership_total: 1",
+        "vhost.backend.vcluster.qotm_post.upstream_rq_2xx: 3",
+        "vhost.backend.vcluster.qotm_post.upstream_rq_5xx: 1"
+    ])))
+    app.estats.update_envoy_stats(0)
+
+    overview = json.loads(client.get("/ambassador/v0/diag/?json=true").data.decode("utf-8"))
+    mapping_stats = { route["prefix"]: route["mapping_stats"] for route in overview["route_info"] }
+    sources = { route["prefix"]: route["_source"] for route in overview["route_info"] }
+
+    assert mapping_stats["/qotm/quote/"]["upstream_total"] == 4
+    assert mapping_stats["/qotm/quote/"]["upstream_5xx"] == 1
+    assert mapping_stats["/qotm/"] is None
+
+    r = client.get("/ambassador/v0/diag/%s" % sources["/qotm/quote/"])
+    assert r.status_code == 200
+    assert b"requests: 4, 5xx: 1" in r.data
+
+def test_virtual_clusters_case(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+    os.makedirs(prefix)
+
+    with open(os.path.join(prefix, "qotm.yaml"), "w") as fd:
+        fd.write(VIRTUAL_CLUSTERS)
+        fd.write("""---
+apiVersion: ambassador/v0
+kind: Mapping
+name: ci
+prefix: /CI/v1.0/
+case_sensitive: false
+service: ci
+""")
+
+    config = create_diag_app(prefix).config_cache.get()[1]
+    vclusters = { vcluster["name"]: vcluster for vcluster in config.envoy_config["virtual_clusters"] }
+
+    # Envoy matches the route case-sensitively (it never sees
+    # case_sensitive: false), so the virtual cluster does too.
+    pattern = vclusters["ci"]["pattern"]
+    assert pattern == "/CI/v1\\.0/.*"
+    assert re.fullmatch(pattern, "/CI/v1.0/build?x=1")
+    assert not re.fullmatch(pattern, "/ci/v1.0/")
+
+def test_route_lookup(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+    write_config(prefix, "alpha")
+
+    with open(os.path.join(prefix, "beta.yaml"), "w") as fd:
+        fd.write(MAPPING % ("beta", "beta", "beta") + "method: POST\n")
+
+    client = create_diag_app(prefix).test_client()
+
+    def lookup(query):
+        r = client.get("/ambassador/v0/diag/route?%s" % query)
+        return r.status_code, json.loads(r.data.decode("utf-8")) if r.status_code == 200 else None
+
+    status, result = lookup("path=/alpha/foo")
+    assert status == 200
+    assert result["route"]["prefix"] == "/alpha/"
+    assert result["depth"] == result["index"] + 1
+
+    assert lookup("path=/beta/")[1]["route"] is None
+    assert lookup("path=/beta/&method=POST")[1]["route"]["prefix"] == "/beta/"
+
+    status, result = lookup("path=/nowhere&header=X-Foo:%20bar")
+    assert result["route"] is None
+    assert result["depth"] == result["route_count"]
+    assert result["request"]["headers"] == { "x-foo": "bar" }
+
+    assert lookup("method=GET")[0] == 400
+    assert lookup("path=/&header=nocolon")[0] == 400
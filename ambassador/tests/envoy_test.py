@@ -0,0 +1,342 @@
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from ambassador_diag.envoy import EnvoyAdminClient, EnvoyStats, RequestsTransport
+from ambassador_diag.history import StatsHistory
+
+STATS = "\n".join([ "cluster.cluster_%d.%s: %d" % (i, name, value)
+                    for i in range(50)
+                    for name, value in [ ("membership_healthy", 1), ("membership_total", 1),
+                                         ("update_attempt", 3), ("update_success", 3),
+                                         ("upstream_rq_pending_total", 10), ("upstream_rq_5xx", 1) ] ] +
+                  [ "http.ingress_http.downstream_rq_total: %d" % i for i in range(500) ] +
+                  [ "server.uptime: 10", "runtime.load_success: 1" ]) + "\n"
+
+class FakeTransport (object):
+    def __init__(self, text):
+        self.text = text
+
+    def request(self, method, path, params=None):
+        return 200, self.text
+
+class FakeAdminServer (ThreadingMixIn, HTTPServer):
+    """
+    Just enough of Envoy's admin API for EnvoyStats, counting connections
+    and the filters it's asked for. Set honor_filter to act like an Envoy
+    that supports /stats?filter=.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, honor_filter=False):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeAdminHandler)
+        self.honor_filter = honor_filter
+        self.connections = 0
+        self.filters = []
+
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class FakeAdminHandler (BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Send headers and body together, like Envoy does, rather than tripping
+    # over Nagle and delayed ACKs on a kept-alive connection.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def reply(self, status, text):
+        body = text.encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        text = STATS
+
+        if url.path != "/stats":
+            return self.reply(404, "not found")
+
+        stat_filter = parse_qs(url.query).get("filter", [ None ])[0]
+        self.server.filters.append(stat_filter)
+
+        if stat_filter and self.server.honor_filter:
+            text = "".join(line + "\n" for line in STATS.split("\n") if re.match(stat_filter, line))
+
+        self.reply(200, text)
+
+    def do_POST(self):
+        self.reply(404, "active loggers:\n  admin: info\n  upstream: info\n")
+
+    def log_message(self, format, *args):
+        pass
+
+def test_admin_client_keepalive():
+    for honor_filter in [ False, True ]:
+        server = FakeAdminServer(honor_filter=honor_filter).start()
+
+        try:
+            estats = EnvoyStats(admin=EnvoyAdminClient(RequestsTransport(base_url=server.url())))
+
+            for i in range(5):
+                estats.update()
+
+            # One connection for all ten requests, with the stats filtered one
+            # way or the other.
+            assert server.connections == 1
+            assert server.filters == [ "^(cluster\\.|cluster_manager\\.|http\\.|listener\\.|listener_manager\\.|"
+                                       "server\\.|tcp\\.|vhost\\.)" ] * 5
+            assert estats.stats["update_errors"] == 0
+            assert estats.loginfo == { "all": "info" }
+            assert set(estats.stats["envoy"].keys()) == { "cluster", "http", "server" }
+            assert estats.cluster_stats("cluster_7")["healthy_percent"] == 90
+
+            # Everything's still there when it's asked for.
+            assert "runtime.load_success" not in estats.stats["flat"]
+            assert estats.all_stats()["runtime.load_success"] == 1
+        finally:
+            server.shutdown()
+            server.server_close()
+
+def test_admin_client_errors():
+    server = FakeAdminServer().start()
+    server.shutdown()
+    server.server_close()
+
+    estats = EnvoyStats(admin=EnvoyAdminClient(RequestsTransport(base_url=server.url(), timeout=0.5)))
+    estats.update()
+
+    assert estats.stats["update_errors"] == 2
+    assert estats.stats["last_update"] == 0
+    assert estats.all_stats() == {}
+
+def test_admin_client_pooling():
+    server = FakeAdminServer(honor_filter=True).start()
+
+    try:
+        # Without the client, every poll is a new connection...
+        for i in range(10):
+            requests.get(server.url() + "/stats").text
+
+        assert server.connections == 10
+
+        # ...and with it, they all share one, and get only what they asked for.
+        client = EnvoyAdminClient(RequestsTransport(base_url=server.url()))
+
+        for i in range(10):
+            text = client.stats([ "cluster." ])
+
+        assert server.connections == 11
+        assert server.filters == [ None ] * 10 + [ "^(cluster\\.)" ] * 10
+        assert "http.ingress_http" not in text
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_parse_stats():
+    text = "\n".join([
+        "cluster.cluster_qotm.membership_healthy: 2",
+        "cluster.cluster_qotm.membership_total: 3",
+        "cluster.cluster_qotm.upstream_rq_pending_total: 20",
+        "cluster.cluster_qotm.upstream_rq_5xx: 5",
+        "cluster.cluster_qotm.upstream_rq_time: P0(nan,0) P25(nan,0) P50(nan,0)",
+        "cluster.cluster_qotm.outlier_detection.ejections_active: 0",
+        "http.admin.downstream_rq_total: 12",
+        "runtime.load_success: 1"
+    ]) + "\n"
+
+    estats = EnvoyStats(admin=EnvoyAdminClient(FakeTransport(text)))
+    estats.update_envoy_stats(0)
+
+    # Only the clusters are parsed up front...
+    assert estats.stats["clusters"]["cluster_qotm"]["healthy_percent"] == 75
+    assert estats.stats["clusters"]["cluster_qotm"]["total_members"] == 3
+    assert "flat" not in estats.stats
+    assert "envoy" not in estats.stats
+
+    # ...and the rest on demand, filtered like the poll.
+    assert estats.stats["flat"] == {
+        "cluster.cluster_qotm.membership_healthy": 2,
+        "cluster.cluster_qotm.membership_total": 3,
+        "cluster.cluster_qotm.upstream_rq_pending_total": 20,
+        "cluster.cluster_qotm.upstream_rq_5xx": 5,
+        "cluster.cluster_qotm.outlier_detection.ejections_active": 0,
+        "http.admin.downstream_rq_total": 12
+    }
+
+    envoy = estats.stats["envoy"]
+    assert envoy["cluster"]["cluster_qotm"]["outlier_detection"] == { "ejections_active": 0 }
+    assert "runtime" not in envoy
+
+    # A new update throws the old parsed stats away.
+    estats.admin.transport.text = text.replace("upstream_rq_5xx: 5", "upstream_rq_5xx: 10")
+    estats.update_envoy_stats(0)
+
+    assert estats.stats["clusters"]["cluster_qotm"]["healthy_percent"] == 50
+    assert estats.stats["envoy"]["cluster"]["cluster_qotm"]["upstream_rq_5xx"] == 10
+
+    assert estats.all_stats()["runtime.load_success"] == 1
+
+def test_cluster_history():
+    history = StatsHistory(size=8)
+    requests, errors = 0, 0
+
+    # A healthy cluster for a while, polled every 5 seconds...
+    for i in range(4):
+        history.record({ "cluster_qotm": { "upstream_total": requests, "upstream_5xx": errors } }, when=i * 5.0)
+        requests += 100
+
+    rates = history.get("cluster_qotm").rates()
+    assert rates["1m"]["request_rate"] == 20.0
+    assert rates["1m"]["success_percent"] == 100
+
+    # ...then Envoy restarts, and the cluster starts failing.
+    requests = 0
+
+    for i in range(4, 12):
+        history.record({ "cluster_qotm": { "upstream_total": requests, "upstream_5xx": requests // 2 } }, when=i * 5.0)
+        requests += 100
+
+    cluster = history.get("cluster_qotm")
+    rates = cluster.rates()
+
+    # Only the last 8 samples are left, and the restart didn't count as
+    # negative requests.
+    assert rates["1m"]["seconds"] == 35
+    assert rates["1m"]["requests"] == 700
+    assert rates["1m"]["success_percent"] == 50
+    assert len(cluster.sparkline()) == 7
+    assert cluster.sparkline()[-1][1:] == [ 20.0, 10.0 ]
+
+    assert history.get("cluster_qotm").window(1) is None
+
+    history.record({})
+    assert history.get("cluster_qotm") is None
+
+LATENCY = "P0(1,1) P25(2,2.05) P50(4,10.5) P75(8,20) P90(9,48) P95(10,49.5) P99(11,51) P99.9(12,51) P100(12,51)"
+
+def test_latency():
+    text = "\n".join([
+        "cluster.cluster_qotm.membership_total: 1",
+        "cluster.cluster_qotm.upstream_rq_time: %s" % LATENCY,
+        "cluster.cluster_idle.membership_total: 1",
+        "cluster.cluster_idle.upstream_rq_time: No recorded values",
+        "cluster.cluster_quiet.membership_total: 1",
+        "cluster.cluster_quiet.upstream_rq_time: P0(nan,1) P25(nan,2) P50(nan,3) P75(nan,4) P90(nan,5) P95(nan,6) P99(nan,7) P99.9(nan,8) P100(nan,8)",
+        "http.ingress_http.downstream_rq_time: %s" % LATENCY,
+        "http.admin.downstream_rq_time: P0(nan,nan) P25(nan,nan) P50(nan,nan) P75(nan,nan) P90(nan,nan) P95(nan,nan) P99(nan,nan) P99.9(nan,nan) P100(nan,nan)"
+    ]) + "\n"
+
+    estats = EnvoyStats(admin=EnvoyAdminClient(FakeTransport(text)))
+    estats.update_envoy_stats(0)
+
+    latency = estats.cluster_stats("cluster_qotm")["latency"]
+    assert latency == { "p50": 10.5, "p90": 48.0, "p95": 49.5, "p99": 51.0,
+                        "recent": { "p50": 4.0, "p90": 9.0, "p95": 10.0, "p99": 11.0 } }
+
+    assert "latency" not in estats.cluster_stats("cluster_idle")
+
+    # No requests since the last flush.
+    assert estats.cluster_stats("cluster_quiet")["latency"] == { "p50": 3.0, "p90": 5.0, "p95": 6.0, "p99": 7.0,
+                                                                  "recent": None }
+    assert estats.stats["downstream_latency"] == { "ingress_http": latency }
+
+def test_virtual_cluster_stats():
+    text = "\n".join([
+        "vhost.backend.vcluster.qotm_mapping.upstream_rq_200: 90",
+        "vhost.backend.vcluster.qotm_mapping.upstream_rq_2xx: 90",
+        "vhost.backend.vcluster.qotm_mapping.upstream_rq_404: 4",
+        "vhost.backend.vcluster.qotm_mapping.upstream_rq_4xx: 4",
+        "vhost.backend.vcluster.qotm_mapping.upstream_rq_503: 6",
+        "vhost.backend.vcluster.qotm_mapping.upstream_rq_5xx: 6",
+        "vhost.backend.vcluster.qotm_mapping.upstream_rq_time: %s" % LATENCY,
+        "vhost.backend.vcluster.other.upstream_rq_2xx: 1000",
+    ]) + "\n"
+
+    estats = EnvoyStats(admin=EnvoyAdminClient(FakeTransport(text)))
+    estats.update_envoy_stats(0)
+
+    vcstat = estats.virtual_cluster_stats("qotm_mapping")
+
+    assert vcstat["upstream_total"] == 100
+    assert vcstat["upstream_4xx"] == 4
+    assert vcstat["upstream_5xx"] == 6
+    assert vcstat["latency"]["p99"] == 51.0
+    assert vcstat["rates"]["5m"] is None
+
+    # Envoy's catch-all isn't any Mapping's.
+    assert estats.virtual_cluster_stats("other") is None
+    assert estats.virtual_cluster_stats("missing") is None
+
+    estats.vcluster_history.get("qotm_mapping").times[0] -= 10
+    estats.admin.transport.text = text.replace("upstream_rq_2xx: 90", "upstream_rq_2xx: 140")
+    estats.update_envoy_stats(0)
+
+    recent = estats.virtual_cluster_stats("qotm_mapping")["rates"]["5m"]
+    assert recent["requests"] == 50
+    assert recent["errors"] == 0
+    assert 4.5 < recent["request_rate"] <= 5.0
+
+def test_adaptive_polling():
+    transport = FakeTransport("cluster.cluster_qotm.membership_total: 1\n")
+    estats = EnvoyStats(admin=EnvoyAdminClient(transport))
+
+    def polls():
+        return estats.stats["stats_polls"], estats.stats["logging_polls"]
+
+    # The first tick always polls, including the log levels.
+    estats.tick()
+    estats.tick()
+    assert polls() == (1, 1)
+    assert estats.is_ready()
+
+    # Idle: poll every 10 seconds, and leave the log levels alone.
+    assert estats.poll_period() == 10
+
+    estats.last_poll -= 6
+    estats.tick()
+    assert polls() == (1, 1)
+
+    estats.last_poll -= 5
+    estats.tick()
+    assert polls() == (2, 1)
+
+    # Someone's looking: poll every 5 seconds, and recheck the log levels
+    # once they're a minute old.
+    estats.demand()
+    assert estats.poll_period() == 5
+
+    estats.last_poll -= 6
+    estats.tick()
+    assert polls() == (3, 1)
+
+    estats.last_poll -= 6
+    estats.loginfo_updated -= 60
+    estats.tick()
+    assert polls() == (4, 2)
+
+    # Setting a log level picks up the new levels.
+    assert estats.update_log_levels(0, level="debug")
+    assert polls() == (4, 3)
+
+    # No one's looked for a while.
+    estats.demanded -= 60
+    assert estats.poll_period() == 10
@@ -0,0 +1,195 @@
+import sys
+
+import json
+import os
+import subprocess
+
+from ambassador.generations import GenerationManifest, GenerationWriter, check_generation_dir, read_generation_index
+
+def make_generation(manifest, valid=True):
+    generation = manifest.next_generation()
+    config_dir = "%s-%d" % (manifest.config_dir_prefix, generation)
+    envoy_config = os.path.join(os.path.dirname(config_dir), "envoy-%d.json" % generation)
+
+    os.makedirs(config_dir)
+
+    with open(os.path.join(config_dir, "mapping.yaml"), "w") as fd:
+        fd.write("generation: %d\n" % generation)
+
+    with open(envoy_config, "w") as fd:
+        fd.write("{}")
+
+    return manifest.add(generation, config_dir, envoy_config, valid=valid)
+
+def test_manifest_roundtrip(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+
+    manifest = GenerationManifest(prefix, retain=5)
+    assert not manifest.load()
+    assert manifest.latest_config_dir() == prefix
+    assert manifest.latest_envoy_config() is None
+
+    for i in range(3):
+        make_generation(manifest)
+
+    reloaded = GenerationManifest(prefix)
+    assert reloaded.load()
+    assert reloaded.latest == 3
+    assert reloaded.last_generation == 3
+    assert reloaded.latest_config_dir() == "%s-3" % prefix
+    assert reloaded.latest_envoy_config() == str(tmpdir.join("envoy-3.json"))
+
+def test_manifest_compaction(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+
+    manifest = GenerationManifest(prefix, retain=3)
+
+    for i in range(7):
+        make_generation(manifest)
+
+    assert [ entry['generation'] for entry in manifest.generations ] == [ 5, 6, 7 ]
+
+    for generation in range(1, 5):
+        assert not os.path.exists("%s-%d" % (prefix, generation))
+        assert not os.path.exists(str(tmpdir.join("envoy-%d.json" % generation)))
+
+    for generation in range(5, 8):
+        assert os.path.isdir("%s-%d" % (prefix, generation))
+        assert os.path.exists(str(tmpdir.join("envoy-%d.json" % generation)))
+
+def test_manifest_keeps_latest_valid(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+
+    manifest = GenerationManifest(prefix, retain=2)
+
+    make_generation(manifest)
+
+    for i in range(4):
+        make_generation(manifest, valid=False)
+
+    # Generation 1 is the only valid one, so it must survive compaction even
+    # though it's the oldest.
+    assert manifest.latest == 1
+    assert manifest.last_generation == 5
+    assert [ entry['generation'] for entry in manifest.generations ] == [ 1, 5 ]
+    assert manifest.latest_config_dir() == "%s-1" % prefix
+
+def test_manifest_scan(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+
+    for generation in [ 1, 2, 10 ]:
+        os.makedirs("%s-%d" % (prefix, generation))
+
+    # Not generations.
+    os.makedirs("%s-bogus" % prefix)
+    tmpdir.join("ambassador-config-3-envoy.json").write("{}")
+
+    manifest = GenerationManifest(prefix)
+    manifest.scan()
+
+    assert [ entry['generation'] for entry in manifest.generations ] == [ 1, 2, 10 ]
+    assert manifest.last_generation == 10
+    assert manifest.latest_config_dir() == "%s-10" % prefix
+    assert manifest.latest_envoy_config() is None
+
+def test_manifest_scan_envoy_configs(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+
+    for generation in range(1, 6):
+        os.makedirs("%s-%d" % (prefix, generation))
+
+        # Generation 5 never got a valid Envoy config.
+        if generation < 5:
+            tmpdir.join("envoy-%d.json" % generation).write("{}")
+
+    manifest = GenerationManifest(prefix, retain=2)
+    manifest.scan()
+
+    assert manifest.generations[0]['envoy_config'] == str(tmpdir.join("envoy-1.json"))
+    assert manifest.latest == 4
+    assert manifest.latest_envoy_config() == str(tmpdir.join("envoy-4.json"))
+
+    # Compacting the scanned manifest cleans up the old Envoy configs too.
+    manifest.compact()
+
+    assert not tmpdir.join("envoy-1.json").exists()
+    assert not os.path.exists("%s-1" % prefix)
+    assert tmpdir.join("envoy-4.json").exists()
+
+def test_manifest_cli(tmpdir):
+    prefix = str(tmpdir.join("ambassador-config"))
+    cmd = [ sys.executable, "-m", "ambassador.generations", prefix ]
+
+    assert subprocess.run(cmd, stdout=subprocess.PIPE).returncode == 1
+
+    manifest = GenerationManifest(prefix)
+    make_generation(manifest)
+    make_generation(manifest)
+
+    result = subprocess.run(cmd, stdout=subprocess.PIPE)
+    assert result.returncode == 0
+    assert result.stdout.decode("utf-8").strip() == str(tmpdir.join("envoy-2.json"))
+
+    result = subprocess.run(cmd + [ "config_dir" ], stdout=subprocess.PIPE)
+    assert result.stdout.decode("utf-8").strip() == "%s-2" % prefix
+
+def test_writer_links_unchanged_inputs(tmpdir):
+    configs = {
+        "a.yaml": "---\nkind: Mapping\nname: a\n",
+        "b.yaml": "---\nkind: Mapping\nname: b\n",
+        "c.yaml": "---\nkind: Mapping\nname: c\n",
+    }
+
+    first = str(tmpdir.mkdir("ambassador-config-1"))
+    writer = GenerationWriter(None)
+    writer.write(first, configs)
+
+    assert writer.written == 3
+    assert writer.linked == 0
+    assert read_generation_index(first).keys() == configs.keys()
+
+    configs["b.yaml"] = "---\nkind: Mapping\nname: b\nprefix: /b/\n"
+    del(configs["c.yaml"])
+    configs["d.yaml"] = "---\nkind: Mapping\nname: d\n"
+
+    second = str(tmpdir.mkdir("ambassador-config-2"))
+    writer = GenerationWriter(first)
+    files = writer.write(second, configs)
+
+    assert writer.written == 2
+    assert writer.linked == 1
+    assert os.stat(os.path.join(first, "a.yaml")).st_ino == os.stat(os.path.join(second, "a.yaml")).st_ino
+    assert not os.path.exists(os.path.join(second, "c.yaml"))
+    assert check_generation_dir(second, files) == []
+
+    for name, config in configs.items():
+        assert open(os.path.join(second, name), "r").read() == config
+
+def test_writer_survives_missing_previous(tmpdir):
+    configs = { "a.yaml": "---\nkind: Mapping\nname: a\n" }
+
+    first = str(tmpdir.mkdir("ambassador-config-1"))
+    GenerationWriter(None).write(first, configs)
+
+    # The previous generation got compacted out from under us.
+    os.unlink(os.path.join(first, "a.yaml"))
+
+    second = str(tmpdir.mkdir("ambassador-config-2"))
+    writer = GenerationWriter(first)
+    writer.write(second, configs)
+
+    assert writer.written == 1
+    assert writer.linked == 0
+    assert open(os.path.join(second, "a.yaml"), "r").read() == configs["a.yaml"]
+
+def test_check_generation_dir(tmpdir):
+    configs = { "a.yaml": "---\nkind: Mapping\nname: a\n", "b.yaml": "---\nkind: Mapping\nname: b\n" }
+
+    output = str(tmpdir.mkdir("ambassador-config-1"))
+    files = GenerationWriter(None).write(output, configs)
+
+    tmpdir.join("ambassador-config-1", "a.yaml").write("truncated")
+    tmpdir.join("ambassador-config-1", "stray.yaml").write("---\n")
+    os.unlink(os.path.join(output, "b.yaml"))
+
+    assert check_generation_dir(output, files) == [ "stray.yaml", "a.yaml", "b.yaml" ]
@@ -0,0 +1,135 @@
+import sys
+
+import os
+import signal
+import socket
+import stat
+import subprocess
+import time
+
+from ambassador.generations import GenerationManifest
+from ambassador.hot_restart import restarter_status
+
+HOT_RESTARTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hot-restarter.py")
+
+# A stand-in for start-envoy.sh + envoy: on startup it shuts down the previous
+# epoch (like a real hot restart does), takes a moment to get going, and then
+# answers /server_info for its epoch.
+FAKE_ENVOY = """#!%s
+import http.server, os, signal, sys, time
+
+epoch = int(os.environ["RESTART_EPOCH"])
+pidfile = os.environ["FAKE_ENVOY_PIDFILE"]
+port = int(os.environ["FAKE_ENVOY_PORT"])
+
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+if epoch > 0:
+    os.kill(int(open(pidfile).read()), signal.SIGTERM)
+
+time.sleep(0.5)
+open(pidfile, "w").write(str(os.getpid()))
+
+class Handler (http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = ("envoy fake/1.7.0 live 1 1 %%d" %% epoch).encode("utf-8")
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+http.server.HTTPServer.allow_reuse_address = True
+
+for i in range(50):
+    try:
+        server = http.server.HTTPServer(("127.0.0.1", port), Handler)
+        break
+    except OSError:
+        time.sleep(0.1)
+
+server.serve_forever()
+"""
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for(sock, predicate, timeout=15):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        status = restarter_status(sock)
+
+        if status and predicate(status):
+            return status
+
+        time.sleep(0.1)
+
+    raise Exception("timed out; last status %s" % restarter_status(sock))
+
+def test_readiness_and_coalescing(tmpdir):
+    fake_envoy = str(tmpdir.join("fake-envoy.py"))
+
+    with open(fake_envoy, "w") as fd:
+        fd.write(FAKE_ENVOY % sys.executable)
+
+    os.chmod(fake_envoy, os.stat(fake_envoy).st_mode | stat.S_IEXEC)
+
+    prefix = str(tmpdir.join("ambassador-config"))
+    manifest = GenerationManifest(prefix)
+    manifest.add(3, "%s-3" % prefix, None, changed_at=time.time() - 1)
+
+    port = free_port()
+    sock = str(tmpdir.join("restarter.sock"))
+
+    env = dict(os.environ)
+    env.update({
+        "AMBASSADOR_CONFIG_DIR": prefix,
+        "AMBASSADOR_ADMIN_URL": "http://127.0.0.1:%d" % port,
+        "AMBASSADOR_RESTARTER_SOCKET": sock,
+        "AMBASSADOR_RESTARTER_STARTUP_TIME": "0",
+        "AMBASSADOR_SHUTDOWN_TIME": "1",
+        "FAKE_ENVOY_PIDFILE": str(tmpdir.join("envoy.pid")),
+        "FAKE_ENVOY_PORT": str(port)
+    })
+
+    restarter = subprocess.Popen([ sys.executable, HOT_RESTARTER, fake_envoy ], env=env,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        status = wait_for(sock, lambda status: status['ready'])
+
+        assert status['epoch'] == 0
+        assert status['state'] == 'stable'
+
+        first = status['history'][0]
+        assert first['generation'] == 3
+        assert first['startup_seconds'] >= 0.5
+        assert first['propagation_seconds'] >= first['startup_seconds'] + 1
+
+        manifest.add(4, "%s-4" % prefix, None, changed_at=time.time())
+
+        # The first SIGHUP starts epoch 1 right away; the rest arrive while
+        # it's starting, and collapse into a single restart after it's stable.
+        restarter.send_signal(signal.SIGHUP)
+        wait_for(sock, lambda status: status['epoch'] == 1)
+
+        # (Pending signals don't queue, so space them out a little.)
+        for i in range(3):
+            restarter.send_signal(signal.SIGHUP)
+            time.sleep(0.05)
+
+        status = wait_for(sock, lambda status: (status['epoch'] == 2) and status['ready'])
+
+        assert status['coalesced'] == 2
+        assert [ record['epoch'] for record in status['history'] ] == [ 0, 1, 2 ]
+        assert [ record['state'] for record in status['history'] ] == [ 'ready' ] * 3
+        assert [ record['generation'] for record in status['history'] ] == [ 3, 4, 4 ]
+    finally:
+        restarter.send_signal(signal.SIGTERM)
+        restarter.wait(timeout=10)
@@ -0,0 +1,662 @@
+import sys
+
+import asyncio
+import json
+import os
+import threading
+
+from types import SimpleNamespace
+
+import pytest
+
+from kubernetes.client.rest import ApiException
+
+import kubewatch
+
+from ambassador.leader import FileChannel, FileLock, make_snapshot
+from kubewatch import RestartPipeline, Restarter, ServiceWatcher, list_services, put_latest, watch_forever, \
+                      watched_namespaces
+
+def make_service(name, namespace, config=None):
+    annotations = { kubewatch.KEY: config } if config else None
+
+    return SimpleNamespace(metadata=SimpleNamespace(name=name, namespace=namespace, annotations=annotations))
+
+class FakeCoreV1 (object):
+    """
+    Just enough of CoreV1Api to list services, by namespace or everywhere.
+    """
+
+    def __init__(self, services):
+        self.services = services
+        self.listed = []
+        self.lock = threading.Lock()
+
+    def list_namespaced_service(self, namespace):
+        with self.lock:
+            self.listed.append(namespace)
+
+        return SimpleNamespace(items=[ svc for svc in self.services if svc.metadata.namespace == namespace ])
+
+    def list_service_for_all_namespaces(self):
+        with self.lock:
+            self.listed.append(None)
+
+        return SimpleNamespace(items=list(self.services))
+
+class FakeWatch (object):
+    """
+    A kubernetes.watch.Watch that streams a canned list of events.
+    """
+
+    events = []
+    streamed = None
+
+    def __init__(self):
+        self.stopped = False
+
+    def stream(self, func, **kwargs):
+        FakeWatch.streamed = (func.__name__, kwargs)
+        return iter(self.events)
+
+    def stop(self):
+        self.stopped = True
+
+MAPPING = """---
+apiVersion: ambassador/v0
+kind: Mapping
+name: %s
+prefix: /%s/
+service: %s
+"""
+
+# Stands in for envoy --mode validate: any config mentioning "invalid" is.
+FAKE_VALIDATE = """
+import sys
+config = open(sys.argv[1]).read()
+if "invalid" in config:
+    print("error initializing configuration '%s': invalid" % sys.argv[1])
+    sys.exit(1)
+print("configuration '%s' OK" % sys.argv[1])
+"""
+
+class FakeRestarter (Restarter):
+    """
+    A Restarter whose "Envoy config" is just its inputs as JSON, validated by
+    FAKE_VALIDATE, and which records what was on disk whenever it signals.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.signals = []
+        self.cert_dirs = []
+
+    def generate_config(self, generation, output, configs):
+        self.restart_count = generation
+        os.makedirs(output)
+
+        for name, config in configs.items():
+            with open(os.path.join(output, name), "w") as fd:
+                fd.write(config)
+
+        envoy_config = "%s-%s" % (output, "envoy.json")
+
+        with open(envoy_config, "w") as fd:
+            json.dump(configs, fd, sort_keys=True)
+
+        return envoy_config
+
+    def save_certs(self, output):
+        self.cert_dirs.append(output)
+
+    def validate_command(self, envoy_config):
+        return [ sys.executable, "-c", FAKE_VALIDATE, envoy_config ]
+
+    def signal(self):
+        latest = self.manifest.latest
+        self.signals.append((latest, os.path.exists(self.manifest.latest_envoy_config() or "")))
+        super().signal()
+
+    def envoy_configs(self):
+        return sorted(name for name in os.listdir(os.path.dirname(self.envoy_config_file))
+                      if name.startswith("envoy-"))
+
+class FakeClock (object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def make_restarter(tmpdir, cls=Restarter, **kwargs):
+    config_dir = tmpdir.join("config")
+    config_dir.ensure(dir=True)
+
+    return cls(str(config_dir), "ambassador", str(tmpdir.join("envoy.json")), 0, None, **kwargs)
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+def start_stages(pipeline, election=False):
+    """
+    Start the pipeline's stages (without any watches), plus its election
+    stage if asked.
+    """
+
+    stages = [ pipeline.generate_stage(), pipeline.validate_stage(), pipeline.restart_stage() ]
+
+    if election:
+        stages.append(pipeline.election_stage())
+
+    return [ pipeline.loop.create_task(stage) for stage in stages ]
+
+def wait_for(loop, done, timeout=10):
+    async def wait():
+        deadline = loop.time() + timeout
+
+        while not done():
+            assert loop.time() < deadline, "pipeline did not finish in time"
+            await asyncio.sleep(0.01)
+
+    loop.run_until_complete(wait())
+
+def stop_stages(loop, stages):
+    # The stages catch Exception, which (in Python 3.6) includes
+    # CancelledError, so a stage might need cancelling more than once.
+    while not all(stage.done() for stage in stages):
+        for stage in stages:
+            stage.cancel()
+
+        loop.run_until_complete(asyncio.wait(stages, timeout=0.1))
+
+def run_pipeline(pipeline, done, timeout=10):
+    """
+    Run the pipeline's stages until done() is true.
+    """
+
+    stages = start_stages(pipeline)
+
+    try:
+        wait_for(pipeline.loop, done, timeout=timeout)
+    finally:
+        stop_stages(pipeline.loop, stages)
+
+def test_watched_namespaces(monkeypatch):
+    restarter = SimpleNamespace(namespace="ambassador")
+
+    monkeypatch.delenv("AMBASSADOR_SINGLE_NAMESPACE", raising=False)
+    monkeypatch.delenv("AMBASSADOR_WATCH_NAMESPACES", raising=False)
+    assert watched_namespaces(restarter) is None
+
+    monkeypatch.setenv("AMBASSADOR_WATCH_NAMESPACES", "")
+    assert watched_namespaces(restarter) is None
+
+    monkeypatch.setenv("AMBASSADOR_WATCH_NAMESPACES", " , ")
+    assert watched_namespaces(restarter) is None
+
+    monkeypatch.setenv("AMBASSADOR_WATCH_NAMESPACES", "qotm")
+    assert watched_namespaces(restarter) == [ "qotm" ]
+
+    monkeypatch.setenv("AMBASSADOR_WATCH_NAMESPACES", "qotm, auth  billing,")
+    assert watched_namespaces(restarter) == [ "qotm", "auth", "billing" ]
+
+    # AMBASSADOR_SINGLE_NAMESPACE wins.
+    monkeypatch.setenv("AMBASSADOR_SINGLE_NAMESPACE", "true")
+    assert watched_namespaces(restarter) == [ "ambassador" ]
+
+def test_list_services():
+    services = [ make_service("svc%d" % i, "ns%d" % (i % 4)) for i in range(20) ]
+    v1 = FakeCoreV1(services)
+
+    # Everywhere is one call.
+    assert list_services(v1, None) == services
+    assert v1.listed == [ None ]
+
+    # Several namespaces get listed separately, and the results merged.
+    v1.listed = []
+    found = list_services(v1, [ "ns0", "ns2", "ns3", "nowhere" ])
+
+    assert sorted(v1.listed) == [ "nowhere", "ns0", "ns2", "ns3" ]
+    assert sorted(svc.metadata.name for svc in found) == \
+           sorted(svc.metadata.name for svc in services if svc.metadata.namespace != "ns1")
+    assert len(found) == 15
+
+    v1.listed = []
+    assert [ svc.metadata.name for svc in list_services(v1, [ "ns1" ]) ] == [ "svc1", "svc5", "svc9", "svc13", "svc17" ]
+    assert v1.listed == [ "ns1" ]
+
+def test_service_watcher(tmpdir, monkeypatch):
+    restarter = make_restarter(tmpdir)
+    poked = []
+    restarter.on_poke = lambda: poked.append(restarter.pokes)
+
+    qotm = make_service("qotm", "qotm", MAPPING % ("qotm", "qotm", "qotm"))
+    plain = make_service("plain", "qotm")
+
+    FakeWatch.events = [
+        { "type": "ADDED", "object": qotm },
+        { "type": "ADDED", "object": plain },
+        { "type": "MODIFIED", "object": qotm },
+        { "type": "DELETED", "object": qotm },
+    ]
+
+    v1 = FakeCoreV1([])
+    monkeypatch.setattr(kubewatch, "kube_v1", lambda: v1)
+    monkeypatch.setattr(kubewatch.watch, "Watch", FakeWatch)
+
+    watcher = ServiceWatcher(restarter, "qotm")
+    watcher.watch()
+    assert FakeWatch.streamed == ("list_namespaced_service", { "namespace": "qotm" })
+
+    # Adding qotm pokes; an unannotated service and an unchanged
+    # modification don't; deleting qotm pokes again.
+    assert poked == [ 1, 2 ]
+    assert "qotm-qotm.yaml" not in restarter.configs
+    assert restarter.changes() == 2
+
+    assert watcher.counters == { "ADDED": 2, "MODIFIED": 1, "DELETED": 1 }
+
+    # Watching everywhere uses the other API call.
+    FakeWatch.events = [ { "type": "ADDED", "object": qotm } ]
+    watcher = ServiceWatcher(restarter)
+    assert watcher.name == "watch-all"
+
+    watcher.watch()
+    assert FakeWatch.streamed == ("list_service_for_all_namespaces", {})
+    assert poked == [ 1, 2, 3 ]
+    assert "qotm-qotm.yaml" in restarter.configs
+
+def test_service_watcher_stops(tmpdir, monkeypatch):
+    restarter = make_restarter(tmpdir)
+    stopped = threading.Event()
+    stopped.set()
+
+    FakeWatch.events = [ { "type": "ADDED", "object": make_service("qotm", "qotm", MAPPING % ("q", "q", "q")) } ]
+
+    monkeypatch.setattr(kubewatch, "kube_v1", lambda: FakeCoreV1([]))
+    monkeypatch.setattr(kubewatch.watch, "Watch", FakeWatch)
+
+    # Once stopped, the watcher ignores whatever is still in the stream.
+    ServiceWatcher(restarter, "qotm", stopped=stopped).watch()
+    assert restarter.pokes == 0
+
+class ExpiredWatch (FakeWatch):
+    """
+    A Watch whose stream fails the way it does when our token has expired.
+    """
+
+    def stream(self, func, **kwargs):
+        raise ApiException(status=401, reason="Unauthorized")
+
+def test_service_watcher_reloads_credentials(tmpdir, monkeypatch):
+    restarter = make_restarter(tmpdir)
+    watcher = ServiceWatcher(restarter, "qotm", retry_delay=0)
+    resets = []
+
+    def reset():
+        resets.append(True)
+        watcher.stopped.set()
+
+    monkeypatch.setattr(kubewatch, "kube_v1", lambda: FakeCoreV1([]))
+    monkeypatch.setattr(kubewatch, "reset_kube_v1", reset)
+    monkeypatch.setattr(kubewatch.watch, "Watch", ExpiredWatch)
+
+    watcher.run()
+
+    assert resets == [ True ]
+    assert watcher.counters["errors"] == 1
+
+def test_watch_forever_reloads_credentials(monkeypatch):
+    stopped = threading.Event()
+    resets = []
+    errors = [ ApiException(status=403, reason="Forbidden"), ValueError("something else"),
+               ConnectionRefusedError() ]
+
+    def watch_loop(restarter, stopped):
+        error = errors.pop(0)
+
+        if not errors:
+            stopped.set()
+
+        raise error
+
+    monkeypatch.setattr(kubewatch, "watch_loop", watch_loop)
+    monkeypatch.setattr(kubewatch, "reset_kube_v1", lambda: resets.append(True))
+    monkeypatch.setattr(stopped, "wait", lambda timeout=None: stopped.is_set())
+
+    watch_forever(None, stopped)
+
+    # Auth and connection failures get a new client; anything else doesn't.
+    assert errors == []
+    assert resets == [ True, True ]
+
+def test_put_latest(loop):
+    queue = asyncio.Queue(maxsize=1)
+
+    assert put_latest(queue, 1) == []
+    assert put_latest(queue, 2) == [ 1 ]
+    assert queue.get_nowait() == 2
+    assert queue.empty()
+
+def test_snapshot_and_mark_processed(tmpdir):
+    restarter = make_restarter(tmpdir)
+
+    restarter.update("a.yaml", MAPPING % ("a", "a", "a"))
+    restarter.update("b.yaml", MAPPING % ("b", "b", "b"))
+
+    configs, pokes = restarter.snapshot()
+    assert sorted(configs.keys()) == [ "a.yaml", "b.yaml" ]
+    assert pokes == 2
+
+    # The snapshot is a copy.
+    restarter.update("c.yaml", MAPPING % ("c", "c", "c"))
+    assert "c.yaml" not in configs
+    assert restarter.changes() == 3
+
+    restarter.mark_processed(pokes)
+    assert restarter.changes() == 1
+    assert restarter.pending_since is not None
+
+    # Marking an older snapshot processed doesn't go backward.
+    restarter.mark_processed(1)
+    assert restarter.changes() == 1
+
+    restarter.mark_processed(3)
+    assert restarter.changes() == 0
+    assert restarter.pending_since is None
+    assert restarter.changed_at is None
+
+def test_pipeline_restart(tmpdir, loop):
+    restarter = make_restarter(tmpdir, cls=FakeRestarter)
+    pipeline = RestartPipeline(restarter, loop=loop)
+
+    restarter.update("a.yaml", MAPPING % ("a", "a", "a"))
+    pipeline.changed()
+
+    run_pipeline(pipeline, lambda: restarter.signals)
+
+    # The restart was signalled only once generation 1 was committed: in the
+    # manifest, and in place as envoy-1.json.
+    assert restarter.signals == [ (1, True) ]
+    assert restarter.envoy_configs() == [ "envoy-1.json" ]
+    assert restarter.manifest.entry(1)["valid"]
+    assert restarter.changes() == 0
+
+def test_pipeline_failed_validation(tmpdir, loop):
+    restarter = make_restarter(tmpdir, cls=FakeRestarter)
+    pipeline = RestartPipeline(restarter, loop=loop)
+
+    restarter.update("a.yaml", "invalid")
+    pipeline.changed()
+
+    run_pipeline(pipeline, lambda: restarter.changes() == 0)
+
+    # Nothing was committed or signalled, but the failure is on record, with
+    # its config left around for debugging.
+    entry = restarter.manifest.entry(1)
+
+    assert restarter.signals == []
+    assert restarter.envoy_configs() == []
+    assert not entry["valid"]
+    assert entry["envoy_config"] == "%s-envoy.json" % restarter.generation_dir(1)
+    assert os.path.exists(entry["envoy_config"])
+    assert restarter.manifest.latest_entry() is None
+
+    # The synchronous path agrees.
+    assert not restarter.validate_config(entry["envoy_config"])
+
+    # Fixing the input gets us a restart.
+    restarter.update("a.yaml", MAPPING % ("a", "a", "a"))
+    pipeline.changed()
+
+    run_pipeline(pipeline, lambda: restarter.signals)
+
+    assert restarter.signals == [ (2, True) ]
+    assert restarter.envoy_configs() == [ "envoy-2.json" ]
+    assert restarter.validate_config(restarter.manifest.latest_envoy_config())
+
+def test_pipeline_newer_generation_replaces_queued(tmpdir, loop):
+    restarter = make_restarter(tmpdir, cls=FakeRestarter)
+    pipeline = RestartPipeline(restarter, loop=loop)
+
+    def generate():
+        generation = restarter.manifest.next_generation()
+        output = restarter.generation_dir(generation)
+        configs, pokes = restarter.snapshot()
+
+        return generation, output, restarter.generate_config(generation, output, configs), pokes
+
+    restarter.update("a.yaml", MAPPING % ("a", "a", "a"))
+    pipeline.discard(put_latest(pipeline.to_validate, generate()))
+
+    restarter.update("b.yaml", MAPPING % ("b", "b", "b"))
+    pipeline.discard(put_latest(pipeline.to_validate, generate()))
+
+    # Generation 1 never got validated; 2 took its place.
+    assert pipeline.to_validate.qsize() == 1
+    assert restarter.manifest.entry(1)["abandoned"]
+    assert not restarter.manifest.entry(1)["valid"]
+    assert restarter.skipped == 1
+
+    run_pipeline(pipeline, lambda: restarter.signals)
+
+    assert restarter.signals == [ (2, True) ]
+    assert restarter.envoy_configs() == [ "envoy-2.json" ]
+    assert restarter.manifest.entry(2)["skipped"] == 1
+    assert restarter.changes() == 0
+
+class BurstyRestarter (FakeRestarter):
+    """
+    A FakeRestarter that gets a new input while it's generating each of its
+    first burst generations, as if changes were streaming in.
+    """
+
+    def __init__(self, *args, burst=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.burst = burst
+
+    def generate_config(self, generation, output, configs):
+        envoy_config = super().generate_config(generation, output, configs)
+
+        if generation <= self.burst:
+            self.update("burst-%d.yaml" % generation, MAPPING % ("b%d" % generation, "b", "b"))
+
+        return envoy_config
+
+def test_pipeline_burst_collapses(tmpdir, loop):
+    restarter = make_restarter(tmpdir, cls=BurstyRestarter, burst=3)
+    pipeline = RestartPipeline(restarter, loop=loop)
+    restarter.on_poke = pipeline.poked
+
+    # A burst that all arrives before we get going is a single generation...
+    for name in "abcde":
+        restarter.update("%s.yaml" % name, MAPPING % (name, name, name))
+
+    pipeline.changed()
+
+    # ...and one that keeps arriving while we generate abandons everything
+    # but the newest.
+    run_pipeline(pipeline, lambda: restarter.signals)
+
+    assert restarter.signals == [ (4, True) ]
+    assert restarter.skipped == 3
+    assert restarter.consecutive_skips == 0
+    assert restarter.envoy_configs() == [ "envoy-4.json" ]
+    assert restarter.changes() == 0
+
+    for generation in range(1, 4):
+        assert restarter.manifest.entry(generation)["abandoned"]
+
+    entry = restarter.manifest.entry(4)
+    assert entry["skipped"] == 3
+
+    with open(entry["envoy_config"]) as fd:
+        assert sorted(json.load(fd).keys()) == [ "a.yaml", "b.yaml", "burst-1.yaml", "burst-2.yaml",
+                                                 "burst-3.yaml", "c.yaml", "d.yaml", "e.yaml" ]
+
+def test_max_skips(tmpdir):
+    # Changes never stop coming, so every generation is superseded by the
+    # time it's generated. After max_skips abandoned generations in a row,
+    # we apply the next one anyway.
+    restarter = make_restarter(tmpdir, cls=BurstyRestarter, burst=100)
+    assert Restarter.max_skips == 5
+
+    restarter.update("a.yaml", MAPPING % ("a", "a", "a"))
+    restarter.restart()
+
+    assert restarter.signals == [ (6, True) ]
+    assert restarter.skipped == 5
+    assert restarter.consecutive_skips == 0
+    assert restarter.manifest.entry(6)["skipped"] == 5
+    assert restarter.envoy_configs() == [ "envoy-6.json" ]
+
+    for generation in range(1, 6):
+        assert restarter.manifest.entry(generation)["abandoned"]
+
+    # Generation 6 was superseded too; it just wasn't abandoned.
+    assert restarter.changes() > 0
+
+    # The count starts over after a restart.
+    assert restarter.superseded(0)
+
+def test_pipeline_leader_election(tmpdir, loop, monkeypatch):
+    # Watching does nothing here but wait to be stopped.
+    monkeypatch.setattr(kubewatch, "watch_forever", lambda restarter, stopped: stopped.wait())
+
+    clock = FakeClock()
+    lock_path = str(tmpdir.join("leader.json"))
+    channel = FileChannel(str(tmpdir.join("snapshot.json")))
+
+    a = make_restarter(tmpdir.mkdir("a"), cls=FakeRestarter)
+    b = make_restarter(tmpdir.mkdir("b"), cls=FakeRestarter)
+
+    leader = RestartPipeline(a, loop=loop,
+                             election=(FileLock(lock_path, identity="a", lease_duration=0.3, clock=clock), channel))
+    follower = RestartPipeline(b, loop=loop,
+                               election=(FileLock(lock_path, identity="b", lease_duration=0.3, clock=clock), channel))
+
+    a.update("qotm.yaml", MAPPING % ("qotm", "qotm", "qotm"))
+    b.on_poke = follower.poked
+
+    leader_stages = start_stages(leader, election=True)
+    follower_stages = []
+
+    try:
+        # a takes the lock first, so it generates and publishes; b applies
+        # what a published, without generating anything itself.
+        wait_for(loop, lambda: leader.leading)
+        follower_stages = start_stages(follower, election=True)
+        wait_for(loop, lambda: b.signals)
+
+        published = channel.fetch()
+
+        assert leader.leading and not follower.leading
+        assert a.signals == [ (1, True) ]
+        assert published["leader"] == "a"
+        assert published["digest"] == a.digest
+        assert a.manifest.entry(1)["digest"] == a.digest
+
+        assert b.signals == [ (1, True) ]
+        assert b.cert_dirs == [ b.generation_dir(1) ]
+        assert b.digest == published["digest"]
+        assert b.manifest.entry(1)["leader"] == "a"
+        assert b.configs == a.configs
+
+        with open(a.manifest.latest_envoy_config()) as fd_a, open(b.manifest.latest_envoy_config()) as fd_b:
+            assert fd_a.read() == fd_b.read()
+
+        # Changes b sees while it's following wait until it leads.
+        b.update("sneaky.yaml", MAPPING % ("sneaky", "sneaky", "sneaky"))
+
+        # a goes away without releasing the lock. Once its lease runs out,
+        # b takes over, starts watching, and publishes its own generations.
+        stop_stages(loop, leader_stages)
+        leader_stages = []
+
+        clock.now += 1
+        wait_for(loop, lambda: follower.leading)
+
+        assert follower.watch_stopped is not None
+
+        wait_for(loop, lambda: (channel.fetch()["leader"] == "b") and (b.digest == channel.fetch()["digest"]))
+
+        assert b.signals == [ (1, True), (2, True) ]
+        assert "sneaky.yaml" in channel.fetch()["inputs"]
+    finally:
+        stop_stages(loop, leader_stages + follower_stages)
+        leader.stop_watching()
+        follower.stop_watching()
+
+def test_pipeline_follower_validates(tmpdir, loop):
+    clock = FakeClock()
+    lock_path = str(tmpdir.join("leader.json"))
+    channel = FileChannel(str(tmpdir.join("snapshot.json")))
+
+    # Somebody else holds the lock for good.
+    assert FileLock(lock_path, identity="a", lease_duration=0.3, clock=clock).acquire()
+
+    b = make_restarter(tmpdir.mkdir("b"), cls=FakeRestarter)
+    follower = RestartPipeline(b, loop=loop,
+                               election=(FileLock(lock_path, identity="b", lease_duration=0.3, clock=clock), channel))
+
+    inputs = { "qotm.yaml": MAPPING % ("qotm", "qotm", "qotm") }
+    invalid = make_snapshot(1, "a", json.dumps({ "invalid": True }), inputs)
+    channel.publish(invalid)
+
+    stages = start_stages(follower, election=True)
+
+    try:
+        # A snapshot that doesn't validate here is recorded as a failure, and
+        # Envoy isn't restarted with it, or tried again.
+        wait_for(loop, lambda: b.digest == invalid["digest"])
+
+        assert not follower.leading
+        assert b.cert_dirs == [ b.generation_dir(1) ]
+        assert b.manifest.entry(1)["valid"] is False
+        assert b.signals == []
+        assert b.envoy_configs() == []
+
+        # The leader's next generation is fine.
+        channel.publish(make_snapshot(2, "a", json.dumps(inputs), inputs))
+        wait_for(loop, lambda: b.signals)
+
+        assert b.signals == [ (2, True) ]
+        assert b.manifest.entry(2)["leader"] == "a"
+        assert b.cert_dirs == [ b.generation_dir(1), b.generation_dir(2) ]
+    finally:
+        stop_stages(loop, stages)
+
+TLS_MODULE = """---
+apiVersion: ambassador/v0
+kind: Module
+name: tls
+config:
+  server:
+    enabled: true
+    secret: qotm-certs
+"""
+
+def test_save_certs(tmpdir, monkeypatch):
+    import ambassador.config
+
+    saved = []
+
+    monkeypatch.setattr(ambassador.config, "kube_v1", lambda: "v1")
+    monkeypatch.setattr(ambassador.config, "check_cert_file", lambda path: False)
+    monkeypatch.setattr(ambassador.config, "read_cert_secret",
+                        lambda v1, name, namespace: (b"cert", b"key", {}) if name == "qotm-certs" else (None, None, None))
+    monkeypatch.setattr(ambassador.config, "save_cert", lambda cert, key, dir: saved.append((cert, key, dir)))
+
+    output = tmpdir.join("config-1")
+    output.mkdir()
+    output.join("tls.yaml").write(TLS_MODULE)
+
+    # A follower gets the Secret's certs from loading the inputs alone.
+    make_restarter(tmpdir).save_certs(str(output))
+
+    assert saved == [ (b"cert", b"key", "/ambassador/certs") ]
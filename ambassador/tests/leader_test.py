@@ -0,0 +1,139 @@
+import copy
+import json
+
+import pytest
+
+from kubernetes.client.rest import ApiException
+
+from ambassador.leader import ConfigMapLock, FileChannel, FileLock, LeaderLock, LEADER_KEY, make_snapshot
+
+class FakeClock (object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class FakeCoreV1 (object):
+    """
+    Just enough of CoreV1Api for ConfigMapLock, including resourceVersion
+    conflict detection.
+    """
+
+    def __init__(self):
+        self.config_maps = {}
+        self.version = 0
+
+    def key(self, name, namespace):
+        return "%s/%s" % (namespace, name)
+
+    def read_namespaced_config_map(self, name, namespace):
+        cm = self.config_maps.get(self.key(name, namespace), None)
+
+        if not cm:
+            raise ApiException(status=404)
+
+        return copy.deepcopy(cm)
+
+    def create_namespaced_config_map(self, namespace, body):
+        key = self.key(body.metadata.name, namespace)
+
+        if key in self.config_maps:
+            raise ApiException(status=409)
+
+        self.version += 1
+        body.metadata.resource_version = str(self.version)
+        self.config_maps[key] = copy.deepcopy(body)
+
+    def replace_namespaced_config_map(self, name, namespace, body):
+        current = self.config_maps.get(self.key(name, namespace), None)
+
+        if not current:
+            raise ApiException(status=404)
+
+        if body.metadata.resource_version and (body.metadata.resource_version != current.metadata.resource_version):
+            raise ApiException(status=409)
+
+        self.version += 1
+        body.metadata.resource_version = str(self.version)
+        self.config_maps[self.key(name, namespace)] = copy.deepcopy(body)
+
+def test_leader_lock_is_abstract():
+    with pytest.raises(TypeError):
+        LeaderLock(identity="a")
+
+def test_file_lock(tmpdir):
+    path = str(tmpdir.join("leader.json"))
+    clock = FakeClock()
+
+    a = FileLock(path, identity="a", lease_duration=10, clock=clock)
+    b = FileLock(path, identity="b", lease_duration=10, clock=clock)
+
+    assert a.acquire()
+    assert not b.acquire()
+    assert a.holder() == "a"
+
+    # a keeps renewing, so b never gets it...
+    clock.now += 8
+    assert a.acquire()
+    clock.now += 8
+    assert not b.acquire()
+
+    # ...until a stops renewing and the lease expires.
+    clock.now += 11
+    assert b.acquire()
+    assert not a.acquire()
+    assert a.holder() == "b"
+
+    # Releasing hands over immediately.
+    b.release()
+    assert a.acquire()
+
+def test_configmap_lock():
+    v1 = FakeCoreV1()
+    clock = FakeClock()
+
+    a = ConfigMapLock(v1, "default", "ambassador-leader", identity="a", lease_duration=10, clock=clock)
+    b = ConfigMapLock(v1, "default", "ambassador-leader", identity="b", lease_duration=10, clock=clock)
+
+    assert a.acquire()
+    assert not b.acquire()
+
+    cm = v1.read_namespaced_config_map("ambassador-leader", "default")
+    assert json.loads(cm.metadata.annotations[LEADER_KEY])['holder'] == "a"
+
+    clock.now += 11
+    assert b.acquire()
+    assert not a.acquire()
+
+    b.release()
+    assert a.acquire()
+
+def test_configmap_lock_race():
+    v1 = FakeCoreV1()
+    clock = FakeClock()
+
+    a = ConfigMapLock(v1, "default", "ambassador-leader", identity="a", lease_duration=10, clock=clock)
+    b = ConfigMapLock(v1, "default", "ambassador-leader", identity="b", lease_duration=10, clock=clock)
+
+    a.acquire()
+    clock.now += 11
+
+    # Both see the expired lease, but only the first write wins.
+    cm_a = a.read()
+    cm_b = b.read()
+
+    assert a.write(cm_a, a.new_record(clock.now))
+    assert not b.write(cm_b, b.new_record(clock.now))
+    assert not b.acquire()
+
+def test_file_channel(tmpdir):
+    channel = FileChannel(str(tmpdir.join("snapshot.json")))
+
+    assert channel.fetch() is None
+
+    snapshot = make_snapshot(3, "a", '{ "listeners": [] }', { "svc.yaml": "---\nkind: Mapping\n" })
+    channel.publish(snapshot)
+
+    assert channel.fetch() == snapshot
+    assert make_snapshot(4, "b", '{ "listeners": [] }', {})['digest'] == snapshot['digest']
@@ -0,0 +1,68 @@
+import socket
+import urllib.request
+
+from ambassador.metrics import MetricsServer, Registry
+
+def test_render():
+    registry = Registry()
+
+    events = registry.counter("events_total", "Events")
+    depth = registry.gauge("queue_depth", "Queue depth", fn=lambda: 3)
+    latency = registry.histogram("latency_seconds", "Latency", buckets=( 0.1, 1.0 ))
+
+    events.inc(type="ADDED")
+    events.inc(type="ADDED")
+    events.inc(type="DELETED")
+
+    latency.observe(0.05)
+    latency.observe(0.1)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    assert events.get(type="ADDED") == 2
+    assert latency.count() == 4
+
+    lines = registry.render().split("\n")
+
+    assert "# TYPE events_total counter" in lines
+    assert 'events_total{type="ADDED"} 2' in lines
+    assert 'events_total{type="DELETED"} 1' in lines
+    assert "queue_depth 3" in lines
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert "latency_seconds_sum 5.65" in lines
+    assert "latency_seconds_count 4" in lines
+
+def test_statsd():
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sink.settimeout(5)
+
+    registry = Registry()
+    registry.enable_statsd(port=sink.getsockname()[1], prefix="ambassador.")
+
+    registry.counter("restarts_total", "Restarts").inc()
+    registry.histogram("validation_seconds", "Validation").observe(0.25)
+    registry.counter("failures_total", "Failures").inc(stage="validate")
+
+    assert sink.recv(1024) == b"ambassador.restarts_total:1|c"
+    assert sink.recv(1024) == b"ambassador.validation_seconds:250|ms"
+    assert sink.recv(1024) == b"ambassador.failures_total.validate:1|c"
+
+def test_server():
+    registry = Registry()
+    registry.counter("restarts_total", "Restarts").inc()
+
+    server = MetricsServer(registry, address="127.0.0.1", port=0)
+    server.start()
+
+    try:
+        url = "http://127.0.0.1:%d/metrics" % server.server_address[1]
+        body = urllib.request.urlopen(url).read().decode("utf-8")
+
+        assert "restarts_total 1" in body.split("\n")
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,175 @@
+import os
+import re
+
+from ambassador.config import Config
+from ambassador.route_matcher import RouteMatcher, ReplayStats, parse_access_line
+
+MAPPINGS = """---
+apiVersion: ambassador/v0
+kind: Mapping
+name: qotm
+prefix: /qotm/
+service: qotm
+---
+apiVersion: ambassador/v0
+kind: Mapping
+name: qotm_post
+prefix: /qotm/quote/
+method: POST
+service: qotm-writer
+---
+apiVersion: ambassador/v0
+kind: Mapping
+name: qotm_id
+prefix: "/qotm/[0-9]+"
+prefix_regex: true
+service: qotm-id
+---
+apiVersion: ambassador/v0
+kind: Mapping
+name: qotm_canary
+prefix: /qotm/
+headers:
+  x-canary: "true"
+service: qotm-canary
+---
+apiVersion: ambassador/v0
+kind: Mapping
+name: example
+prefix: /
+host: example.com
+service: example
+---
+apiVersion: ambassador/v0
+kind: Mapping
+name: shouty
+prefix: /Shout/
+case_sensitive: false
+service: shouty
+"""
+
+def build_matcher(tmpdir):
+    config_dir = str(tmpdir.join("config"))
+    os.makedirs(config_dir)
+
+    with open(os.path.join(config_dir, "mappings.yaml"), "w") as fd:
+        fd.write(MAPPINGS)
+
+    routes = Config(config_dir).envoy_config['routes']
+
+    return routes, RouteMatcher(routes)
+
+def cluster_of(routes, index):
+    return routes[index]['clusters'][0]['name'] if index is not None else None
+
+def slow_match(routes, path, method, authority, headers):
+    """ Try every route in order, the obvious way. """
+
+    headers = dict(headers, **{ ':method': method })
+
+    if authority:
+        headers[':authority'] = authority
+
+    for index, route in enumerate(routes):
+        if 'prefix' in route:
+            matched = path.startswith(route['prefix'])
+        else:
+            matched = re.fullmatch(route['regex'], path.split('?')[0])
+
+        for header in route.get('headers', []):
+            value = headers.get(header['name'], None)
+
+            if (value is None) or (('value' in header) and
+                                   not (re.fullmatch(header['value'], value) if header.get('regex', False)
+                                        else (value == header['value']))):
+                matched = False
+
+        if matched:
+            return index, index + 1
+
+    return None, len(routes)
+
+def test_route_matcher(tmpdir):
+    routes, matcher = build_matcher(tmpdir)
+
+    def hit(path, method='GET', authority=None, **headers):
+        return cluster_of(routes, matcher.match(path, method=method, authority=authority, headers=headers)[0])
+
+    assert hit("/qotm/") == "cluster_qotm"
+    assert hit("/qotm/quote/") == "cluster_qotm"
+    assert hit("/qotm/quote/", method="POST") == "cluster_qotm_writer"
+    assert hit("/qotm/42") == "cluster_qotm_id"
+    assert hit("/qotm/42?json=true") == "cluster_qotm_id"
+    assert hit("/qotm/42/more") == "cluster_qotm"
+    assert hit("/qotm/", **{ "x-canary": "true" }) == "cluster_qotm_canary"
+    assert hit("/qotm/", **{ "x-canary": "false" }) == "cluster_qotm"
+    assert hit("/anything", authority="example.com") == "cluster_example"
+    assert hit("/anything") is None
+    assert hit("/Shout/it") == "cluster_shouty"
+
+    # Envoy never sees case_sensitive: false (envoy.j2 drops it), so case
+    # still matters.
+    assert hit("/sHOUT/it") is None
+    assert hit("/ambassador/v0/check_alive") == "cluster_127_0_0_1_8877"
+
+    # Depth is the position of the matching route, or every route if none.
+    index, depth = matcher.match("/qotm/")
+    assert depth == index + 1
+    assert matcher.match("/anything") == (None, len(routes))
+
+    lookup = matcher.lookup("/qotm/quote/", method="POST")
+    assert lookup["route"]["prefix"] == "/qotm/quote/"
+    assert lookup["route_count"] == len(routes)
+
+    # The index and the cache don't change any answers.
+    for path in [ "/", "/qotm", "/qotm/", "/qotm/7", "/qotm/7?x=1", "/qotm/quote/x", "/Shout/", "/SHOUT/", "/shout",
+                  "/ambassador/v0/check_ready", "/other" ]:
+        for method in [ "GET", "POST" ]:
+            for authority in [ None, "example.com" ]:
+                for headers in [ {}, { "x-canary": "true" } ]:
+                    for attempt in range(2):
+                        assert matcher.match(path, method=method, authority=authority, headers=headers) == \
+                               slow_match(routes, path, method, authority, headers)
+
+def test_bad_regex():
+    matcher = RouteMatcher([ { "regex": "/broken[", "clusters": [] }, { "prefix": "/", "clusters": [] } ])
+
+    assert matcher.match("/broken[") == (1, 2)
+    assert matcher.errors[0][0] == 0
+
+ACCESS = ('ACCESS [2018-10-10T12:26:51.000Z] "%s %s HTTP/1.1" 200 - 0 42 5 4 "10.0.0.1" "curl/7.54.0" '
+          '"1b0a9fe0-6bd5-4bc4-a2e7-5a62a2ec4ed6" "%s" "10.1.2.3:5000"')
+
+def test_replay(tmpdir):
+    routes, matcher = build_matcher(tmpdir)
+
+    entry = parse_access_line("2018-10-10 12:26:51 " + ACCESS % ("GET", "/qotm/?json=true", "example.com"))
+    assert entry["method"] == "GET"
+    assert entry["path"] == "/qotm/?json=true"
+    assert entry["authority"] == "example.com"
+    assert entry["user-agent"] == "curl/7.54.0"
+    assert entry["response_flags"] is None
+
+    stats = ReplayStats(matcher)
+    lines = [ ACCESS % ("GET", "/qotm/", "localhost") ] * 3
+    lines += [ ACCESS % ("POST", "/qotm/quote/", "localhost") ]
+    lines += [ ACCESS % ("GET", "/nowhere", "localhost") ]
+    lines += [ "[2018-10-10 12:26:51.000][11][info][main] starting main dispatch loop" ]
+
+    for line in lines:
+        stats.add_line(line)
+
+    report = stats.report()
+
+    assert report["requests"] == 5
+    assert report["unmatched"] == 1
+    assert report["skipped"] == 1
+
+    busiest = report["routes"][0]
+    assert busiest["prefix"] == "/qotm/"
+    assert busiest["hits"] == 3
+    assert busiest["evaluations"] == 3 * busiest["depth"]
+
+    expected = sum(matcher.match(path, method=method)[1]
+                   for method, path in [ ("GET", "/qotm/") ] * 3 + [ ("POST", "/qotm/quote/"), ("GET", "/nowhere") ])
+    assert report["average_depth"] == expected / 5
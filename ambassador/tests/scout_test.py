@@ -0,0 +1,152 @@
+import atexit
+import multiprocessing
+import threading
+import time
+
+from ambassador.config import Config
+from ambassador.scout_reporter import EXIT_WAIT, ScoutCache, ScoutReporter
+
+class FakeScout (object):
+    def __init__(self, result=None, delay=0):
+        self.result = result or { "latest_version": "0.40.0" }
+        self.delay = delay
+        self.reports = []
+        self.release = threading.Event()
+
+    def report(self, **kwargs):
+        self.reports.append(kwargs)
+
+        if self.delay:
+            self.release.wait(self.delay)
+
+        return dict(self.result)
+
+def test_scout_reporter(tmpdir):
+    path = str(tmpdir.join("scout.json"))
+    scout = FakeScout(result={ "latest_version": "0.41.0" })
+    reporter = ScoutReporter(scout, ScoutCache(path))
+
+    # Nothing yet: report() doesn't wait for Scout...
+    assert reporter.report(mode="test") == (None, None)
+    assert reporter.flush()
+
+    # ...but the next one sees what it said.
+    result, timestamp = reporter.report(mode="test")
+    assert result == { "latest_version": "0.41.0" }
+    assert timestamp <= time.time()
+    assert scout.reports == [ { "mode": "test" } ]
+
+    # Another process sees the same result, and doesn't report again.
+    other_scout = FakeScout()
+    other = ScoutReporter(other_scout, ScoutCache(path))
+
+    assert other.report(mode="other")[0] == { "latest_version": "0.41.0" }
+    assert other.flush()
+    assert other_scout.reports == []
+
+    # Once the result is stale, the other process reports.
+    other.frequency = other.retry = 0
+    other.report(mode="other")
+    assert other.flush()
+    assert other_scout.reports == [ { "mode": "other" } ]
+    assert reporter.latest()[0] == { "latest_version": "0.40.0" }
+
+def test_scout_reporter_timeout(tmpdir):
+    scout = FakeScout(delay=10)
+    reporter = ScoutReporter(scout, ScoutCache(str(tmpdir.join("scout.json"))), timeout=0.2)
+
+    start = time.time()
+    assert reporter.report(mode="test") == (None, None)
+    assert time.time() - start < 0.1
+
+    assert reporter.flush()
+    scout.release.set()
+
+    # Scout didn't answer in time. We have something to show, but it isn't
+    # fresh, and we won't try again until the retry interval is up.
+    assert reporter.timeouts == 1
+    assert "timed out" in reporter.latest()[0]["exception"]
+
+    entry = reporter.cache.load()
+    assert entry["timestamp"] == 0
+    assert entry["attempted"] > start
+
+    reporter.report(mode="test")
+    assert reporter.flush()
+    assert len(scout.reports) == 1
+
+def test_scout_reporter_exit_wait(tmpdir, monkeypatch):
+    registered = []
+    monkeypatch.setattr(atexit, "register", lambda *args: registered.append(args))
+
+    scout = FakeScout(delay=10)
+    reporter = ScoutReporter(scout, ScoutCache(str(tmpdir.join("scout.json"))))
+    reporter.report(mode="test")
+
+    # Exiting with a report stuck in flight only waits a moment for it.
+    assert registered == [ (reporter.flush, EXIT_WAIT) ]
+    assert EXIT_WAIT <= 0.5
+
+    start = time.time()
+    assert not registered[0][0](*registered[0][1:])
+    assert time.time() - start < 1
+
+    scout.release.set()
+    assert reporter.flush()
+
+def hold_claim(path, claimed, done):
+    cache = ScoutCache(path)
+    assert cache.claim()
+    claimed.set()
+    done.wait(10)
+    cache.release()
+
+def test_scout_cache_claim(tmpdir):
+    path = str(tmpdir.join("scout.json"))
+    claimed = multiprocessing.Event()
+    done = multiprocessing.Event()
+
+    holder = multiprocessing.Process(target=hold_claim, args=(path, claimed, done))
+    holder.start()
+
+    try:
+        assert claimed.wait(10)
+
+        # Someone else is reporting, so we don't.
+        scout = FakeScout()
+        reporter = ScoutReporter(scout, ScoutCache(path))
+        reporter.report(mode="test")
+
+        assert reporter.flush()
+        assert scout.reports == []
+    finally:
+        done.set()
+        holder.join()
+
+    assert ScoutCache(path).claim()
+
+def test_config_scout_report(tmpdir, monkeypatch):
+    scout = FakeScout(result={ "latest_version": "99.0.0",
+                               "notices": [ { "level": "info", "message": "hello" } ] })
+
+    monkeypatch.delenv("AMBASSADOR_SCOUT_RESULT", raising=False)
+    monkeypatch.setattr(Config, "scout", scout)
+    monkeypatch.setattr(Config, "scout_reporter", ScoutReporter(scout, ScoutCache(str(tmpdir.join("scout.json")))))
+    monkeypatch.setattr(Config, "scout_notices", [])
+    monkeypatch.setattr(Config, "scout_latest_semver", None)
+
+    result = Config.scout_report(mode="test")
+
+    assert result["scout"] == "pending"
+    assert not result["cached"]
+
+    assert Config.scout_reporter.flush()
+
+    messages = [ notice["message"] for notice in Config.get_scout_notices() ]
+    assert "Upgrade available! to Ambassador version 99.0.0" in messages
+    assert "hello" in messages
+
+    result = Config.scout_report(mode="test")
+    assert result["cached"]
+    assert result["latest_version"] == "99.0.0"
+    assert len(scout.reports) == 1
@@ -0,0 +1,151 @@
+import multiprocessing
+import os
+import time
+
+from ambassador_diag.envoy import EnvoyAdminClient
+from ambassador_diag.shared import INITIAL_SIZE, SharedEnvoyStats, SharedSnapshot
+
+STATS = """cluster.cluster_qotm.membership_healthy: 1
+cluster.cluster_qotm.membership_total: 1
+cluster.cluster_qotm.upstream_rq_pending_total: 10
+cluster.cluster_qotm.upstream_rq_5xx: 1
+"""
+
+class CountingTransport (object):
+    def __init__(self):
+        self.requests = 0
+
+    def request(self, method, path, params=None):
+        self.requests += 1
+        return 200, STATS if path == "/stats" else "active loggers:\n  admin: warning\n"
+
+def test_snapshot(tmpdir):
+    path = str(tmpdir.join("stats"))
+
+    writer = SharedSnapshot(path)
+    reader = SharedSnapshot(path)
+
+    assert reader.read() == (0, None)
+
+    generation = writer.write(b"hello")
+    assert generation % 2 == 0
+    assert reader.read(loads=bytes) == (generation, b"hello")
+    assert reader.read(since=generation, loads=bytes) == (generation, None)
+
+    # Bigger than the file was when the reader mapped it.
+    big = b"x" * (INITIAL_SIZE * 3)
+    generation = writer.write(big)
+    assert reader.read(loads=bytes) == (generation, big)
+
+def writer(path, count):
+    snapshot = SharedSnapshot(path)
+
+    for i in range(count):
+        snapshot.write(bytes([ i % 256 ]) * (50000 + (i % 7) * 10000))
+
+def test_snapshot_consistency(tmpdir):
+    path = str(tmpdir.join("stats"))
+    reader = SharedSnapshot(path)
+    child = multiprocessing.Process(target=writer, args=(path, 3000))
+    child.start()
+
+    reads = 0
+
+    try:
+        while child.is_alive():
+            generation, data = reader.read(loads=bytes)
+
+            if data:
+                # Never a mix of two snapshots.
+                assert data == data[:1] * len(data)
+                reads += 1
+    finally:
+        child.join()
+
+    assert reads > 0
+
+def test_shared_stats(tmpdir):
+    path = str(tmpdir.join("stats"))
+
+    transports = [ CountingTransport(), CountingTransport() ]
+    collector, reader = [ SharedEnvoyStats(path, admin=EnvoyAdminClient(transport)) for transport in transports ]
+
+    assert not reader.is_ready()
+
+    collector.update()
+    reader.update()
+
+    # Only one of them talks to Envoy...
+    assert collector.collecting and not reader.collecting
+    assert transports[0].requests == 2
+    assert transports[1].requests == 0
+
+    # ...but they both see the same stats.
+    assert reader.is_ready()
+    assert reader.loginfo == { "all": "warning" }
+    assert reader.cluster_stats("cluster_qotm")["healthy_percent"] == 90
+    assert reader.stats["flat"]["cluster.cluster_qotm.upstream_rq_5xx"] == 1
+    assert reader.history.get("cluster_qotm").count == 1
+
+    generation = reader.generation
+    collector.update()
+    assert reader.stats["last_update"] == collector.stats["last_update"]
+    assert reader.generation > generation
+
+def test_shared_demand(tmpdir):
+    path = str(tmpdir.join("stats"))
+
+    collector = SharedEnvoyStats(path, admin=EnvoyAdminClient(CountingTransport()))
+    reader = SharedEnvoyStats(path, elect=False)
+
+    collector.tick()
+    assert collector.poll_period() == collector.idle_period
+
+    # Demand seen by any process speeds up the collector.
+    reader.demand()
+    assert collector.poll_period() == collector.active_period
+
+class LoggingTransport (CountingTransport):
+    def __init__(self, level):
+        super().__init__()
+        self.level = level
+
+    def request(self, method, path, params=None):
+        status, text = super().request(method, path, params=params)
+
+        if path == "/logging":
+            if params and ("level" in params):
+                self.level = params["level"]
+
+            text = "active loggers:\n  admin: %s\n" % self.level
+
+        return status, text
+
+def test_shared_log_levels(tmpdir):
+    path = str(tmpdir.join("stats"))
+
+    # Both talk to the same Envoy.
+    envoy = LoggingTransport("warning")
+    collector = SharedEnvoyStats(path, admin=EnvoyAdminClient(envoy))
+    reader = SharedEnvoyStats(path, elect=False, admin=EnvoyAdminClient(envoy))
+
+    collector.update()
+    assert reader.loginfo == { "all": "warning" }
+    polls = reader.stats["logging_polls"]
+
+    # A worker changes the log level...
+    assert reader.update_log_levels(time.time(), level="debug")
+    assert reader.loginfo == { "all": "debug" }
+
+    # ...and still sees it after the collector publishes its old copy...
+    requests = envoy.requests
+    collector.update()
+    assert reader.loginfo == { "all": "debug" }
+
+    # ...because the collector fetched the log levels again.
+    assert envoy.requests == requests + 2
+    assert collector.loginfo == { "all": "debug" }
+    assert reader.local_loginfo is None
+
+    # The worker's poll still counts.
+    assert reader.stats["logging_polls"] == polls + 2
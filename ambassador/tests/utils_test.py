@@ -0,0 +1,131 @@
+import base64
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import MaxRetryError
+
+import ambassador.utils
+
+from ambassador.utils import SecretCache, TokenBucket, kube_reset_needed, kube_v1, reset_kube_v1, \
+                             read_cert_secret, secret_cache
+
+class FakeClock (object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class FakeSecretsApi (object):
+    def __init__(self, secrets):
+        self.secrets = secrets
+        self.reads = 0
+
+    def read_namespaced_secret(self, name, namespace):
+        self.reads += 1
+
+        if name not in self.secrets:
+            raise ApiException(status=404, reason="Not Found")
+
+        return self.secrets[name]
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(2, 3, clock=clock, sleep=clock.sleep)
+
+    # The burst is free...
+    for i in range(3):
+        bucket.take()
+
+    assert clock.now == 100.0
+
+    # ...after that, we're limited to the rate.
+    bucket.take()
+    assert clock.now == 100.5
+
+    bucket.take()
+    assert clock.now == 101.0
+
+def test_secret_cache():
+    clock = FakeClock()
+    cache = SecretCache(ttl=10, clock=clock)
+
+    assert cache.get("default", "certs") == (False, None)
+
+    cache.put("default", "certs", "data")
+    cache.put("default", "other", None)
+    assert cache.get("default", "certs") == (True, "data")
+    assert cache.get("default", "other") == (True, None)
+
+    clock.now += 11
+    assert cache.get("default", "certs") == (False, None)
+
+    cache.put("default", "certs", "data")
+    cache.put("default", "other", "more")
+    cache.invalidate("default", "certs")
+    assert cache.get("default", "certs") == (False, None)
+    assert cache.get("default", "other") == (True, "more")
+
+    cache.invalidate("default")
+    assert cache.get("default", "other") == (False, None)
+
+def test_read_cert_secret_cached():
+    secret_cache.clear()
+
+    crt = base64.b64encode(b"CERT").decode("utf-8")
+    key = base64.b64encode(b"KEY").decode("utf-8")
+
+    api = FakeSecretsApi({ "ambassador-certs": client.V1Secret(data={ "tls.crt": crt, "tls.key": key }) })
+
+    for i in range(3):
+        (cert, k, data) = read_cert_secret(api, "ambassador-certs", "default")
+        assert (cert, k) == (b"CERT", b"KEY")
+
+        assert read_cert_secret(api, "missing", "default")[0] is None
+
+    assert api.reads == 2
+
+    secret_cache.invalidate("default", "ambassador-certs")
+    read_cert_secret(api, "ambassador-certs", "default")
+    assert api.reads == 3
+
+    secret_cache.clear()
+
+def test_kube_v1_reload(monkeypatch):
+    # The first load fails; after that, each load is a new client.
+    loads = []
+
+    def load():
+        loads.append(len(loads))
+        return None if len(loads) == 1 else "client-%d" % len(loads)
+
+    monkeypatch.setattr(ambassador.utils, "_load_kube_v1", load)
+    monkeypatch.setattr(ambassador.utils, "_kube_api", None)
+    monkeypatch.setattr(ambassador.utils, "_kube_loaded", False)
+
+    # A failure isn't remembered...
+    assert kube_v1() is None
+    assert kube_v1() == "client-2"
+
+    # ...but a client is, until it's reset.
+    assert kube_v1() == "client-2"
+    assert len(loads) == 2
+
+    reset_kube_v1()
+    assert kube_v1() == "client-3"
+    assert kube_v1() == "client-3"
+
+    reset_kube_v1()
+
+def test_kube_reset_needed():
+    assert kube_reset_needed(ApiException(status=401, reason="Unauthorized"))
+    assert kube_reset_needed(ApiException(status=403, reason="Forbidden"))
+    assert not kube_reset_needed(ApiException(status=404, reason="Not Found"))
+    assert not kube_reset_needed(ApiException(status=409, reason="Conflict"))
+
+    assert kube_reset_needed(MaxRetryError(None, "/api/v1/services"))
+    assert kube_reset_needed(ConnectionRefusedError())
+    assert not kube_reset_needed(ValueError("nope"))